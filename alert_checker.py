@@ -1,16 +1,23 @@
 import requests
 import os
-import json
 import logging
-from datetime import datetime
 import urllib3
+import conditional_fetch
+import snapshot_cache
+import renderers
+import alert_records
+import telegram_queue
+import subscriptions
+import metrics
 
 # --- Configurazione Allerte ---
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")
 
 # *** MODIFICA: Rimosso URL_ALLERTA_OGGI ***
-URL_ALLERTA_DOMANI = "https://allertameteo.regione.marche.it/o/api/allerta/get-stato-allerta-domani"
+# Base URL sovrascrivibile per i test offline (mock_server)
+ALLERTAMETEO_BASE_URL = os.environ.get("ALLERTAMETEO_BASE_URL", "https://allertameteo.regione.marche.it").rstrip("/")
+URL_ALLERTA_DOMANI = f"{ALLERTAMETEO_BASE_URL}/o/api/allerta/get-stato-allerta-domani"
 
 AREE_INTERESSATE_ALLERTE = ["2", "4"] # Esempio: ["1", "2", "3", "4", "5", "6"] per tutte
 LIVELLI_ALLERTA_IGNORATI = ["green", "white"]
@@ -18,20 +25,23 @@ LIVELLI_ALLERTA_IGNORATI = ["green", "white"]
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Nome con cui lo script registra le versioni di payload già elaborate (conditional_fetch)
+CONSUMATORE_FETCH = "alert_checker"
+# Ultime allerte per area calcolate da valuta_allerte_domani(), riusate se il bollettino non cambia
+_ultime_allerte_per_area = None
+
 # --- Funzioni Helper (Invariate dalla versione precedente, a parte formatta_evento_allerta già modificata) ---
 
 def fetch_data(url):
-    """Recupera dati JSON da un URL DISABILITANDO la verifica SSL."""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-    response = None
+    """Recupera dati da un URL DISABILITANDO la verifica SSL, tramite la cache condivisa snapshot_cache (RisultatoFetch o None)."""
     try:
         logging.warning(f"Tentativo di richiesta ALLERTE a {url} con VERIFICA SSL DISABILITATA (verify=False).")
-        response = requests.get(url, headers=headers, timeout=45, verify=False)
-        logging.info(f"Richiesta ALLERTE a {url} - Status Code: {response.status_code}")
-        response.raise_for_status()
-        return response.json()
+        risultato = snapshot_cache.cache().ottieni(url, CONSUMATORE_FETCH, timeout=45, verify=False)
+        if risultato.obsoleto:
+            logging.warning(f"Servizio ALLERTE non disponibile: uso del bollettino di {risultato.obsoleto_da:.0f}s fa (versione {risultato.versione[:8]})")
+        else:
+            logging.info(f"Richiesta ALLERTE a {url} - Versione payload: {risultato.versione[:8]}")
+        return risultato
     except requests.exceptions.Timeout as e:
         logging.error(f"Timeout durante la richiesta ALLERTE a {url}: {e}")
         return None
@@ -45,11 +55,6 @@ def fetch_data(url):
     except requests.exceptions.RequestException as e:
         logging.error(f"Errore generico durante la richiesta ALLERTE a {url}: {e}")
         return None
-    except json.JSONDecodeError as e:
-        resp_text = response.text[:200] if response else "N/A"
-        resp_status = response.status_code if response else "N/A"
-        logging.error(f"Errore nel decodificare JSON ALLERTE da {url}. Status: {resp_status}. Risposta (primi 200 char): '{resp_text}...' Errore: {e}")
-        return None
     except Exception as e:
         logging.error(f"Errore imprevisto durante il fetch ALLERTE da {url}: {e}", exc_info=True)
         return None
@@ -59,21 +64,11 @@ def send_telegram_message(token, chat_id, text):
     if not token or not chat_id:
         logging.error("Token Telegram o Chat ID non configurati.")
         return False
-    max_length = 4096
-    if len(text) > max_length:
-        logging.warning(f"Messaggio troppo lungo ({len(text)} caratteri), troncato a {max_length}.")
-        text = text[:max_length - 3] + "..."
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
-    payload = {'chat_id': chat_id, 'text': text, 'parse_mode': 'Markdown'}
-    try:
-        response = requests.post(url, data=payload, timeout=15)
-        response.raise_for_status()
+    if telegram_queue.invia_messaggio(token, chat_id, text, parse_mode='Markdown'):
         logging.info(f"Messaggio inviato con successo a chat ID {chat_id}")
         return True
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Errore durante l'invio del messaggio Telegram: {e}")
-        if e.response is not None: logging.error(f"Risposta API Telegram: {e.response.status_code} - {e.response.text}")
-        return False
+    logging.error(f"Messaggio per chat ID {chat_id} non consegnato, resta in coda per i tentativi successivi")
+    return False
 
 def formatta_evento_allerta(evento_str):
     """Formatta la stringa evento:colore in modo leggibile, con colori in italiano."""
@@ -100,80 +95,95 @@ def formatta_evento_allerta(evento_str):
 
 # --- Logica Principale Solo Allerte (MODIFICATA) ---
 
-def check_allerte_domani():
-    """Controlla le API di allerta per DOMANI e restituisce un messaggio se ci sono allerte rilevanti o errore fetch."""
-    messaggi_allerta_domani = []
+def valuta_allerte_domani():
+    """
+    Scarica il bollettino di DOMANI e restituisce ({area: [eventi rilevanti formattati]}, errore_fetch, obsoleto_da),
+    con obsoleto_da l'età in secondi del bollettino se il servizio non risponde e si usa l'ultima copia valida.
+    Il bollettino è valutato una sola volta per tutte le aree; i messaggi per chat filtrano il risultato.
+    """
+    global _ultime_allerte_per_area
     url = URL_ALLERTA_DOMANI
     tipo_giorno = "DOMANI" # Fisso perché controlliamo solo domani
 
     logging.info(f"Controllo allerte {tipo_giorno} da {url}...")
-    data = fetch_data(url)
+    risultato = fetch_data(url)
+    data = None
+    if risultato is not None:
+        if risultato.invariato and _ultime_allerte_per_area is not None:
+            logging.info(f"Bollettino allerte {tipo_giorno} invariato, riuso dell'ultimo esito.")
+            return (_ultime_allerte_per_area, None, risultato.obsoleto_da)
+        data = risultato.dati
 
     if data is None:
         # Restituisce solo il messaggio di errore per domani
-        return f"⚠️ Impossibile recuperare dati allerta {tipo_giorno} da {URL_ALLERTA_DOMANI}."
+        return ({}, f"⚠️ Impossibile recuperare dati allerta {tipo_giorno} da {URL_ALLERTA_DOMANI}.", None)
 
-    # Se il fetch è riuscito, processa i dati
-    allerte_rilevanti_giorno = []
+    # Se il fetch è riuscito, processa i dati (nell'ordine del bollettino)
+    allerte_per_area = {}
     for item in data:
         area = item.get("area")
         eventi_str = item.get("eventi")
-        if area in AREE_INTERESSATE_ALLERTE and eventi_str:
+        if eventi_str:
             eventi_list = eventi_str.split(',')
             eventi_formattati_area = [fmt for ev in eventi_list if (fmt := formatta_evento_allerta(ev.strip()))]
             if eventi_formattati_area:
-                 allerte_rilevanti_giorno.append(f"  - *Area {area}*:\n    " + "\n    ".join(eventi_formattati_area))
-
-    if allerte_rilevanti_giorno:
-         messaggi_allerta_domani.append(f"🚨 *Allerte Meteo RILEVANTI per {tipo_giorno}:*\n" + "\n".join(allerte_rilevanti_giorno))
-    
-    # Se non ci sono allerte rilevanti, restituisce stringa vuota
-    # Altrimenti, restituisce i messaggi di allerta per domani
-    if not messaggi_allerta_domani:
+                 allerte_per_area[area] = eventi_formattati_area
+
+    _ultime_allerte_per_area = allerte_per_area
+    for eventi in allerte_per_area.values():
+        metrics.incrementa("meteo_allerte_totale", len(eventi), fonte="allertameteo", evento="domani")
+    conditional_fetch.fetcher().conferma(risultato)
+    return (allerte_per_area, None, risultato.obsoleto_da)
+
+def testo_allerte(allerte_per_area, errore_fetch, aree, obsoleto_da=None):
+    """Messaggio delle allerte rilevanti nelle aree indicate, l'errore fetch, oppure stringa vuota se non ce ne sono."""
+    if errore_fetch:
+        return errore_fetch
+    allerte_rilevanti_giorno = [f"  - *Area {area}*:\n    " + "\n    ".join(eventi) for area, eventi in allerte_per_area.items() if area in aree]
+    if not allerte_rilevanti_giorno:
         return ""
-    else:
-        return "\n\n".join(messaggi_allerta_domani)
+    testo = "🚨 *Allerte Meteo RILEVANTI per DOMANI:*\n" + "\n".join(allerte_rilevanti_giorno)
+    if obsoleto_da is not None:
+        testo += "\n" + alert_records.avviso_obsoleto(obsoleto_da)
+    return testo
+
+def check_allerte_domani(aree=AREE_INTERESSATE_ALLERTE):
+    """Controlla le API di allerta per DOMANI e restituisce un messaggio se ci sono allerte rilevanti o errore fetch."""
+    allerte_per_area, errore_fetch, obsoleto_da = valuta_allerte_domani()
+    return testo_allerte(allerte_per_area, errore_fetch, aree, obsoleto_da)
 
 # --- Esecuzione Script Allerte (MODIFICATA) ---
-if __name__ == "__main__":
+def esegui_controllo_allerte():
+    """Esegue il controllo allerte per DOMANI e invia a ogni chat sottoscritta il messaggio di stato delle sue aree."""
     logging.info("--- Avvio Controllo ALLERTE Meteo Marche per DOMANI ---")
 
-    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
-        logging.critical("Errore: Le variabili d'ambiente TELEGRAM_BOT_TOKEN e TELEGRAM_CHAT_ID sono necessarie.")
-        exit(1)
-
-    # Esegui il check solo per domani
-    messaggio_allerte = check_allerte_domani() # Modificata chiamata funzione
-
-    messaggio_da_inviare = ""
-    timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    footer = f"\n\n*{'='*30}*"
-
-    # Caso 1: Ci sono messaggi (allerte rilevanti per domani o errore fetch)
-    if messaggio_allerte:
-        if "⚠️" in messaggio_allerte: # Indica errore fetch
-             header = f"*{'='*5} ERRORE Recupero Allerte DOMANI ({timestamp}) {'='*5}*\n\n"
-             messaggio_da_inviare = header + messaggio_allerte.strip() + footer
-             logging.error(f"Errore recupero dati allerte DOMANI rilevato: {messaggio_allerte}")
-        else: # Indica allerte rilevanti per domani
-             header = f"*{'='*5} Report ALLERTE RILEVANTI DOMANI ({timestamp}) {'='*5}*\n\n"
-             messaggio_da_inviare = header + messaggio_allerte.strip() + footer
-             logging.info("Trovate allerte rilevanti per DOMANI da notificare.")
-
-    # Caso 2: messaggio_allerte è vuoto (fetch OK, nessuna allerta rilevante per domani)
+    # Un solo fetch e una sola valutazione per tutte le chat
+    allerte_per_area, errore_fetch, obsoleto_da = valuta_allerte_domani()
+    aree_monitorate = sorted(set(AREE_INTERESSATE_ALLERTE) | subscriptions.registro().chiavi(subscriptions.AREE_ALLERTA))
+    if errore_fetch:
+        logging.error(f"Errore recupero dati allerte DOMANI rilevato: {errore_fetch}")
+    elif any(area in allerte_per_area for area in aree_monitorate):
+        logging.info("Trovate allerte rilevanti per DOMANI da notificare.")
     else:
-        header = f"*{'='*5} Report ALLERTE DOMANI ({timestamp}) {'='*5}*\n\n"
-        # *** MODIFICA: Aggiornato messaggio "nessuna allerta" ***
-        testo_ok = (f"✅ Nessuna allerta meteo rilevante (diversa da verde/bianco) "
-                    f"prevista per DOMANI nelle aree monitorate "
-                    f"({', '.join(AREE_INTERESSATE_ALLERTE)}).")
-        messaggio_da_inviare = header + testo_ok + footer
         logging.info("Nessuna allerta meteo rilevante per DOMANI trovata (fetch OK). Invio messaggio di stato OK.")
 
-    if messaggio_da_inviare:
-        logging.info("Invio messaggio stato allerte a Telegram...")
-        send_telegram_message(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, messaggio_da_inviare)
-    else:
-         logging.warning("Nessun messaggio da inviare è stato preparato per Telegram.")
+    # Un solo report per tutte le chat e tutti i formati
+    report = renderers.report_allerte(allerte_per_area, errore_fetch, aree_monitorate, obsoleto_da=obsoleto_da)
+
+    def componi(aree):
+        return renderers.MARKDOWN.allerte(report, sorted(aree))
+
+    logging.info("Invio messaggio stato allerte a Telegram...")
+    per_chat = subscriptions.registro().sottoscritte(subscriptions.AREE_ALLERTA, aree_monitorate)
+    subscriptions.fan_out(TELEGRAM_BOT_TOKEN, per_chat, componi, parse_mode=renderers.MARKDOWN.parse_mode)
+    renderers.pubblica("allerte", report)
 
     logging.info("--- Controllo ALLERTE Meteo Marche per DOMANI completato ---")
+    return testo_allerte(allerte_per_area, errore_fetch, AREE_INTERESSATE_ALLERTE, obsoleto_da)
+
+if __name__ == "__main__":
+    if not TELEGRAM_BOT_TOKEN or not len(subscriptions.registro()):
+        logging.critical("Errore: Sono necessari TELEGRAM_BOT_TOKEN e TELEGRAM_CHAT_ID (o un registro sottoscrizioni).")
+        exit(1)
+
+    esegui_controllo_allerte()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Record strutturati degli alert e dei valori stazione, separati dalla resa testuale.
+
+Le funzioni di controllo producono record compatti (dataclass con __slots__)
+con bacino, stazione, rango della stazione nel bacino, sensore, valore e
+soglia. Ordinamento e raggruppamento usano il rango intero precalcolato da
+ORDINE_STAZIONI_PER_BACINO (nessuna ricerca nel testo); il testo viene
+generato solo alla fine da formatta_allerta() / formatta_valori_stazione() con
+lo Stile richiesto (Markdown legacy di default, MarkdownV2 in renderers), così
+gli stessi record possono servire anche ad altri consumatori (bot, JSON, HTML).
+"""
+import sys
+from collections import namedtuple
+from dataclasses import dataclass, field
+
+# Rango delle stazioni assenti dall'ordine del bacino: dopo tutte le altre, in ordine alfabetico
+RANGO_NON_ORDINATO = sys.maxsize
+
+CATEGORIA_SOGLIA = "soglia"
+CATEGORIA_VELOCITA = "velocita"
+CATEGORIA_STAZIONE = "stazione"
+
+# Eventi degli alert (riesportati da threshold_state e station_updates). Definiti qui
+# perché questo modulo non dipenda dallo stato su SQLite né da numpy (readings_archive):
+# alert_checker e renderers lo importano anche nei workflow con solo `requests`.
+EVENTO_SUPERAMENTO = "superamento"
+EVENTO_AGGRAVAMENTO = "aggravamento"
+EVENTO_RIENTRO = "rientro"
+EVENTO_FERMA = "ferma"
+EVENTO_RIPRESA = "ripresa"
+
+# Intestazioni per evento: (emoji, titolo in grassetto)
+INTESTAZIONI_EVENTO = {
+    EVENTO_SUPERAMENTO: ("‼️", "Soglia Superata!"),
+    EVENTO_AGGRAVAMENTO: ("⏫", "Soglia Superata - In Aumento!"),
+    EVENTO_RIENTRO: ("✅", "Rientro Sotto Soglia"),
+}
+INTESTAZIONI_EVENTO_VELOCITA = {
+    EVENTO_SUPERAMENTO: ("🌊", "Crescita Rapida!"),
+    EVENTO_RIENTRO: ("✅", "Crescita Rapida Rientrata"),
+}
+INTESTAZIONI_EVENTO_STAZIONE = {
+    EVENTO_FERMA: ("⏸️", "Stazione Senza Aggiornamenti"),
+    EVENTO_RIPRESA: ("▶️", "Stazione di Nuovo Aggiornata"),
+}
+
+# Stile di resa del testo: grassetto(testo) e testo(testo) semplice (escape del formato).
+# MARKDOWN è il Markdown legacy di Telegram usato finora, senza escape; altri stili in renderers.
+Stile = namedtuple("Stile", ["grassetto", "testo"])
+MARKDOWN = Stile(lambda testo: f"*{testo}*", str)
+
+
+@dataclass(slots=True)
+class Allerta:
+    """Alert di soglia, di velocità di crescita o di stato stazione."""
+    categoria: str
+    evento: str
+    bacino: str
+    stazione: str
+    rango: int
+    ultimo_agg: str = "N/A"
+    sensore: str = ""
+    tipo_sens: int = None
+    unmis: str = ""
+    valore: float = None
+    soglia: float = None # come configurata (int o float), per la resa
+    sorgente: str = "" # sorgente della soglia (generica/specifica)
+    trend: str = "" # simbolo trend, "" se assente
+    minuti: int = None # finestra della velocità o minuti senza aggiornamenti
+    velocita: float = None
+
+
+@dataclass(slots=True)
+class LetturaSensore:
+    """Valore attuale di un sensore monitorato, per il report completo."""
+    sensore: str
+    tipo_sens: int
+    unmis: str
+    soglia: float
+    valore: float = None # None se non disponibile
+    valore_raw: object = None
+    non_numerico: bool = False
+    trend: str = ""
+
+
+@dataclass(slots=True)
+class ValoriStazione:
+    """Valori attuali di tutti i sensori monitorati di una stazione."""
+    bacino: str
+    stazione: str
+    rango: int
+    ultimo_agg: str = "N/A"
+    letture: list = field(default_factory=list)
+    nota: str = "" # stazione monitorata ma non valutata (es. scartata dal registro), senza letture
+
+
+def avviso_obsoleto(secondi):
+    """Avviso visibile per i dati serviti dall'ultima copia valida perché il servizio non risponde (snapshot_cache)."""
+    return f"⚠️ Servizio non raggiungibile: dati di {max(1, round(secondi / 60))} min fa."
+
+
+def compila_ranghi(ordine_stazioni_per_bacino):
+    """Precalcola {bacino: {stazione: posizione}} dall'ordine configurato."""
+    return {bacino: {stazione: indice for indice, stazione in enumerate(stazioni)}
+            for bacino, stazioni in ordine_stazioni_per_bacino.items()}
+
+
+def rango_stazione(ranghi, bacino, stazione):
+    return ranghi.get(bacino, {}).get(stazione, RANGO_NON_ORDINATO)
+
+
+def chiave_ordinamento(record):
+    """Chiave intera + nome: prima le stazioni nell'ordine del bacino, poi le altre in ordine alfabetico."""
+    return (record.rango, record.stazione)
+
+
+def ordina(records):
+    return sorted(records, key=chiave_ordinamento)
+
+
+def _intestazione(intestazioni, evento, stile):
+    emoji, titolo = intestazioni[evento]
+    return stile.testo(f"{emoji} ") + stile.grassetto(titolo)
+
+
+def formatta_allerta(allerta, stile=MARKDOWN):
+    """Resa testuale di un alert (default Markdown legacy di Telegram)."""
+    g, t = stile.grassetto, stile.testo
+    if allerta.categoria == CATEGORIA_STAZIONE:
+        intestazione = _intestazione(INTESTAZIONI_EVENTO_STAZIONE, allerta.evento, stile)
+        if allerta.minuti is not None:
+            intestazione += t(f" (da {allerta.minuti} min)")
+        return (f"{intestazione}\n"
+                f"{t('   Stazione: ')}{g(allerta.stazione)}\n"
+                f"{t(f'   Ultimo Agg.: {allerta.ultimo_agg}')}")
+
+    trend_display = f" {allerta.trend}" if allerta.trend else ""
+    if allerta.categoria == CATEGORIA_VELOCITA:
+        return (f"{_intestazione(INTESTAZIONI_EVENTO_VELOCITA, allerta.evento, stile)}{t(f' (ultimi {allerta.minuti} min)')}\n"
+                f"{t('   Stazione: ')}{g(allerta.stazione)}\n"
+                f"{t(f'   Sensore: {allerta.sensore}')}\n"
+                f"{t('   Velocità: ')}{g(f'{allerta.velocita:+.2f} {allerta.unmis}/h')}"
+                f"{t(f' (Soglia: {allerta.soglia} {allerta.unmis}/h, Livello: {allerta.valore:.2f} {allerta.unmis})')}\n"
+                f"{t(f'   Ultimo Agg.: {allerta.ultimo_agg}')}")
+
+    return (f"{_intestazione(INTESTAZIONI_EVENTO, allerta.evento, stile)}{t(f' ({allerta.sorgente})')}\n"
+            f"{t('   Stazione: ')}{g(allerta.stazione)}\n"
+            f"{t(f'   Sensore: {allerta.sensore}')}\n"
+            f"{t('   Valore: ')}{g(f'{allerta.valore:.2f} {allerta.unmis}{trend_display}')}{t(f' (Soglia: {allerta.soglia} {allerta.unmis})')}\n"
+            f"{t(f'   Ultimo Agg.: {allerta.ultimo_agg}')}")
+
+
+def formatta_lettura(lettura, stile=MARKDOWN):
+    g, t = stile.grassetto, stile.testo
+    if lettura.non_numerico:
+        return f"{t(f'  - {lettura.sensore}: ')}{g(lettura.valore_raw)}{t(f' (Val non num, Soglia: {lettura.soglia} {lettura.unmis})')}"
+    valore_display = "N/D" if lettura.valore is None else f"{lettura.valore:.2f} {lettura.unmis}"
+    trend_display = f" {lettura.trend}" if lettura.trend else ""
+    return f"{t(f'  - {lettura.sensore}: ')}{g(f'{valore_display}{trend_display}')}{t(f' (Soglia: {lettura.soglia} {lettura.unmis})')}"
+
+
+def formatta_valori_stazione(valori, stile=MARKDOWN):
+    """Resa testuale del blocco valori di una stazione (intestazione + una riga per sensore)."""
+    if valori.nota:
+        return stile.grassetto(valori.stazione) + stile.testo(f": ⚠️ {valori.nota}")
+    header_stazione = stile.grassetto(valori.stazione) + stile.testo(f" (Agg: {valori.ultimo_agg}):")
+    return header_stazione + "\n" + "\n".join(formatta_lettura(lettura, stile) for lettura in valori.letture)
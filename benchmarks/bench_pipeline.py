@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark offline delle pipeline stazioni, allerte e WeatherLink.
+
+Le fixture in benchmarks/fixtures (payload RETEMIR rt-data, bollettino allerte
+di domani, /current WeatherLink) vengono servite da una sessione HTTP finta
+al posto di requests.Session, quindi nessuna pipeline tocca la rete. Ogni
+payload è scalato sinteticamente (1×, 10×, 100×, 1000× stazioni o aree):
+le copie hanno codici e nomi propri e le copie delle stazioni monitorate
+sono monitorate anch'esse, così crescono insieme rete e sottoinsieme valutato.
+
+Pipeline misurate (con le funzioni di produzione, non con copie):
+  - stazioni-allerte: station_engine.esegui([allerte]) + messaggio soglie (check_stazioni_alert);
+  - stazioni-report:  station_engine.esegui([completo]) + report Markdown/JSON/HTML (check_stazioni_full_report);
+  - allerte-domani:   alert_checker.valuta_allerte_domani() + report allerte (check_allerte_domani);
+  - weatherlink:      fetch parallelo /current, controllo soglie per stazione e messaggio (weather_alert).
+
+Per ogni stadio (fetch, decodifica, filtro, archivio, valutazione, render) si
+riportano la latenza mediana e minima sulle ripetizioni (tempo esclusivo: gli stadi
+annidati non contano in quello esterno) e il picco di memoria allocata
+(tracemalloc, in un passaggio separato per non falsare i tempi); per la
+pipeline il totale, il throughput in record/s e il picco. Ogni scenario
+parte con una ripetizione di riscaldamento non misurata (registro stazioni
+e indice soglie già compilati, come nel daemon) e con stato sqlite/archivio
+nuovo in una cartella temporanea. In weatherlink la decodifica JSON avviene
+nei thread di fetch ed è inclusa nello stadio fetch.
+
+Uso:
+  python benchmarks/bench_pipeline.py [--scale 1,10,100,1000] [--ripetizioni 5] [--pipeline stazioni-report ...]
+  python benchmarks/bench_pipeline.py --salva-baseline          # scrive BENCH_BASELINE (benchmarks/baseline.json)
+  python benchmarks/bench_pipeline.py --confronta [--tolleranza 0.25]   # exit 1 se peggiora rispetto alla baseline
+  python benchmarks/bench_pipeline.py --registra                # aggiorna le fixture dagli endpoint reali
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import atexit
+import logging
+import argparse
+import platform
+import tempfile
+import functools
+import statistics
+import contextlib
+import tracemalloc
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+CARTELLA_BENCH = os.path.dirname(os.path.abspath(__file__))
+CARTELLA_FIXTURE = os.path.join(CARTELLA_BENCH, "fixtures")
+PERCORSO_BASELINE = os.environ.get("BENCH_BASELINE", os.path.join(CARTELLA_BENCH, "baseline.json"))
+
+# Stato persistente degli script (sqlite, archivio, versioni fetch) in una cartella temporanea:
+# le variabili vanno impostate prima di importare i moduli
+CARTELLA_TEMP = tempfile.mkdtemp(prefix="bench_pipeline_")
+atexit.register(shutil.rmtree, CARTELLA_TEMP, True)
+os.environ["STATO_SOGLIE_DB"] = os.path.join(CARTELLA_TEMP, "stato_soglie.sqlite3")
+os.environ["ARCHIVIO_LETTURE_DIR"] = os.path.join(CARTELLA_TEMP, "archivio_letture")
+os.environ["FETCH_STATO_PATH"] = os.path.join(CARTELLA_TEMP, "stato_fetch.json")
+os.environ["TELEGRAM_CODA_DB"] = os.path.join(CARTELLA_TEMP, "coda_telegram.sqlite3")
+os.environ["REPORT_DIR"] = ""
+
+sys.path.insert(0, os.path.dirname(CARTELLA_BENCH))
+import requests
+import alert_checker
+import conditional_fetch
+import rate_of_rise
+import readings_archive
+import renderers
+import snapshot_cache
+import snapshot_eval
+import station_checker
+import station_engine
+import station_registry
+import station_updates
+import threshold_state
+import weather_alert
+
+SCALE_DEFAULT = [1, 10, 100, 1000]
+RIPETIZIONI_DEFAULT = 5
+TOLLERANZA_DEFAULT = 0.25
+# Differenze sotto queste soglie sono rumore di misura, non regressioni
+RUMORE_MS = 0.2
+RUMORE_KB = 64
+
+# Offset dei codici delle copie sintetiche (oltre ogni codice reale)
+OFFSET_CODICE = 100000
+ORARIO_BASE = datetime(2026, 10, 17, 10, 0)
+FORMATO_ORARIO = "%d/%m/%Y %H:%M"
+
+FIXTURE = {
+    "rt-data": "rt-data.json",
+    "allerta-domani": "allerta-domani.json",
+    "weatherlink-current": "weatherlink-current.json",
+}
+
+
+# --- Replay HTTP ---
+class RispostaRegistrata:
+    """Risposta con l'interfaccia di requests.Response usata dagli script."""
+
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.content = body
+        self.headers = {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} (fixture)", response=self)
+
+
+class SessioneRegistrata:
+    """Al posto di requests.Session: risponde con i body registrati per URL, 404 per gli altri."""
+
+    def __init__(self, risposte):
+        self.headers = {}
+        self.risposte = risposte
+
+    def get(self, url, params=None, headers=None, timeout=None, verify=None):
+        body = self.risposte.get(url)
+        return RispostaRegistrata(body, 200) if body is not None else RispostaRegistrata(b"", 404)
+
+
+# --- Misura per stadio ---
+class Cronometro:
+    """
+    Tempo esclusivo e (con tracemalloc attivo) picco di memoria inclusivo per stadio.
+    Gli stadi possono annidarsi: il tempo di uno stadio interno è sottratto da quello esterno.
+    """
+
+    def __init__(self, memoria=False):
+        self.memoria = memoria
+        self.tempi = defaultdict(float)
+        self.picchi = defaultdict(int)
+        self._pila = [] # [nome, inizio, tempo figli, memoria iniziale, picco]
+
+    @contextlib.contextmanager
+    def stadio(self, nome):
+        if self.memoria:
+            corrente, picco = tracemalloc.get_traced_memory()
+            if self._pila:
+                self._pila[-1][4] = max(self._pila[-1][4], picco)
+            tracemalloc.reset_peak()
+        else:
+            corrente = 0
+        voce = [nome, time.perf_counter(), 0.0, corrente, corrente]
+        self._pila.append(voce)
+        try:
+            yield
+        finally:
+            durata = time.perf_counter() - voce[1]
+            self._pila.pop()
+            self.tempi[nome] += durata - voce[2]
+            if self._pila:
+                self._pila[-1][2] += durata
+            if self.memoria:
+                picco = max(voce[4], tracemalloc.get_traced_memory()[1])
+                self.picchi[nome] = max(self.picchi[nome], picco - voce[3])
+                if self._pila:
+                    self._pila[-1][4] = max(self._pila[-1][4], picco)
+                tracemalloc.reset_peak()
+
+    def avvolgi(self, nome, funzione):
+        @functools.wraps(funzione)
+        def avvolta(*args, **kwargs):
+            with self.stadio(nome):
+                return funzione(*args, **kwargs)
+        return avvolta
+
+
+@contextlib.contextmanager
+def strumenta(cronometro, bersagli):
+    """Sostituisce temporaneamente le funzioni (oggetto, attributo, stadio) con versioni cronometrate."""
+    originali = [(oggetto, attributo, getattr(oggetto, attributo)) for oggetto, attributo, _ in bersagli]
+    try:
+        for (oggetto, attributo, stadio), (_, _, funzione) in zip(bersagli, originali):
+            setattr(oggetto, attributo, cronometro.avvolgi(stadio, funzione))
+        yield
+    finally:
+        for oggetto, attributo, funzione in originali:
+            setattr(oggetto, attributo, funzione)
+
+
+def installa_fetcher(risposte):
+    """Fetcher condiviso (conditional_fetch + snapshot_cache senza TTL) che risponde dalle fixture."""
+    fetcher = conditional_fetch.FetchCondizionale(session=SessioneRegistrata(risposte),
+                                                  percorso_stato=os.environ["FETCH_STATO_PATH"])
+    conditional_fetch._fetcher = fetcher
+    snapshot_cache._cache = snapshot_cache.CacheSnapshot(fetcher, ttl=0)
+    return fetcher
+
+
+def carica_fixture(nome):
+    with open(os.path.join(CARTELLA_FIXTURE, FIXTURE[nome]), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _copia(record, **campi):
+    copia = dict(record)
+    copia.update(campi)
+    return copia
+
+
+# --- Scenari ---
+class ScenarioStazioni:
+    """Payload rt-data scalato e configurazione stazioni corrispondente, per un modo di station_engine."""
+
+    def __init__(self, modo, scala):
+        self.modo = modo
+        originale = carica_fixture("rt-data")
+        bacini = dict(station_engine.BACINI_STAZIONI)
+        codici_fissi = dict(station_engine.CODICI_STAZIONI)
+        self.records = [dict(record) for record in originale]
+        for copia in range(1, scala):
+            suffisso = f" #{copia}"
+            for record in originale:
+                nome = record["nome"].strip()
+                self.records.append(_copia(record, codice=record["codice"] + copia * OFFSET_CODICE, nome=nome + suffisso))
+            for nome, bacino in station_engine.BACINI_STAZIONI.items():
+                bacini[nome + suffisso] = bacino
+            for nome, codice in station_engine.CODICI_STAZIONI.items():
+                codici_fissi[nome + suffisso] = codice + copia * OFFSET_CODICE
+        self.registro = station_registry.RegistroStazioni(bacini, codici_fissi)
+        self.stazioni_interessate = list(bacini)
+
+    def __len__(self):
+        return len(self.records)
+
+    def prepara(self, ripetizione):
+        """Body della ripetizione: ogni ciclo ha un lastUpdateTime nuovo, come un payload reale successivo."""
+        orario = (ORARIO_BASE + timedelta(minutes=10 * ripetizione)).strftime(FORMATO_ORARIO)
+        for record in self.records:
+            record["lastUpdateTime"] = orario
+        return {station_engine.URL_STAZIONI: json.dumps(self.records).encode()}
+
+    @contextlib.contextmanager
+    def configurazione(self):
+        """Registro, stazioni di interesse e stato persistente nuovi per lo scenario."""
+        cartella = tempfile.mkdtemp(dir=CARTELLA_TEMP)
+        originali = (station_engine.REGISTRO_STAZIONI, station_engine.STAZIONI_INTERESSATE)
+        station_engine.REGISTRO_STAZIONI, station_engine.STAZIONI_INTERESSATE = self.registro, self.stazioni_interessate
+        station_engine._stato_soglie = threshold_state.StatoSoglie(os.path.join(cartella, "stato.sqlite3"))
+        station_engine._registro_aggiornamenti = station_updates.RegistroAggiornamenti(os.path.join(cartella, "stato.sqlite3"))
+        readings_archive._archivio = readings_archive.ArchivioLetture(os.path.join(cartella, "archivio"))
+        rate_of_rise._motore = None
+        station_engine._ultimi_report.clear()
+        try:
+            yield
+        finally:
+            station_engine.REGISTRO_STAZIONI, station_engine.STAZIONI_INTERESSATE = originali
+            station_engine._stato_soglie.close()
+            station_engine._registro_aggiornamenti.close()
+            station_engine._stato_soglie = station_engine._registro_aggiornamenti = None
+
+    def bersagli(self):
+        return [
+            (conditional_fetch.FetchCondizionale, "scarica", "fetch"),
+            (conditional_fetch.FetchCondizionale, "decodifica_filtrata", "decodifica"),
+            (station_engine, "filtra_stazioni", "filtro"),
+            (readings_archive, "archivia_stazioni", "archivio"),
+            (station_engine, "controlla_velocita_crescita", "valutazione"),
+            (snapshot_eval, "costruisci_snapshot", "valutazione"),
+            (station_engine, "valuta_transizioni", "valutazione"),
+            (station_engine, "controlla_stazioni_ferme", "valutazione"),
+            (station_engine, "componi_report", "valutazione"),
+        ]
+
+    def esegui(self, risposte, cronometro):
+        installa_fetcher(risposte)
+        risultato = station_engine.esegui([self.modo])[self.modo]
+        with cronometro.stadio("render"):
+            if self.modo == station_engine.MODO_ALLERTE:
+                station_checker.componi_messaggio_soglie(risultato[0])
+            else:
+                soglie, valori, errore_fetch, obsoleto_da = risultato
+                report = renderers.report_stazioni(soglie, valori, errore_fetch, station_engine.ORDINE_BACINI, obsoleto_da=obsoleto_da)
+                for renderer in (renderers.MARKDOWN, renderers.JSON, renderers.HTML):
+                    renderer.stazioni(report)
+
+
+class ScenarioAllerte:
+    """Bollettino allerte di domani con le aree replicate (alert_checker)."""
+
+    def __init__(self, scala):
+        originale = carica_fixture("allerta-domani")
+        self.records = [_copia(voce, area=voce["area"] if not copia else f"{voce['area']}.{copia}")
+                        for copia in range(scala) for voce in originale]
+        self.aree = [voce["area"] for voce in self.records]
+
+    def __len__(self):
+        return len(self.records)
+
+    def prepara(self, ripetizione):
+        return {alert_checker.URL_ALLERTA_DOMANI: json.dumps(self.records).encode()}
+
+    @contextlib.contextmanager
+    def configurazione(self):
+        yield
+
+    def bersagli(self):
+        return [
+            (conditional_fetch.FetchCondizionale, "scarica", "fetch"),
+            (conditional_fetch.FetchCondizionale, "decodifica", "decodifica"),
+            (alert_checker, "valuta_allerte_domani", "valutazione"),
+        ]
+
+    def esegui(self, risposte, cronometro):
+        installa_fetcher(risposte)
+        alert_checker._ultime_allerte_per_area = None
+        allerte_per_area, errore_fetch, obsoleto_da = alert_checker.valuta_allerte_domani()
+        with cronometro.stadio("render"):
+            report = renderers.report_allerte(allerte_per_area, errore_fetch, self.aree, obsoleto_da=obsoleto_da)
+            for renderer in (renderers.MARKDOWN, renderers.JSON, renderers.HTML):
+                renderer.allerte(report, self.aree)
+
+
+class ScenarioWeatherlink:
+    """Stazioni WeatherLink replicate, ognuna con il proprio /current (weather_alert)."""
+
+    def __init__(self, scala):
+        correnti = carica_fixture("weatherlink-current")
+        self.stazioni = []
+        self.risposte = {}
+        for copia in range(scala):
+            for indice, info in enumerate(weather_alert.STATIONS_INFO):
+                id_stazione = f"{info['id']}-{copia}" if copia else info["id"]
+                nome = f"{info['name']} #{copia}" if copia else info["name"]
+                self.stazioni.append({"id": id_stazione, "name": nome})
+                corrente = correnti[indice % len(correnti)]
+                self.risposte[f"{weather_alert.API_BASE_URL}/current/{id_stazione}"] = json.dumps(corrente).encode()
+
+    def __len__(self):
+        return len(self.stazioni)
+
+    def prepara(self, ripetizione):
+        return self.risposte
+
+    @contextlib.contextmanager
+    def configurazione(self):
+        originali = (weather_alert.SESSION, weather_alert.API_KEY, weather_alert.API_SECRET)
+        weather_alert.API_KEY = weather_alert.API_SECRET = "benchmark"
+        try:
+            with open(os.devnull, "w") as nulla, contextlib.redirect_stdout(nulla):
+                yield
+        finally:
+            weather_alert.SESSION, weather_alert.API_KEY, weather_alert.API_SECRET = originali
+
+    def bersagli(self):
+        return []
+
+    def esegui(self, risposte, cronometro):
+        weather_alert.SESSION = SessioneRegistrata(risposte)
+        with cronometro.stadio("fetch"):
+            risultati = weather_alert.fetch_all_current_data(self.stazioni)
+        with cronometro.stadio("valutazione"):
+            alert_per_stazione = {info["name"]: weather_alert.check_station_thresholds(info["name"], dati)
+                                  for info, dati in risultati if dati}
+        with cronometro.stadio("render"):
+            weather_alert.compose_alerts_message([alert for alerts in alert_per_stazione.values() for alert in alerts])
+
+
+PIPELINE = {
+    "stazioni-allerte": lambda scala: ScenarioStazioni(station_engine.MODO_ALLERTE, scala),
+    "stazioni-report": lambda scala: ScenarioStazioni(station_engine.MODO_COMPLETO, scala),
+    "allerte-domani": ScenarioAllerte,
+    "weatherlink": ScenarioWeatherlink,
+}
+
+
+def misura(scenario, ripetizioni):
+    """
+    Esegue lo scenario e restituisce {"record", "totale_ms", "totale_min_ms", "record_s", "picco_kb",
+    "stadi": {stadio: {"ms", "min_ms", "picco_kb"}}}: mediana e minimo sulle ripetizioni.
+    """
+    tempi_stadi = defaultdict(list)
+    totali = []
+    with scenario.configurazione():
+        # Riscaldamento: associazione codici, indice soglie, prime transizioni
+        scenario.esegui(scenario.prepara(0), Cronometro())
+        for ripetizione in range(1, ripetizioni + 1):
+            risposte = scenario.prepara(ripetizione)
+            cronometro = Cronometro()
+            with strumenta(cronometro, scenario.bersagli()):
+                inizio = time.perf_counter()
+                scenario.esegui(risposte, cronometro)
+                totali.append(time.perf_counter() - inizio)
+            for stadio, durata in cronometro.tempi.items():
+                tempi_stadi[stadio].append(durata)
+            tempi_stadi["altro"].append(totali[-1] - sum(cronometro.tempi.values()))
+
+        # Allocazioni in un passaggio a parte: tracemalloc rallenta ogni allocazione
+        risposte = scenario.prepara(ripetizioni + 1)
+        cronometro = Cronometro(memoria=True)
+        tracemalloc.start()
+        try:
+            with strumenta(cronometro, scenario.bersagli()):
+                with cronometro.stadio("totale"):
+                    scenario.esegui(risposte, cronometro)
+        finally:
+            tracemalloc.stop()
+
+    totale = statistics.median(totali)
+    return {
+        "record": len(scenario),
+        "totale_ms": round(totale * 1000, 3),
+        "totale_min_ms": round(min(totali) * 1000, 3),
+        "record_s": round(len(scenario) / totale) if totale else None,
+        "picco_kb": round(cronometro.picchi["totale"] / 1024),
+        "stadi": {stadio: {"ms": round(statistics.median(durate) * 1000, 3),
+                           "min_ms": round(min(durate) * 1000, 3),
+                           "picco_kb": round(cronometro.picchi.get(stadio, 0) / 1024)}
+                  for stadio, durate in tempi_stadi.items()},
+    }
+
+
+def stampa(chiave, esito):
+    print(f"{chiave}: {esito['record']} record, totale {esito['totale_ms']:.2f} ms (min {esito['totale_min_ms']:.2f}), "
+          f"{esito['record_s']} record/s, picco {esito['picco_kb']} KB")
+    for stadio, valori in esito["stadi"].items():
+        print(f"    {stadio:<12} {valori['ms']:>10.3f} ms (min {valori['min_ms']:>10.3f})   picco {valori['picco_kb']:>8} KB")
+
+
+def confronta(risultati, baseline, tolleranza):
+    """
+    Regressioni rispetto alla baseline: tempi e picchi oltre la tolleranza relativa e la soglia di rumore.
+    Per i tempi si confronta il minimo delle ripetizioni, molto meno sensibile della mediana al carico della macchina.
+    """
+    regressioni = []
+
+    def controlla(chiave, misura_nome, nuovo, vecchio, rumore):
+        if vecchio is not None and nuovo > vecchio * (1 + tolleranza) and nuovo - vecchio > rumore:
+            regressioni.append(f"{chiave} {misura_nome}: {vecchio} -> {nuovo} (+{(nuovo / vecchio - 1) * 100 if vecchio else float('inf'):.0f}%)")
+
+    for chiave, esito in risultati.items():
+        precedente = baseline.get(chiave)
+        if precedente is None:
+            logging.warning(f"[Benchmark] {chiave} assente nella baseline, non confrontato")
+            continue
+        controlla(chiave, "totale ms", esito["totale_min_ms"], precedente.get("totale_min_ms"), RUMORE_MS)
+        controlla(chiave, "picco KB", esito["picco_kb"], precedente.get("picco_kb"), RUMORE_KB)
+        for stadio, valori in esito["stadi"].items():
+            vecchi = precedente.get("stadi", {}).get(stadio, {})
+            controlla(chiave, f"{stadio} ms", valori["min_ms"], vecchi.get("min_ms"), RUMORE_MS)
+            controlla(chiave, f"{stadio} picco KB", valori["picco_kb"], vecchi.get("picco_kb"), RUMORE_KB)
+    return regressioni
+
+
+def registra_fixture():
+    """Scarica i payload reali nelle fixture (l'unica operazione che usa la rete)."""
+    sorgenti = {"rt-data": station_engine.URL_STAZIONI, "allerta-domani": alert_checker.URL_ALLERTA_DOMANI}
+    for nome, url in sorgenti.items():
+        try:
+            response = requests.get(url, timeout=45, verify=False, headers={"User-Agent": conditional_fetch.USER_AGENT})
+            response.raise_for_status()
+            dati = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error(f"[Benchmark] Registrazione {nome} da {url} fallita: {e}")
+            continue
+        _scrivi_fixture(nome, dati)
+
+    if not weather_alert.API_KEY or not weather_alert.API_SECRET:
+        logging.warning("[Benchmark] WEATHERLINK_API_KEY/SECRET mancanti, fixture WeatherLink non aggiornata")
+        return
+    correnti = [dati for _, dati in weather_alert.fetch_all_current_data(weather_alert.STATIONS_INFO) if dati]
+    if correnti:
+        _scrivi_fixture("weatherlink-current", correnti)
+
+
+def _scrivi_fixture(nome, dati):
+    percorso = os.path.join(CARTELLA_FIXTURE, FIXTURE[nome])
+    with open(percorso, "w", encoding="utf-8") as f:
+        json.dump(dati, f, ensure_ascii=False, indent=1)
+    logging.info(f"[Benchmark] Fixture {nome} registrata in {percorso}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark offline delle pipeline stazioni, allerte e WeatherLink.")
+    parser.add_argument("--scale", default=",".join(map(str, SCALE_DEFAULT)), help="fattori di scala separati da virgola")
+    parser.add_argument("--ripetizioni", type=int, default=RIPETIZIONI_DEFAULT)
+    parser.add_argument("--pipeline", nargs="+", choices=list(PIPELINE), default=list(PIPELINE))
+    parser.add_argument("--salva-baseline", action="store_true", help=f"salva i risultati in {PERCORSO_BASELINE}")
+    parser.add_argument("--confronta", action="store_true", help="confronta con la baseline, exit 1 se peggiora")
+    parser.add_argument("--tolleranza", type=float, default=TOLLERANZA_DEFAULT, help="peggioramento relativo ammesso")
+    parser.add_argument("--registra", action="store_true", help="aggiorna le fixture dagli endpoint reali ed esce")
+    argomenti = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO if argomenti.registra else logging.ERROR)
+    if argomenti.registra:
+        registra_fixture()
+        exit(0)
+
+    try:
+        scale = [int(scala) for scala in argomenti.scale.split(",") if scala.strip()]
+    except ValueError:
+        logging.critical(f"[Benchmark] Scale non valide: {argomenti.scale}"); exit(1)
+    if not scale or min(scale) < 1 or argomenti.ripetizioni < 1:
+        logging.critical("[Benchmark] Servono scale >= 1 e almeno una ripetizione"); exit(1)
+
+    risultati = {}
+    for nome in argomenti.pipeline:
+        for scala in scale:
+            chiave = f"{nome} x{scala}"
+            risultati[chiave] = misura(PIPELINE[nome](scala), argomenti.ripetizioni)
+            stampa(chiave, risultati[chiave])
+
+    if argomenti.salva_baseline:
+        with open(PERCORSO_BASELINE, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "macchina": platform.platform(),
+                       "data": datetime.now().isoformat(timespec="seconds"), "risultati": risultati}, f, indent=1)
+        print(f"Baseline salvata in {PERCORSO_BASELINE}")
+
+    if argomenti.confronta:
+        try:
+            with open(PERCORSO_BASELINE, encoding="utf-8") as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.critical(f"[Benchmark] Baseline {PERCORSO_BASELINE} non leggibile ({e}): generarla con --salva-baseline"); exit(1)
+        regressioni = confronta(risultati, baseline.get("risultati", {}), argomenti.tolleranza)
+        if regressioni:
+            print(f"Regressioni rispetto alla baseline del {baseline.get('data')} (tolleranza {argomenti.tolleranza:.0%}):")
+            for regressione in regressioni:
+                print(f"    {regressione}")
+            exit(1)
+        print(f"Nessuna regressione rispetto alla baseline del {baseline.get('data')}")
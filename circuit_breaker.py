@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Circuit breaker per servizio esterno, con timeout adattivi e richieste hedged.
+
+Ogni host (RETEMIR, allertameteo, WeatherLink) ha un proprio Circuito:
+  - timeout adattivo: con almeno CAMPIONI_MIN risposte riuscite il timeout
+    della richiesta è il p99 delle latenze recenti per CIRCUITO_MOLTIPLICATORE
+    (default 4), tra CIRCUITO_TIMEOUT_MIN (default 5s) e il timeout fisso del
+    chiamante, che resta il valore usato finché non ci sono dati;
+  - hedging: se la risposta non arriva entro il p95 delle latenze (o entro
+    CIRCUITO_RITARDO_HEDGE secondi, default 10, senza storico) parte una
+    seconda richiesta identica e vince la prima che risponde (solo GET
+    idempotenti; CIRCUITO_HEDGE=0 disabilita). Le due richieste girano in
+    thread propri, non in un pool condiviso: con molti chiamanti concorrenti
+    (weather_alert) nessuna attende in coda e le latenze misurano solo l'HTTP;
+  - circuito aperto: dopo CIRCUITO_SOGLIA_ERRORI errori consecutivi (default 3:
+    errori di rete, timeout, HTTP 5xx o 429) le richieste falliscono subito con
+    CircuitoAperto per CIRCUITO_PAUSA secondi (default 60); poi una sola
+    richiesta di prova decide se richiudere o riaprire il circuito.
+CircuitoAperto è una requests.exceptions.ConnectionError, quindi i chiamanti
+la gestiscono come gli altri errori di rete (snapshot_cache serve l'ultima
+copia valida, marcata obsoleta).
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, FIRST_COMPLETED, TimeoutError as FutureTimeoutError, wait
+
+import requests
+
+import metrics
+
+SOGLIA_ERRORI = int(os.environ.get("CIRCUITO_SOGLIA_ERRORI", "3"))
+PAUSA = float(os.environ.get("CIRCUITO_PAUSA", "60"))
+TIMEOUT_MIN = float(os.environ.get("CIRCUITO_TIMEOUT_MIN", "5"))
+MOLTIPLICATORE_TIMEOUT = float(os.environ.get("CIRCUITO_MOLTIPLICATORE", "4"))
+HEDGE = os.environ.get("CIRCUITO_HEDGE", "1") != "0"
+RITARDO_HEDGE = float(os.environ.get("CIRCUITO_RITARDO_HEDGE", "10"))
+RITARDO_HEDGE_MIN = 0.2 # sotto questa soglia una seconda richiesta costa più di quanto fa risparmiare
+CAMPIONI = 100 # latenze riuscite conservate per circuito
+CAMPIONI_MIN = 5
+
+CHIUSO = "chiuso"
+APERTO = "aperto"
+SEMIAPERTO = "semiaperto"
+VALORI_STATO = {CHIUSO: 0, SEMIAPERTO: 1, APERTO: 2} # valore della metrica meteo_circuito_stato
+
+
+class CircuitoAperto(requests.exceptions.ConnectionError):
+    """Richiesta rifiutata senza contattare il servizio: il circuito è aperto."""
+
+
+def _risposta_fallita(response):
+    """Risposte che contano come errore del servizio: 5xx e 429 (i 4xx sono errori del chiamante)."""
+    return response.status_code >= 500 or response.status_code == 429
+
+
+def _percentile(valori, quota):
+    ordinati = sorted(valori)
+    return ordinati[min(len(ordinati) - 1, int(quota * len(ordinati)))]
+
+
+def _chiudi_perdente(futuro):
+    # La risposta della richiesta che ha perso l'hedging libera subito la connessione
+    if futuro.exception() is None:
+        futuro.result()[0].close()
+
+
+def _misurata(richiesta, timeout):
+    """(response, secondi) della sola richiesta HTTP."""
+    inizio = time.monotonic()
+    response = richiesta(timeout)
+    return response, time.monotonic() - inizio
+
+
+def _avvia(richiesta, timeout):
+    """Avvia _misurata() in un thread dedicato, che parte subito, e ne restituisce il Future."""
+    futuro = Future()
+    futuro.set_running_or_notify_cancel()
+
+    def esegui():
+        try:
+            futuro.set_result(_misurata(richiesta, timeout))
+        except BaseException as e:
+            futuro.set_exception(e)
+
+    threading.Thread(target=esegui, name="circuito-hedge", daemon=True).start()
+    return futuro
+
+
+class Circuito:
+    """Stato (chiuso/aperto/semiaperto), errori consecutivi e latenze recenti di un servizio."""
+
+    def __init__(self, nome, soglia_errori=SOGLIA_ERRORI, pausa=PAUSA):
+        self.nome = nome
+        self.soglia_errori = soglia_errori
+        self.pausa = pausa
+        self._lock = threading.Lock()
+        self.stato = CHIUSO
+        self.errori_consecutivi = 0
+        self._aperto_fino = 0.0
+        self._sonda_in_corso = False
+        self._latenze = deque(maxlen=CAMPIONI)
+        metrics.imposta("meteo_circuito_stato", VALORI_STATO[CHIUSO], circuito=nome)
+
+    def timeout(self, timeout_massimo):
+        """Timeout della prossima richiesta: p99 delle latenze × moltiplicatore, entro [TIMEOUT_MIN, timeout_massimo]."""
+        with self._lock:
+            latenze = list(self._latenze)
+        if len(latenze) < CAMPIONI_MIN:
+            return timeout_massimo
+        return min(timeout_massimo, max(TIMEOUT_MIN, _percentile(latenze, 0.99) * MOLTIPLICATORE_TIMEOUT))
+
+    def ritardo_hedge(self, timeout):
+        """Attesa prima della richiesta di riserva (p95 delle latenze), None se l'hedging non si applica."""
+        with self._lock:
+            latenze = list(self._latenze)
+            stato = self.stato
+        if not HEDGE or stato != CHIUSO:
+            return None
+        ritardo = _percentile(latenze, 0.95) if len(latenze) >= CAMPIONI_MIN else RITARDO_HEDGE
+        ritardo = max(RITARDO_HEDGE_MIN, ritardo)
+        return ritardo if ritardo < timeout else None
+
+    def _ammetti(self):
+        with self._lock:
+            if self.stato == CHIUSO:
+                return
+            if self.stato == APERTO and time.monotonic() >= self._aperto_fino:
+                self._cambia_stato(SEMIAPERTO)
+            if self.stato == SEMIAPERTO and not self._sonda_in_corso:
+                self._sonda_in_corso = True
+                logging.info(f"[Circuito] {self.nome}: richiesta di prova")
+                return
+            attesa = max(0.0, self._aperto_fino - time.monotonic())
+        metrics.incrementa("meteo_circuito_rifiutate_totale", circuito=self.nome)
+        raise CircuitoAperto(f"Circuito {self.nome} aperto, nuovo tentativo tra {attesa:.0f}s")
+
+    def _cambia_stato(self, stato):
+        # Chiamata con self._lock acquisito
+        if stato != self.stato:
+            logging.warning(f"[Circuito] {self.nome}: {self.stato} -> {stato}")
+            self.stato = stato
+            metrics.imposta("meteo_circuito_stato", VALORI_STATO[stato], circuito=self.nome)
+
+    def registra_successo(self, secondi):
+        with self._lock:
+            self._latenze.append(secondi)
+            self.errori_consecutivi = 0
+            self._sonda_in_corso = False
+            self._cambia_stato(CHIUSO)
+
+    def registra_errore(self):
+        with self._lock:
+            self.errori_consecutivi += 1
+            self._sonda_in_corso = False
+            if self.stato == SEMIAPERTO or self.errori_consecutivi >= self.soglia_errori:
+                self._aperto_fino = time.monotonic() + self.pausa
+                self._cambia_stato(APERTO)
+
+    def esegui(self, richiesta, timeout_massimo):
+        """
+        Esegue richiesta(timeout) -> requests.Response con timeout adattivo ed eventuale hedging.
+        Solleva CircuitoAperto se il circuito è aperto; le eccezioni di requests sono propagate.
+        """
+        self._ammetti()
+        timeout = self.timeout(timeout_massimo)
+        try:
+            response, secondi = self._con_hedge(richiesta, timeout)
+        except requests.exceptions.RequestException:
+            self.registra_errore()
+            raise
+        except BaseException:
+            # Errore del chiamante, non del servizio: libera solo la richiesta di prova
+            with self._lock:
+                self._sonda_in_corso = False
+            raise
+        if _risposta_fallita(response):
+            self.registra_errore()
+        else:
+            self.registra_successo(secondi)
+        return response
+
+    def _con_hedge(self, richiesta, timeout):
+        """(response, secondi della richiesta vincente): senza hedging la richiesta gira nel thread chiamante."""
+        ritardo = self.ritardo_hedge(timeout)
+        if ritardo is None:
+            return _misurata(richiesta, timeout)
+        primaria = _avvia(richiesta, timeout)
+        try:
+            return primaria.result(timeout=ritardo)
+        except FutureTimeoutError:
+            pass
+
+        logging.info(f"[Circuito] {self.nome}: nessuna risposta dopo {ritardo:.2f}s, richiesta di riserva")
+        riserva = _avvia(richiesta, timeout)
+        nomi = {primaria: "primaria", riserva: "riserva"}
+        in_corso = {primaria, riserva}
+        errore = None
+        while in_corso:
+            completate, in_corso = wait(in_corso, return_when=FIRST_COMPLETED)
+            for futuro in completate:
+                if futuro.exception() is None:
+                    metrics.incrementa("meteo_hedge_totale", circuito=self.nome, vincitore=nomi[futuro])
+                    for perdente in in_corso:
+                        perdente.add_done_callback(_chiudi_perdente)
+                    return futuro.result()
+                errore = futuro.exception()
+        metrics.incrementa("meteo_hedge_totale", circuito=self.nome, vincitore="nessuno")
+        raise errore
+
+
+# Circuiti condivisi dagli script caricati nello stesso processo
+_circuiti = {}
+_lock_circuiti = threading.Lock()
+
+
+def circuito(nome):
+    """Circuito del servizio `nome` (di norma l'host dell'URL), creato al primo uso."""
+    with _lock_circuiti:
+        if nome not in _circuiti:
+            _circuiti[nome] = Circuito(nome)
+        return _circuiti[nome]
+
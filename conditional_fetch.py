@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Fetch HTTP condizionale con ETag/Last-Modified e confronto dell'hash del payload.
+
+Ogni risposta viene identificata da una "versione" (hash BLAKE2 del body).
+I validatori dell'ultima risposta di ogni URL (ETag, Last-Modified e la
+versione a cui si riferiscono) rendono condizionale la richiesta successiva
+(If-None-Match / If-Modified-Since): un 304 non scarica nulla. Se il server
+non supporta i validatori, il body viene comunque confrontato per hash prima
+di decodificarlo.
+
+Ogni consumatore (script) registra con conferma() l'ultima versione che ha
+elaborato; il risultato successivo è `invariato` se la versione coincide, così
+il chiamante può saltare del tutto decodifica JSON e valutazione. Le versioni
+confermate e i validatori sono salvati su disco (FETCH_STATO_PATH) e valgono
+anche tra esecuzioni one-shot: dopo un riavvio un payload invariato costa un
+304. Se dopo un 304 serve comunque il body (consumatore che non ha elaborato
+quella versione, nessuna copia in memoria) il payload viene riscaricato senza
+condizioni. La decodifica JSON avviene solo all'accesso a `.dati`,
+oppure con dati_filtrati() per i payload array di cui serve solo una parte
+(decodifica in streaming, stream_decode).
+
+Le richieste passano dal circuito dell'host (circuit_breaker): il timeout
+indicato è il massimo, quello effettivo si adatta alle latenze osservate.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+
+import circuit_breaker
+import metrics
+import stream_decode
+
+PERCORSO_STATO = os.environ.get("FETCH_STATO_PATH",
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), "stato_fetch.json"))
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+
+def calcola_versione(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class RisultatoFetch:
+    """Esito di un fetch: versione del payload, flag `invariato` per il consumatore e dati decodificati su richiesta."""
+
+    def __init__(self, fetcher, url, consumatore, versione, invariato, body=None, obsoleto_da=None):
+        self.fetcher = fetcher
+        self.url = url
+        self.consumatore = consumatore
+        self.versione = versione
+        self.invariato = invariato
+        self.body = body
+        self.obsoleto_da = obsoleto_da # secondi dall'ultimo download riuscito se il servizio non risponde, None se fresco
+
+    @property
+    def obsoleto(self):
+        return self.obsoleto_da is not None
+
+    @property
+    def dati(self):
+        """Payload JSON decodificato (riusato dalla memoria se la versione è già stata decodificata), None se non valido."""
+        return self.fetcher.decodifica(self)
+
+    def dati_filtrati(self, tieni):
+        """Payload array decodificato tenendo solo i record per cui tieni(record) è vero (vedi stream_decode)."""
+        return self.fetcher.decodifica_filtrata(self, tieni)
+
+
+class FetchCondizionale:
+    """Client condiviso: validatori HTTP e ultimo payload decodificato per URL, versioni elaborate per consumatore."""
+
+    def __init__(self, session=None, percorso_stato=PERCORSO_STATO):
+        self.session = session or requests.Session()
+        self.session.headers.setdefault('User-Agent', USER_AGENT)
+        self.percorso_stato = percorso_stato
+        self._lock = threading.Lock()
+        self._decodificati = {} # url -> (versione, dati)
+        self._filtrati = {} # url -> (versione, record tenuti da decodifica_filtrata)
+        self._richieste = {} # url -> argomenti (timeout, verify, headers) dell'ultimo scarica(), per riscaricare dopo un 304
+        stato = self._carica_stato()
+        self._versioni_consumatori = stato["versioni"] # "consumatore url" -> versione elaborata
+        self._validatori = stato["validatori"] # url -> {"versione", "etag", "last_modified"}
+
+    def _carica_stato(self):
+        """{"versioni": {...}, "validatori": {...}} dal file; il formato precedente (solo versioni) viene convertito."""
+        try:
+            with open(self.percorso_stato, encoding="utf-8") as f:
+                stato = json.load(f)
+        except FileNotFoundError:
+            stato = {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"[Fetch] Stato fetch non leggibile ({self.percorso_stato}), ignorato: {e}")
+            stato = {}
+        if not isinstance(stato, dict):
+            logging.warning(f"[Fetch] Stato fetch non valido ({self.percorso_stato}), ignorato")
+            stato = {}
+        if "versioni" not in stato and "validatori" not in stato:
+            stato = {"versioni": stato}
+        versioni = stato.get("versioni")
+        validatori = stato.get("validatori")
+        return {
+            "versioni": versioni if isinstance(versioni, dict) else {},
+            "validatori": {url: voce for url, voce in validatori.items() if isinstance(voce, dict) and voce.get("versione")}
+                          if isinstance(validatori, dict) else {},
+        }
+
+    def _salva_stato(self):
+        temporaneo = self.percorso_stato + ".tmp"
+        try:
+            with open(temporaneo, "w", encoding="utf-8") as f:
+                json.dump({"versioni": self._versioni_consumatori, "validatori": self._validatori}, f)
+            os.replace(temporaneo, self.percorso_stato)
+        except OSError as e:
+            logging.warning(f"[Fetch] Impossibile salvare lo stato fetch in {self.percorso_stato}: {e}")
+
+    def get(self, url, consumatore, timeout=45, verify=False, headers=None):
+        """
+        Esegue il GET (condizionale se possibile) e restituisce un RisultatoFetch.
+        Le eccezioni di requests (timeout, HTTPError, ...) sono propagate al chiamante.
+        """
+        versione, body = self.scarica(url, timeout=timeout, verify=verify, headers=headers)
+        return self.risultato(url, consumatore, versione, body)
+
+    def scarica(self, url, timeout=45, verify=False, headers=None, condizionale=True):
+        """
+        GET condizionale: restituisce (versione, body), con body None se il server risponde 304.
+        `timeout` è il massimo: il circuito dell'host lo riduce in base alle latenze osservate.
+        """
+        self._richieste[url] = {"timeout": timeout, "verify": verify, "headers": headers}
+        richiesta_headers = dict(headers or {})
+        validatori = self._validatori.get(url) if condizionale else None
+        if validatori:
+            if validatori.get("etag"):
+                richiesta_headers["If-None-Match"] = validatori["etag"]
+            if validatori.get("last_modified"):
+                richiesta_headers["If-Modified-Since"] = validatori["last_modified"]
+
+        host = urlsplit(url).netloc
+        try:
+            with metrics.misura("meteo_fetch_secondi", host=host):
+                response = circuit_breaker.circuito(host).esegui(
+                    lambda timeout_richiesta: self.session.get(url, headers=richiesta_headers, timeout=timeout_richiesta, verify=verify),
+                    timeout)
+        except requests.exceptions.RequestException as e:
+            metrics.incrementa("meteo_fetch_risposte_totale", host=host, stato=type(e).__name__)
+            raise
+        metrics.incrementa("meteo_fetch_risposte_totale", host=host, stato=str(response.status_code))
+        if response.status_code == 304 and validatori:
+            logging.info(f"[Fetch] {url} non modificato (304)")
+            return validatori["versione"], None
+        response.raise_for_status()
+        body = response.content
+        metrics.incrementa("meteo_fetch_byte_totale", len(body), host=host)
+        versione = calcola_versione(body)
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        # Senza validatori HTTP non c'è richiesta condizionale possibile: resta il solo confronto per hash
+        nuovi_validatori = {"versione": versione, "etag": etag, "last_modified": last_modified} if etag or last_modified else None
+        with self._lock:
+            if self._validatori.get(url) != nuovi_validatori:
+                if nuovi_validatori is None:
+                    del self._validatori[url]
+                else:
+                    self._validatori[url] = nuovi_validatori
+                self._salva_stato()
+        return versione, body
+
+    def _body(self, risultato):
+        """
+        Body del risultato. Dopo un 304 senza copia in memoria (validatori letti dal disco) il payload
+        viene riscaricato senza condizioni e il risultato aggiornato; None se il download fallisce.
+        """
+        if risultato.body is None:
+            logging.info(f"[Fetch] {risultato.url} non modificato ma non in memoria: nuovo download completo")
+            try:
+                risultato.versione, risultato.body = self.scarica(risultato.url, condizionale=False,
+                                                                  **self._richieste.get(risultato.url, {}))
+            except requests.exceptions.RequestException as e:
+                logging.error(f"[Fetch] Nessun body disponibile per decodificare {risultato.url}: {e}")
+        return risultato.body
+
+    def risultato(self, url, consumatore, versione, body=None, obsoleto_da=None):
+        """Costruisce il RisultatoFetch per un consumatore, confrontando la versione con l'ultima che ha elaborato."""
+        invariato = self._versioni_consumatori.get(f"{consumatore} {url}") == versione
+        if invariato:
+            logging.info(f"[Fetch] Payload di {url} invariato per '{consumatore}' (versione {versione[:8]})")
+        return RisultatoFetch(self, url, consumatore, versione, invariato, body, obsoleto_da)
+
+    def decodifica(self, risultato):
+        with self._lock:
+            cache = self._decodificati.get(risultato.url)
+            if cache and cache[0] == risultato.versione:
+                return cache[1]
+        if self._body(risultato) is None:
+            return None
+        try:
+            with metrics.misura("meteo_decodifica_secondi", host=urlsplit(risultato.url).netloc):
+                dati = json.loads(risultato.body)
+        except ValueError as e:
+            logging.error(f"[Fetch] Errore JSON da {risultato.url}: Resp '{risultato.body[:200]!r}...', Err: {e}")
+            return None
+        with self._lock:
+            self._decodificati[risultato.url] = (risultato.versione, dati)
+        return dati
+
+    def decodifica_filtrata(self, risultato, tieni):
+        """
+        Come decodifica() per un payload array, ma i record scartati da `tieni` non vengono costruiti.
+        Il risultato è riusato per la stessa versione: `tieni` deve essere lo stesso filtro per ogni URL.
+        """
+        with self._lock:
+            cache = self._filtrati.get(risultato.url)
+            if cache and cache[0] == risultato.versione:
+                return cache[1]
+            completa = self._decodificati.get(risultato.url)
+        if risultato.body is None and completa and completa[0] == risultato.versione:
+            # 304 con la sola copia completa in memoria: si filtra quella
+            dati = completa[1]
+            if not isinstance(dati, list):
+                return None
+            return [record for record in dati if not isinstance(record, dict) or tieni(record)]
+        if self._body(risultato) is None:
+            return None
+        with metrics.misura("meteo_decodifica_secondi", host=urlsplit(risultato.url).netloc):
+            dati = stream_decode.decodifica_array(risultato.body, tieni, risultato.url)
+        if dati is not None:
+            with self._lock:
+                self._filtrati[risultato.url] = (risultato.versione, dati)
+        return dati
+
+    def conferma(self, risultato):
+        """Registra che il consumatore ha elaborato la versione del risultato (da chiamare a elaborazione riuscita)."""
+        with self._lock:
+            chiave = f"{risultato.consumatore} {risultato.url}"
+            if self._versioni_consumatori.get(chiave) != risultato.versione:
+                self._versioni_consumatori[chiave] = risultato.versione
+                self._salva_stato()
+
+
+# Istanza condivisa tra gli script caricati nello stesso processo: validatori e
+# payload decodificati sono comuni, le versioni elaborate restano per consumatore
+_fetcher = None
+
+
+def fetcher():
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = FetchCondizionale()
+    return _fetcher
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Messaggio di stato "live": un solo messaggio fissato per chat, modificato sul posto.
+
+Invece di inviare un nuovo report a ogni esecuzione (un sendMessage e una
+notifica ogni 15 minuti), la modalità live tiene per ogni chat un messaggio
+fissato e lo aggiorna con editMessageText, senza notifica:
+  - contenuto invariato (stessa impronta)        -> nessuna chiamata;
+  - contenuto cambiato, stessi alert attivi       -> modifica in place;
+  - cambiano gli alert attivi (superamenti/rientri), primo invio,
+    o messaggio non più modificabile              -> nuovo messaggio (con notifica),
+                                                     fissato al posto del precedente.
+Un report diviso in più parti (message_splitter) occupa più messaggi; se cambia
+il numero di parti viene inviato un nuovo gruppo di messaggi.
+
+Lo stato (message_id, impronta, chiave degli alert) è salvato in SQLite
+(LIVE_STATUS_DB, default il database della coda Telegram): la modalità ha
+senso dove il file sopravvive tra un'esecuzione e l'altra (daemon residente).
+LIVE_STATUS_FISSA=0 disattiva il pin del messaggio.
+"""
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime
+
+import telegram_queue
+import message_splitter
+
+PERCORSO_DB = os.environ.get("LIVE_STATUS_DB", telegram_queue.PERCORSO_DB)
+FISSA_MESSAGGIO = os.environ.get("LIVE_STATUS_FISSA", "1") != "0"
+
+ESITO_INVARIATO = "invariato"
+ESITO_MODIFICATO = "modificato"
+ESITO_NUOVO = "nuovo"
+ESITO_ERRORE = "errore"
+
+# Errori di editMessageText: il primo è innocuo, gli altri richiedono un nuovo messaggio
+ERRORE_NON_MODIFICATO = "message is not modified"
+ERRORI_NON_MODIFICABILE = ("message to edit not found", "message can't be edited")
+
+
+def impronta(testo):
+    return hashlib.blake2b(testo.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class StatoLive:
+    """Messaggi live per chat di un bot; vedi aggiorna()."""
+
+    def __init__(self, coda, percorso=PERCORSO_DB, fissa=FISSA_MESSAGGIO):
+        self.coda = coda
+        self.fissa = fissa
+        self.conn = sqlite3.connect(percorso, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS stato_live ("
+            " bot TEXT NOT NULL, chat_id TEXT NOT NULL, message_ids TEXT NOT NULL,"
+            " impronta TEXT NOT NULL, chiave_allerte TEXT, aggiornato TEXT,"
+            " PRIMARY KEY (bot, chat_id))"
+        )
+        self.conn.commit()
+        self._lock = threading.Lock()
+
+    def _leggi(self, chat_id):
+        with self._lock:
+            riga = self.conn.execute("SELECT message_ids, impronta, chiave_allerte FROM stato_live WHERE bot = ? AND chat_id = ?",
+                                     (self.coda.bot, str(chat_id))).fetchone()
+        return (json.loads(riga[0]), riga[1], riga[2]) if riga else None
+
+    def _salva(self, chat_id, message_ids, impronta_contenuto, chiave_allerte):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stato_live (bot, chat_id, message_ids, impronta, chiave_allerte, aggiornato) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.coda.bot, str(chat_id), json.dumps(message_ids), impronta_contenuto, chiave_allerte, datetime.now().isoformat(timespec="seconds"))
+            )
+            self.conn.commit()
+
+    def aggiorna(self, chat_id, testo, contenuto=None, chiave_allerte=None, parse_mode=None):
+        """
+        Porta il messaggio live della chat al testo indicato e restituisce l'esito (ESITO_*).
+        `contenuto` è il testo su cui calcolare l'impronta (default testo): serve a escludere
+        parti che cambiano a ogni esecuzione, come l'orario del report. `chiave_allerte`
+        identifica gli alert attivi: quando cambia si invia un nuovo messaggio.
+        """
+        impronta_contenuto = impronta(testo if contenuto is None else contenuto)
+        parti = message_splitter.dividi_messaggio(testo)
+        stato = self._leggi(chat_id)
+
+        if stato is not None and stato[2] == chiave_allerte and len(stato[0]) == len(parti):
+            message_ids, impronta_precedente, _ = stato
+            if impronta_precedente == impronta_contenuto:
+                logging.info(f"[Live Status] Chat {chat_id}: contenuto invariato, nessuna modifica")
+                return ESITO_INVARIATO
+            esito = self._modifica(chat_id, message_ids, parti, parse_mode)
+            if esito == ESITO_MODIFICATO:
+                self._salva(chat_id, message_ids, impronta_contenuto, chiave_allerte)
+                return esito
+            if esito == ESITO_ERRORE:
+                return esito
+            # Messaggio non più modificabile: se ne invia uno nuovo
+
+        return self._nuovo(chat_id, stato[0] if stato else [], parti, parse_mode, impronta_contenuto, chiave_allerte)
+
+    def _modifica(self, chat_id, message_ids, parti, parse_mode):
+        for message_id, parte in zip(message_ids, parti):
+            parametri = {"message_id": message_id, "text": parte}
+            if parse_mode:
+                parametri["parse_mode"] = parse_mode
+            risultato, errore = self.coda.chiama(chat_id, "editMessageText", **parametri)
+            if risultato is not None or ERRORE_NON_MODIFICATO in (errore or ""):
+                continue
+            if any(motivo in (errore or "") for motivo in ERRORI_NON_MODIFICABILE):
+                logging.warning(f"[Live Status] Chat {chat_id}: messaggio {message_id} non modificabile, invio di un nuovo messaggio")
+                return ESITO_NUOVO
+            return ESITO_ERRORE
+        logging.info(f"[Live Status] Chat {chat_id}: messaggio live modificato ({len(parti)} parti)")
+        return ESITO_MODIFICATO
+
+    def _nuovo(self, chat_id, message_ids_precedenti, parti, parse_mode, impronta_contenuto, chiave_allerte):
+        message_ids = []
+        for parte in parti:
+            parametri = {"text": parte}
+            if parse_mode:
+                parametri["parse_mode"] = parse_mode
+            risultato, _ = self.coda.chiama(chat_id, "sendMessage", **parametri)
+            if risultato is None:
+                # Lo stato non viene aggiornato: il prossimo ciclo ritenta l'invio
+                return ESITO_ERRORE
+            message_ids.append(risultato["message_id"])
+
+        if self.fissa:
+            if message_ids_precedenti:
+                self.coda.chiama(chat_id, "unpinChatMessage", message_id=message_ids_precedenti[0])
+            self.coda.chiama(chat_id, "pinChatMessage", message_id=message_ids[0], disable_notification="true")
+        self._salva(chat_id, message_ids, impronta_contenuto, chiave_allerte)
+        logging.info(f"[Live Status] Chat {chat_id}: nuovo messaggio live {message_ids[0]} ({len(parti)} parti)")
+        return ESITO_NUOVO
+
+
+# Uno stato per token, condiviso dagli script caricati nello stesso processo
+_stati = {}
+_lock_stati = threading.Lock()
+
+
+def stato(token):
+    with _lock_stati:
+        if token not in _stati:
+            _stati[token] = StatoLive(telegram_queue.coda(token))
+        return _stati[token]
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Divisione dei messaggi Telegram oltre il limite di 4096 caratteri.
+
+Invece di troncare (perdendo gli alert in fondo al report) il testo viene
+diviso in più parti, tutte consegnate in ordine dalla coda (telegram_queue).
+I punti di taglio sono scelti, in ordine di preferenza:
+  1. prima di una riga vuota (confine di sezione/bacino nei report);
+  2. prima di una riga non indentata (inizio del blocco di una stazione o di un alert);
+  3. tra due righe qualsiasi.
+Un taglio viene accettato solo se la parte è piena almeno a metà, così una
+sezione lunga non produce una raffica di messaggi quasi vuoti. Una singola riga
+più lunga del limite viene spezzata chiudendo e riaprendo le entità Markdown
+aperte (*, _, `), così ogni parte resta valida per il parse_mode.
+Le parti sono numerate ("📄 1/3") e le lunghezze sono misurate in unità UTF-16,
+come fa la Bot API (le emoji contano doppio).
+"""
+LIMITE_TELEGRAM = 4096
+# Spazio riservato alla numerazione delle parti ("\n\n📄 12/12")
+RISERVA_NUMERAZIONE = 16
+MARCATORI_ENTITA = "*_`"
+
+TAGLIO_SEZIONE = 3
+TAGLIO_BLOCCO = 2
+TAGLIO_RIGA = 1
+
+
+def lunghezza_telegram(testo):
+    """Lunghezza in unità UTF-16, l'unità con cui la Bot API applica il limite."""
+    return len(testo.encode("utf-16-le")) // 2
+
+
+def _marcatori_aperti(testo, aperti=()):
+    """Entità Markdown ancora aperte alla fine di testo (i caratteri preceduti da "\\" sono escape)."""
+    aperti = list(aperti)
+    escape = False
+    for carattere in testo:
+        if escape:
+            escape = False
+        elif carattere == "\\":
+            escape = True
+        elif carattere in MARCATORI_ENTITA:
+            if aperti and aperti[-1] == carattere:
+                aperti.pop()
+            elif carattere not in aperti:
+                aperti.append(carattere)
+    return aperti
+
+
+def _spezza_riga(riga, spazio):
+    """Divide una riga più lunga di spazio, preferibilmente sugli spazi, mantenendo bilanciate le entità."""
+    if lunghezza_telegram(riga) <= spazio:
+        return [riga]
+    pezzi = []
+    aperti = []
+    # Margine per le entità da richiudere e riaprire ai bordi del pezzo
+    spazio_utile = max(1, spazio - 2 * len(MARCATORI_ENTITA))
+    while riga:
+        riapertura = "".join(aperti)
+        fine = len(riga)
+        while lunghezza_telegram(riapertura + riga[:fine]) > spazio_utile:
+            fine = min(fine - 1, spazio_utile - len(riapertura))
+        if fine < len(riga):
+            spazio_trovato = riga.rfind(" ", 0, fine)
+            if spazio_trovato > fine // 2:
+                fine = spazio_trovato + 1
+            # Non separa un carattere di escape da quello che protegge
+            if riga[fine - 1] == "\\" and fine > 1:
+                fine -= 1
+        pezzo = riga[:fine]
+        nuovi_aperti = _marcatori_aperti(pezzo, aperti)
+        pezzi.append(riapertura + pezzo + "".join(reversed(nuovi_aperti)))
+        aperti = nuovi_aperti
+        riga = riga[fine:]
+    return pezzi
+
+
+def _intestazione_prima(righe, indice):
+    """True se l'ultima riga piena prima di indice è isolata tra righe vuote (un titolo di sezione/bacino)."""
+    precedente = indice - 1
+    while precedente >= 0 and not righe[precedente].strip():
+        precedente -= 1
+    return precedente >= 0 and (precedente == 0 or not righe[precedente - 1].strip())
+
+
+def _livello_taglio(righe, indice):
+    """Preferenza del taglio prima di righe[indice]; un titolo non resta mai in fondo a una parte."""
+    riga = righe[indice]
+    if _intestazione_prima(righe, indice):
+        return TAGLIO_RIGA - 1
+    if not riga.strip():
+        return TAGLIO_SEZIONE
+    if not riga[0].isspace():
+        return TAGLIO_BLOCCO
+    return TAGLIO_RIGA
+
+
+def dividi_messaggio(testo, limite=LIMITE_TELEGRAM):
+    """Restituisce le parti (in ordine) in cui inviare testo; una sola parte se sta nel limite."""
+    if lunghezza_telegram(testo) <= limite:
+        return [testo]
+
+    spazio = limite - RISERVA_NUMERAZIONE
+    righe = [pezzo for riga in testo.split("\n") for pezzo in _spezza_riga(riga, spazio)]
+    lunghezze = [lunghezza_telegram(riga) for riga in righe]
+
+    parti = []
+    inizio = 0
+    while inizio < len(righe):
+        # Le righe vuote ai bordi di una parte non servono
+        if not righe[inizio].strip():
+            inizio += 1
+            continue
+        # Righe che stanno nella parte, con la lunghezza accumulata prima di ogni possibile taglio
+        occupato = lunghezze[inizio]
+        fine = inizio + 1
+        candidati = []
+        while fine < len(righe) and occupato + 1 + lunghezze[fine] <= spazio:
+            if occupato >= spazio // 2:
+                candidati.append((_livello_taglio(righe, fine), fine))
+            occupato += 1 + lunghezze[fine]
+            fine += 1
+        if fine < len(righe):
+            if occupato >= spazio // 2:
+                candidati.append((_livello_taglio(righe, fine), fine))
+            if candidati:
+                fine = max(candidati)[1]
+        parti.append("\n".join(righe[inizio:fine]).rstrip())
+        inizio = fine
+
+    if len(parti) > 1:
+        parti = [f"{parte}\n\n📄 {numero}/{len(parti)}" for numero, parte in enumerate(parti, 1)]
+    return parti
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Metriche di processo (contatori, valori, istogrammi) con endpoint Prometheus
+e riepilogo periodico nei log.
+
+Gli script registrano sul percorso caldo durate e conteggi (download HTTP,
+decodifica JSON, stadi del motore stazioni, stazioni/sensori valutati, allerte
+prodotte, chiamate e ritentativi Telegram, durata dei job del daemon); ogni
+registrazione è un lookup in un dizionario sotto lock, senza I/O.
+
+Nei processi residenti (daemon, bot) avvia() espone:
+  - http://METRICS_HOST:METRICS_PORTA/metrics nel formato testo di Prometheus
+    (default 127.0.0.1:9108, porta 0 = disabilitato);
+  - ogni METRICS_INTERVALLO_RIEPILOGO secondi (default 900, 0 = mai) una riga
+    di log per serie con conteggio, p50/p95/max delle durate e incrementi dei
+    contatori dall'ultimo riepilogo, per vedere dove va il tempo di ogni ciclo.
+"""
+import os
+import time
+import logging
+import threading
+import contextlib
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+PORTA = int(os.environ.get("METRICS_PORTA", "9108"))
+INTERVALLO_RIEPILOGO = int(os.environ.get("METRICS_INTERVALLO_RIEPILOGO", "900"))
+
+CONTATORE = "counter"
+VALORE = "gauge"
+ISTOGRAMMA = "histogram"
+
+# Limiti (secondi) dei bucket degli istogrammi, da richieste locali a upstream lenti
+BUCKET = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Durate conservate per serie tra due riepiloghi, per i percentili
+MAX_CAMPIONI_RIEPILOGO = 10000
+
+METRICHE = {
+    "meteo_fetch_secondi": (ISTOGRAMMA, "Durata dei download HTTP dai servizi esterni"),
+    "meteo_fetch_risposte_totale": (CONTATORE, "Risposte dei servizi esterni per stato HTTP (o tipo di errore di rete)"),
+    "meteo_fetch_byte_totale": (CONTATORE, "Byte scaricati dai servizi esterni"),
+    "meteo_decodifica_secondi": (ISTOGRAMMA, "Durata della decodifica JSON dei payload"),
+    "meteo_motore_stadio_secondi": (ISTOGRAMMA, "Durata degli stadi del motore stazioni"),
+    "meteo_stazioni_valutate_totale": (CONTATORE, "Stazioni valutate dal motore stazioni"),
+    "meteo_sensori_valutati_totale": (CONTATORE, "Sensori con soglia valutati dal motore stazioni"),
+    "meteo_allerte_totale": (CONTATORE, "Allerte prodotte per fonte ed evento"),
+    "meteo_telegram_secondi": (ISTOGRAMMA, "Durata delle chiamate alla Bot API Telegram"),
+    "meteo_telegram_esiti_totale": (CONTATORE, "Esiti delle chiamate alla Bot API (inviato, riprova, scartato)"),
+    "meteo_telegram_ritentativi_totale": (CONTATORE, "Chiamate alla Bot API che ritentano un invio fallito"),
+    "meteo_job_secondi": (ISTOGRAMMA, "Durata dei job del daemon"),
+    "meteo_job_errori_totale": (CONTATORE, "Job del daemon terminati con eccezione"),
+    "meteo_job_sforamenti_totale": (CONTATORE, "Job del daemon durati più del proprio intervallo"),
+    "meteo_job_ultima_esecuzione": (VALORE, "Timestamp Unix di fine dell'ultima esecuzione del job"),
+    "meteo_circuito_stato": (VALORE, "Stato del circuito di un servizio esterno (0 chiuso, 1 semiaperto, 2 aperto)"),
+    "meteo_circuito_rifiutate_totale": (CONTATORE, "Richieste rifiutate a circuito aperto"),
+    "meteo_hedge_totale": (CONTATORE, "Richieste di riserva (hedging) per richiesta vincente"),
+    "meteo_snapshot_obsoleti_totale": (CONTATORE, "Payload serviti dall'ultima copia valida perché il servizio non risponde"),
+}
+
+
+def _chiave(etichette):
+    return tuple(sorted((nome, str(valore)) for nome, valore in etichette.items()))
+
+
+def _formatta_etichette(chiave, extra=()):
+    coppie = list(chiave) + list(extra)
+    if not coppie:
+        return ""
+    testo = ",".join('{}="{}"'.format(nome, valore.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                     for nome, valore in coppie)
+    return "{" + testo + "}"
+
+
+def _percentile(ordinati, quota):
+    return ordinati[min(len(ordinati) - 1, int(quota * len(ordinati)))]
+
+
+class RegistroMetriche:
+    """Serie per (nome, etichette): contatori e valori come numeri, istogrammi come bucket + somma + conteggio."""
+
+    def __init__(self, bucket=BUCKET):
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._tipi = {}
+        self._valori = {} # (nome, chiave etichette) -> numero
+        self._istogrammi = {} # (nome, chiave etichette) -> [conteggi per bucket, somma, conteggio]
+        self._campioni = defaultdict(list) # serie istogramma -> durate dall'ultimo riepilogo
+        self._valori_riepilogo = {} # serie contatore -> valore all'ultimo riepilogo
+
+    def _tipo(self, nome, tipo):
+        tipo_registrato = self._tipi.setdefault(nome, tipo)
+        if tipo_registrato != tipo:
+            logging.error(f"[Metriche] {nome} usata come {tipo} ma registrata come {tipo_registrato}")
+            return False
+        return True
+
+    def incrementa(self, nome, valore=1, **etichette):
+        serie = (nome, _chiave(etichette))
+        with self._lock:
+            if self._tipo(nome, CONTATORE):
+                self._valori[serie] = self._valori.get(serie, 0) + valore
+
+    def imposta(self, nome, valore, **etichette):
+        serie = (nome, _chiave(etichette))
+        with self._lock:
+            if self._tipo(nome, VALORE):
+                self._valori[serie] = valore
+
+    def osserva(self, nome, secondi, **etichette):
+        serie = (nome, _chiave(etichette))
+        with self._lock:
+            if not self._tipo(nome, ISTOGRAMMA):
+                return
+            istogramma = self._istogrammi.get(serie)
+            if istogramma is None:
+                istogramma = self._istogrammi[serie] = [[0] * len(self.bucket), 0.0, 0]
+            for indice, limite in enumerate(self.bucket):
+                if secondi <= limite:
+                    istogramma[0][indice] += 1
+                    break
+            istogramma[1] += secondi
+            istogramma[2] += 1
+            campioni = self._campioni[serie]
+            if len(campioni) < MAX_CAMPIONI_RIEPILOGO:
+                campioni.append(secondi)
+
+    @contextlib.contextmanager
+    def misura(self, nome, **etichette):
+        """Osserva nell'istogramma `nome` la durata del blocco, anche se termina con un'eccezione."""
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.osserva(nome, time.perf_counter() - inizio, **etichette)
+
+    def testo_prometheus(self):
+        """Tutte le serie nel formato testo di esposizione di Prometheus (0.0.4)."""
+        with self._lock:
+            valori = dict(self._valori)
+            istogrammi = {serie: ([*conteggi], somma, totale) for serie, (conteggi, somma, totale) in self._istogrammi.items()}
+            tipi = dict(self._tipi)
+        righe = []
+        for nome in sorted(tipi):
+            tipo = tipi[nome]
+            righe.append(f"# HELP {nome} {METRICHE.get(nome, (tipo, nome))[1]}")
+            righe.append(f"# TYPE {nome} {tipo}")
+            if tipo == ISTOGRAMMA:
+                for (nome_serie, chiave), (conteggi, somma, totale) in sorted(istogrammi.items()):
+                    if nome_serie != nome:
+                        continue
+                    cumulato = 0
+                    for limite, conteggio in zip(self.bucket, conteggi):
+                        cumulato += conteggio
+                        righe.append(f"{nome}_bucket{_formatta_etichette(chiave, [('le', repr(limite))])} {cumulato}")
+                    righe.append(f"{nome}_bucket{_formatta_etichette(chiave, [('le', '+Inf')])} {totale}")
+                    righe.append(f"{nome}_sum{_formatta_etichette(chiave)} {somma!r}")
+                    righe.append(f"{nome}_count{_formatta_etichette(chiave)} {totale}")
+            else:
+                for (nome_serie, chiave), valore in sorted(valori.items()):
+                    if nome_serie == nome:
+                        righe.append(f"{nome}{_formatta_etichette(chiave)} {valore!r}")
+        return "\n".join(righe) + "\n"
+
+    def riepilogo(self):
+        """
+        Righe di riepilogo dall'ultima chiamata: per istogramma conteggio, p50/p95/max;
+        per contatore l'incremento. Azzera la finestra.
+        """
+        with self._lock:
+            campioni, self._campioni = self._campioni, defaultdict(list)
+            contatori = {serie: valore for serie, valore in self._valori.items() if self._tipi.get(serie[0]) == CONTATORE}
+            precedenti, self._valori_riepilogo = self._valori_riepilogo, contatori
+        righe = []
+        for (nome, chiave), durate in sorted(campioni.items()):
+            durate.sort()
+            righe.append(f"{nome}{_formatta_etichette(chiave)}: n={len(durate)} p50={_percentile(durate, 0.5):.3f}s "
+                         f"p95={_percentile(durate, 0.95):.3f}s max={durate[-1]:.3f}s")
+        for (nome, chiave), valore in sorted(contatori.items()):
+            incremento = valore - precedenti.get((nome, chiave), 0)
+            if incremento:
+                righe.append(f"{nome}{_formatta_etichette(chiave)}: +{incremento:g}")
+        return righe
+
+
+# Registro condiviso da tutti i moduli del processo
+_registro = RegistroMetriche()
+_lock_avvio = threading.Lock()
+_avviato = False
+
+
+def registro():
+    return _registro
+
+
+def incrementa(nome, valore=1, **etichette):
+    _registro.incrementa(nome, valore, **etichette)
+
+
+def imposta(nome, valore, **etichette):
+    _registro.imposta(nome, valore, **etichette)
+
+
+def osserva(nome, secondi, **etichette):
+    _registro.osserva(nome, secondi, **etichette)
+
+
+def misura(nome, **etichette):
+    return _registro.misura(nome, **etichette)
+
+
+class GestoreMetriche(BaseHTTPRequestHandler):
+    def log_message(self, formato, *args):
+        logging.debug("[Metriche] " + formato % args)
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = _registro.testo_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def logga_riepilogo():
+    righe = _registro.riepilogo()
+    if righe:
+        logging.info("[Metriche] Riepilogo:\n  " + "\n  ".join(righe))
+
+
+def avvia(host=HOST, porta=PORTA, intervallo_riepilogo=INTERVALLO_RIEPILOGO):
+    """Avvia (una volta per processo) l'endpoint /metrics e il riepilogo periodico, in thread daemon."""
+    global _avviato
+    with _lock_avvio:
+        if _avviato:
+            return
+        _avviato = True
+
+    if porta > 0:
+        try:
+            server = ThreadingHTTPServer((host, porta), GestoreMetriche)
+        except OSError as e:
+            logging.error(f"[Metriche] Endpoint non avviato su {host}:{porta}: {e}")
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="metriche-http", daemon=True).start()
+            logging.info(f"[Metriche] Endpoint Prometheus su http://{host}:{porta}/metrics")
+
+    if intervallo_riepilogo > 0:
+        def riepiloga():
+            while True:
+                threading.Event().wait(intervallo_riepilogo)
+                logga_riepilogo()
+
+        threading.Thread(target=riepiloga, name="metriche-riepilogo", daemon=True).start()
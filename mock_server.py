@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+Server locale che sostituisce RETEMIR, allertameteo, WeatherLink e la Bot API
+Telegram, per i test di carico e di guasto senza rete.
+
+Un solo processo (http.server, un thread per richiesta) serve i quattro
+servizi sotto prefissi diversi; gli script vi si collegano con le variabili
+di base URL, stampate all'avvio:
+  RETEMIR_BASE_URL=http://127.0.0.1:8765/retemir
+  ALLERTAMETEO_BASE_URL=http://127.0.0.1:8765/allertameteo
+  WEATHERLINK_API_BASE_URL=http://127.0.0.1:8765/weatherlink/v2
+  TELEGRAM_API_BASE_URL=http://127.0.0.1:8765/telegram
+
+I payload partono dalle fixture di benchmarks/fixtures (MOCK_FIXTURE_DIR),
+scalate di --scala volte come nel benchmark. Il payload RETEMIR cambia ogni
+--intervallo-dati secondi (lastUpdateTime e valori ±10%) e risponde 304 a
+If-None-Match, come un server reale con ETag.
+
+Guasti configurabili (opzioni o variabili MOCK_*), per ogni richiesta:
+  --latenza 20-200     latenza aggiunta in ms (valore fisso o intervallo uniforme)
+  --errori 0.05        frazione di risposte 500/502/503
+  --troppe 0.02        frazione di risposte 429 (Bot API: retry_after = --retry-after)
+  --blocchi 0.01       frazione di richieste che restano appese --durata-blocco secondi
+
+Per il bot interattivo, getUpdates restituisce comandi sintetici (/stato,
+/bacino, /stazione, /allerte) a --comandi-al-secondo da --chat chat diverse.
+GET /_statistiche restituisce per servizio richieste, esiti e latenze
+(p50/p95/p99) servite; il riepilogo viene stampato anche all'uscita.
+
+Uso: python mock_server.py [--porta 8765] [--scala 10] [--latenza 20-200] [--errori 0.05] [--troppe 0.02]
+"""
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from datetime import datetime
+from collections import defaultdict, deque
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.utils import formatdate
+
+CARTELLA_FIXTURE = os.environ.get("MOCK_FIXTURE_DIR",
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "fixtures"))
+OFFSET_CODICE = 100000
+FORMATO_ORARIO = "%d/%m/%Y %H:%M"
+# Campioni di latenza conservati per servizio, per i percentili
+CAMPIONI_LATENZA = 10000
+COMANDI_SINTETICI = ["/stato", "/bacino Misa", "/bacino Nevola", "/stazione Arcevia", "/stazione Senigallia", "/allerte", "/allerte 2 4"]
+ERRORI_SERVER = {500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable"}
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def _env(nome, default):
+    return os.environ.get(nome, default)
+
+
+def intervallo_latenza(testo):
+    """'50' -> (50, 50), '20-200' -> (20, 200), in millisecondi."""
+    minimo, _, massimo = str(testo).partition("-")
+    return float(minimo), float(massimo or minimo)
+
+
+def carica_fixture(nome):
+    with open(os.path.join(CARTELLA_FIXTURE, nome), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _jitter(valore, generatore):
+    """Valore numerico (stringa) variato del ±10%; gli altri valori restano com'erano."""
+    try:
+        numero = float(valore)
+    except (TypeError, ValueError):
+        return valore
+    return str(round(numero * generatore.uniform(0.9, 1.1), 2))
+
+
+def _percentile(durate_ordinate, quota):
+    return round(durate_ordinate[min(len(durate_ordinate) - 1, int(quota * len(durate_ordinate)))] * 1000, 1)
+
+
+class Statistiche:
+    """Richieste, esiti e latenze servite per servizio."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.avvio = time.monotonic()
+        self.richieste = defaultdict(int)
+        self.esiti = defaultdict(lambda: defaultdict(int))
+        self.latenze = defaultdict(lambda: deque(maxlen=CAMPIONI_LATENZA))
+
+    def registra(self, servizio, stato, durata):
+        with self._lock:
+            self.richieste[servizio] += 1
+            self.esiti[servizio][stato] += 1
+            self.latenze[servizio].append(durata)
+
+    def riepilogo(self):
+        with self._lock:
+            secondi = max(time.monotonic() - self.avvio, 1e-9)
+            servizi = {}
+            for servizio, totale in sorted(self.richieste.items()):
+                durate = sorted(self.latenze[servizio])
+                servizi[servizio] = {
+                    "richieste": totale, "al_secondo": round(totale / secondi, 2),
+                    "esiti": {str(stato): numero for stato, numero in sorted(self.esiti[servizio].items())},
+                    "p50_ms": _percentile(durate, 0.50), "p95_ms": _percentile(durate, 0.95), "p99_ms": _percentile(durate, 0.99),
+                }
+            return {"secondi": round(secondi, 1), "servizi": servizi}
+
+
+class ServizioFinto:
+    """Payload, guasti simulati e stato (messaggi, aggiornamenti) dei servizi finti."""
+
+    def __init__(self, scala=1, latenza=(0.0, 0.0), errori=0.0, troppe=0.0, retry_after=1, blocchi=0.0,
+                 durata_blocco=60.0, intervallo_dati=300, comandi_al_secondo=0.0, chat=50):
+        self.scala = max(1, scala)
+        self.latenza = latenza
+        self.errori = errori
+        self.troppe = troppe
+        self.retry_after = retry_after
+        self.blocchi = blocchi
+        self.durata_blocco = durata_blocco
+        self.intervallo_dati = max(1, intervallo_dati)
+        self.comandi_al_secondo = comandi_al_secondo
+        self.chat = [100000 + indice for indice in range(max(1, chat))]
+        self.statistiche = Statistiche()
+        self._lock = threading.Lock()
+
+        self.stazioni = self._scala_stazioni(carica_fixture("rt-data.json"))
+        self._turno_rt = None # (turno, body, etag, last_modified)
+        self.bollettino = json.dumps(self._scala_allerte(carica_fixture("allerta-domani.json"))).encode()
+        self._correnti = carica_fixture("weatherlink-current.json")
+
+        self._message_id = 0
+        self._update_id = 0
+        self._ultimo_comando = time.monotonic()
+        self._aggiornamenti = deque(maxlen=1000)
+
+    def _scala_stazioni(self, originale):
+        stazioni = [dict(record) for record in originale]
+        for copia in range(1, self.scala):
+            stazioni.extend(dict(record, codice=record["codice"] + copia * OFFSET_CODICE, nome=f"{record['nome'].strip()} #{copia}")
+                            for record in originale)
+        return stazioni
+
+    def _scala_allerte(self, originale):
+        return [dict(voce, area=voce["area"] if not copia else f"{voce['area']}.{copia}")
+                for copia in range(self.scala) for voce in originale]
+
+    # --- Guasti ---
+    def guasto(self):
+        """Applica latenza e blocchi; restituisce lo stato HTTP di errore da simulare (429/5xx) o None."""
+        minimo, massimo = self.latenza
+        if massimo > 0:
+            time.sleep(random.uniform(minimo, massimo) / 1000)
+        if self.blocchi and random.random() < self.blocchi:
+            time.sleep(self.durata_blocco)
+        estrazione = random.random()
+        if estrazione < self.troppe:
+            return 429
+        if estrazione < self.troppe + self.errori:
+            return random.choice(list(ERRORI_SERVER))
+        return None
+
+    # --- RETEMIR ---
+    def rt_data(self):
+        """(body, etag, last_modified) del payload stazioni del turno corrente."""
+        turno = int(time.time() // self.intervallo_dati)
+        with self._lock:
+            if self._turno_rt is None or self._turno_rt[0] != turno:
+                generatore = random.Random(turno)
+                orario = datetime.fromtimestamp(turno * self.intervallo_dati).strftime(FORMATO_ORARIO)
+                records = [dict(record, lastUpdateTime=orario,
+                                analog=[dict(sensore, valore=_jitter(sensore.get("valore"), generatore)) for sensore in record.get("analog") or ()])
+                           for record in self.stazioni]
+                body = json.dumps(records).encode()
+                etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+                self._turno_rt = (turno, body, etag, formatdate(turno * self.intervallo_dati, usegmt=True))
+            return self._turno_rt[1:]
+
+    # --- WeatherLink ---
+    def corrente(self, id_stazione):
+        indice = int(hashlib.blake2b(id_stazione.encode(), digest_size=4).hexdigest(), 16)
+        dati = json.loads(json.dumps(self._correnti[indice % len(self._correnti)]))
+        dati["station_id"] = int(id_stazione) if id_stazione.isdigit() else id_stazione
+        dati["generated_at"] = int(time.time())
+        for sensore in dati.get("sensors", ()):
+            for campione in sensore.get("data", ()):
+                campione["ts"] = int(time.time())
+        return json.dumps(dati).encode()
+
+    # --- Bot API ---
+    def _nuovo_messaggio(self, parametri):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        chat_id = parametri.get("chat_id", 0)
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else chat_id, "type": "private"},
+                "text": parametri.get("text", "")}
+
+    def _comandi_sintetici(self):
+        """Genera gli update dei comandi arrivati dall'ultima chiamata, al ritmo configurato."""
+        with self._lock:
+            adesso = time.monotonic()
+            nuovi = int((adesso - self._ultimo_comando) * self.comandi_al_secondo)
+            if not nuovi:
+                return
+            self._ultimo_comando += nuovi / self.comandi_al_secondo
+            for _ in range(min(nuovi, self._aggiornamenti.maxlen)):
+                self._update_id += 1
+                self._message_id += 1
+                chat_id = random.choice(self.chat)
+                testo = random.choice(COMANDI_SINTETICI)
+                comando = testo.split()[0]
+                self._aggiornamenti.append({"update_id": self._update_id, "message": {
+                    "message_id": self._message_id, "date": int(time.time()), "text": testo,
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "Carico"},
+                    "entities": [{"type": "bot_command", "offset": 0, "length": len(comando)}]}})
+
+    def get_updates(self, parametri):
+        offset = int(parametri.get("offset") or 0)
+        limite = int(parametri.get("limit") or 100)
+        attesa = min(float(parametri.get("timeout") or 0), 1.0)
+        scadenza = time.monotonic() + attesa
+        while True:
+            if self.comandi_al_secondo > 0:
+                self._comandi_sintetici()
+            with self._lock:
+                while self._aggiornamenti and self._aggiornamenti[0]["update_id"] < offset:
+                    self._aggiornamenti.popleft()
+                pronti = list(self._aggiornamenti)[:limite]
+            if pronti or time.monotonic() >= scadenza:
+                return pronti
+            time.sleep(0.05)
+
+    def bot_api(self, metodo, parametri):
+        """Risultato (`result`) di un metodo della Bot API."""
+        if metodo == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Mock", "username": "mock_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if metodo == "getUpdates":
+            return self.get_updates(parametri)
+        if metodo in ("sendMessage", "editMessageText"):
+            messaggio = self._nuovo_messaggio(parametri)
+            if metodo == "editMessageText":
+                messaggio["message_id"] = int(parametri.get("message_id") or messaggio["message_id"])
+            return messaggio
+        return True
+
+
+class GestoreRichieste(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, come i server reali
+    servizio = None # ServizioFinto, impostato da crea_server()
+
+    def log_message(self, formato, *args):
+        logging.debug("[Mock Server] " + formato % args)
+
+    def _rispondi(self, stato, body=b"", tipo="application/json", intestazioni=None):
+        self.send_response(stato)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(body)))
+        for nome, valore in (intestazioni or {}).items():
+            self.send_header(nome, valore)
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+        return stato
+
+    def _rispondi_json(self, stato, dati, intestazioni=None):
+        return self._rispondi(stato, json.dumps(dati).encode(), intestazioni=intestazioni)
+
+    def _errore(self, stato, telegram=False):
+        if telegram:
+            if stato == 429:
+                return self._rispondi_json(429, {"ok": False, "error_code": 429, "parameters": {"retry_after": self.servizio.retry_after},
+                                                 "description": f"Too Many Requests: retry after {self.servizio.retry_after}"})
+            return self._rispondi_json(stato, {"ok": False, "error_code": stato, "description": ERRORI_SERVER.get(stato, "Error")})
+        intestazioni = {"Retry-After": str(self.servizio.retry_after)} if stato == 429 else None
+        return self._rispondi_json(stato, {"error": ERRORI_SERVER.get(stato, "Too Many Requests")}, intestazioni)
+
+    def _parametri_post(self):
+        lunghezza = int(self.headers.get("Content-Length") or 0)
+        corpo = self.rfile.read(lunghezza) if lunghezza else b""
+        tipo = self.headers.get("Content-Type", "")
+        if "application/json" in tipo:
+            try:
+                return json.loads(corpo or b"{}")
+            except ValueError:
+                return {}
+        if "application/x-www-form-urlencoded" in tipo:
+            return {chiave: valori[-1] for chiave, valori in parse_qs(corpo.decode("utf-8", "replace")).items()}
+        return {}
+
+    def _gestisci(self):
+        inizio = time.monotonic()
+        indirizzo = urlsplit(self.path)
+        percorso = indirizzo.path.rstrip("/")
+        parametri = {chiave: valori[-1] for chiave, valori in parse_qs(indirizzo.query).items()}
+        if self.command == "POST":
+            parametri.update(self._parametri_post())
+
+        if percorso == "/_statistiche":
+            self._rispondi_json(200, self.servizio.statistiche.riepilogo())
+            return
+
+        if percorso.startswith("/telegram/bot"):
+            _, _, metodo = percorso[len("/telegram/bot"):].partition("/")
+            servizio = f"telegram:{metodo}"
+        elif percorso.startswith("/retemir/"):
+            servizio = "retemir"
+        elif percorso.startswith("/allertameteo/"):
+            servizio = "allertameteo"
+        elif percorso.startswith("/weatherlink/"):
+            servizio = "weatherlink"
+        else:
+            stato = self._rispondi_json(404, {"error": "Not Found"})
+            self.servizio.statistiche.registra("sconosciuto", stato, time.monotonic() - inizio)
+            return
+
+        # getUpdates è il long polling del bot: i guasti si simulano solo sulle chiamate "vere"
+        guasto = self.servizio.guasto() if servizio != "telegram:getUpdates" else None
+        if guasto:
+            stato = self._errore(guasto, telegram=servizio.startswith("telegram:"))
+        elif servizio == "retemir" and percorso == "/retemir/api/stations/rt-data":
+            body, etag, last_modified = self.servizio.rt_data()
+            intestazioni = {"ETag": etag, "Last-Modified": last_modified}
+            if self.headers.get("If-None-Match") == etag:
+                stato = self._rispondi(304, intestazioni=intestazioni)
+            else:
+                stato = self._rispondi(200, body, intestazioni=intestazioni)
+        elif servizio == "allertameteo" and percorso == "/allertameteo/o/api/allerta/get-stato-allerta-domani":
+            stato = self._rispondi(200, self.servizio.bollettino)
+        elif servizio == "weatherlink" and percorso.startswith("/weatherlink/v2/current/"):
+            if not parametri.get("api-key") or not parametri.get("api-signature"):
+                stato = self._rispondi_json(401, {"code": 401, "message": "Missing api-key or api-signature"})
+            else:
+                stato = self._rispondi(200, self.servizio.corrente(percorso.rsplit("/", 1)[1]))
+        elif servizio.startswith("telegram:"):
+            stato = self._rispondi_json(200, {"ok": True, "result": self.servizio.bot_api(servizio.split(":", 1)[1], parametri)})
+        else:
+            stato = self._rispondi_json(404, {"error": "Not Found"})
+        self.servizio.statistiche.registra(servizio, stato, time.monotonic() - inizio)
+
+    def _gestisci_protetto(self):
+        try:
+            self._gestisci()
+        except (BrokenPipeError, ConnectionResetError):
+            # Il client ha chiuso (es. timeout scaduto durante un blocco simulato)
+            self.close_connection = True
+
+    do_GET = do_POST = do_HEAD = _gestisci_protetto
+
+
+def crea_server(servizio, host="127.0.0.1", porta=8765):
+    """ThreadingHTTPServer che serve `servizio` (ServizioFinto)."""
+    gestore = type("GestoreServizio", (GestoreRichieste,), {"servizio": servizio})
+    server = ThreadingHTTPServer((host, porta), gestore)
+    server.daemon_threads = True
+    return server
+
+
+def variabili_ambiente(host, porta):
+    base = f"http://{host}:{porta}"
+    return {
+        "RETEMIR_BASE_URL": f"{base}/retemir",
+        "ALLERTAMETEO_BASE_URL": f"{base}/allertameteo",
+        "WEATHERLINK_API_BASE_URL": f"{base}/weatherlink/v2",
+        "TELEGRAM_API_BASE_URL": f"{base}/telegram",
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Server locale per RETEMIR, allertameteo, WeatherLink e Bot API Telegram.")
+    parser.add_argument("--host", default=_env("MOCK_HOST", "127.0.0.1"))
+    parser.add_argument("--porta", type=int, default=int(_env("MOCK_PORTA", "8765")))
+    parser.add_argument("--scala", type=int, default=int(_env("MOCK_SCALA", "1")), help="fattore di scala dei payload")
+    parser.add_argument("--latenza", default=_env("MOCK_LATENZA_MS", "0"), help="ms aggiunti, es. 50 o 20-200")
+    parser.add_argument("--errori", type=float, default=float(_env("MOCK_TASSO_ERRORI", "0")), help="frazione di risposte 5xx")
+    parser.add_argument("--troppe", type=float, default=float(_env("MOCK_TASSO_429", "0")), help="frazione di risposte 429")
+    parser.add_argument("--retry-after", type=int, default=int(_env("MOCK_RETRY_AFTER", "1")))
+    parser.add_argument("--blocchi", type=float, default=float(_env("MOCK_TASSO_BLOCCHI", "0")), help="frazione di richieste appese")
+    parser.add_argument("--durata-blocco", type=float, default=float(_env("MOCK_DURATA_BLOCCO", "60")))
+    parser.add_argument("--intervallo-dati", type=int, default=int(_env("MOCK_INTERVALLO_DATI", "300")),
+                        help="secondi tra due payload RETEMIR diversi")
+    parser.add_argument("--comandi-al-secondo", type=float, default=float(_env("MOCK_COMANDI_AL_SECONDO", "0")),
+                        help="comandi sintetici per il bot via getUpdates")
+    parser.add_argument("--chat", type=int, default=int(_env("MOCK_CHAT", "50")), help="chat da cui arrivano i comandi sintetici")
+    argomenti = parser.parse_args()
+
+    try:
+        latenza = intervallo_latenza(argomenti.latenza)
+    except ValueError:
+        logging.critical(f"[Mock Server] Latenza non valida: {argomenti.latenza}"); exit(1)
+    if argomenti.errori + argomenti.troppe > 1:
+        logging.critical("[Mock Server] --errori + --troppe non può superare 1"); exit(1)
+
+    servizio = ServizioFinto(argomenti.scala, latenza, argomenti.errori, argomenti.troppe, argomenti.retry_after,
+                             argomenti.blocchi, argomenti.durata_blocco, argomenti.intervallo_dati,
+                             argomenti.comandi_al_secondo, argomenti.chat)
+    server = crea_server(servizio, argomenti.host, argomenti.porta)
+    logging.info(f"[Mock Server] In ascolto su http://{argomenti.host}:{argomenti.porta} "
+                 f"(scala {argomenti.scala}, {len(servizio.stazioni)} stazioni). Variabili per gli script:")
+    for nome, valore in variabili_ambiente(argomenti.host, argomenti.porta).items():
+        print(f"export {nome}={valore}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(servizio.statistiche.riepilogo(), indent=1))
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Daemon residente che sostituisce le esecuzioni cron ogni 15 minuti.
+
+Ospita in un unico processo i controlli degli script one-shot:
+  - soglie     -> station_engine, modo allerte (con modalità piena)
+  - report     -> station_engine, modo idro (station_checker_idro.pubblica_report)
+  - weatherlink-> weather_alert.run_weather_check
+  - allerte    -> alert_checker.esegui_controllo_allerte (una volta al giorno)
+
+Soglie e report usano lo stesso passaggio del motore stazioni: quando il report
+è dovuto viene prodotto dal job soglie insieme alle allerte (un fetch, una
+valutazione); il job "report" separato esiste solo se il job soglie è disabilitato.
+
+I moduli vengono importati una sola volta: configurazione, sessioni HTTP
+(connessioni keep-alive/TLS) e interprete restano caldi tra un ciclo e l'altro.
+
+Intervalli configurabili da variabili d'ambiente (secondi, 0 = job disabilitato):
+  DAEMON_INTERVALLO_SOGLIE        (default 300)  polling RETEMIR in condizioni normali
+  DAEMON_INTERVALLO_SOGLIE_PIENA  (default 90)   polling RETEMIR con soglie superate
+  DAEMON_INTERVALLO_ERRORI        (default 900)  intervallo minimo tra due messaggi di errore fetch
+  DAEMON_INTERVALLO_REPORT        (default 900)
+  DAEMON_INTERVALLO_WEATHERLINK   (default 900)
+  DAEMON_ORA_ALLERTE              (default "14:00", ora locale; "" = disabilitato)
+  DAEMON_INTERVALLO_TELEGRAM      (default 30)   ritentativo dei messaggi rimasti in coda (telegram_queue)
+
+Le soglie vengono da THRESHOLDS_JSON.txt e sono ricaricate a caldo quando il
+file cambia (threshold_config, SOGLIE_INTERVALLO_CONTROLLO secondi).
+
+Con REPORT_MODALITA=live il job "report" aggiorna un messaggio fissato per chat
+(live_status) invece di inviare un nuovo report a ogni ciclo.
+
+Durate e contatori di ogni ciclo (download, decodifica, stadi del motore,
+allerte, chiamate Telegram, job) sono esposti su
+http://METRICS_HOST:METRICS_PORTA/metrics e riassunti nel log ogni
+METRICS_INTERVALLO_RIEPILOGO secondi (vedi metrics). Un job che dura più
+dell'80% del proprio intervallo viene segnalato nel log.
+
+Uso: python monitor_daemon.py
+"""
+import os
+import time
+import signal
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import station_checker
+import station_checker_idro
+import station_engine
+import weather_alert
+import alert_checker
+import rate_of_rise
+import telegram_queue
+import subscriptions
+import threshold_config
+import metrics
+
+# Quota dell'intervallo oltre la quale la durata di un job viene segnalata
+QUOTA_AVVISO_DURATA = 0.8
+
+INTERVALLO_SOGLIE = int(os.environ.get("DAEMON_INTERVALLO_SOGLIE", "300"))
+INTERVALLO_SOGLIE_PIENA = int(os.environ.get("DAEMON_INTERVALLO_SOGLIE_PIENA", "90"))
+INTERVALLO_ERRORI = int(os.environ.get("DAEMON_INTERVALLO_ERRORI", "900"))
+INTERVALLO_REPORT = int(os.environ.get("DAEMON_INTERVALLO_REPORT", "900"))
+INTERVALLO_WEATHERLINK = int(os.environ.get("DAEMON_INTERVALLO_WEATHERLINK", "900"))
+ORA_ALLERTE = os.environ.get("DAEMON_ORA_ALLERTE", "14:00")
+INTERVALLO_TELEGRAM = int(os.environ.get("DAEMON_INTERVALLO_TELEGRAM", "30"))
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class Job:
+    """Controllo schedulato: esegue `funzione` a intervallo fisso o a un orario giornaliero (HH:MM)."""
+
+    def __init__(self, nome, funzione, intervallo=None, orario=None):
+        self.nome = nome
+        self.funzione = funzione
+        self.intervallo = intervallo # int oppure callable che restituisce i secondi
+        self.orario = orario
+        self.prossima_esecuzione = 0.0
+
+    def calcola_prossima(self, adesso):
+        """Restituisce il timestamp (time.time()) della prossima esecuzione dopo `adesso`."""
+        if self.orario:
+            ore, minuti = (int(x) for x in self.orario.split(":"))
+            ora_corrente = datetime.fromtimestamp(adesso)
+            prossima = ora_corrente.replace(hour=ore, minute=minuti, second=0, microsecond=0)
+            if prossima <= ora_corrente:
+                prossima += timedelta(days=1)
+            return prossima.timestamp()
+        intervallo = self.intervallo() if callable(self.intervallo) else self.intervallo
+        return adesso + intervallo
+
+    def esegui(self):
+        inizio = time.monotonic()
+        try:
+            self.funzione()
+        except Exception as e:
+            # Un job fallito non deve fermare il daemon: logga e ripianifica
+            logging.error(f"[Daemon] Errore imprevisto nel job '{self.nome}': {e}", exc_info=True)
+            metrics.incrementa("meteo_job_errori_totale", job=self.nome)
+        durata = time.monotonic() - inizio
+        metrics.osserva("meteo_job_secondi", durata, job=self.nome)
+        metrics.imposta("meteo_job_ultima_esecuzione", time.time(), job=self.nome)
+        logging.info(f"[Daemon] Job '{self.nome}' completato in {durata:.1f}s")
+
+        if not self.orario:
+            intervallo = self.intervallo() if callable(self.intervallo) else self.intervallo
+            if durata > intervallo:
+                metrics.incrementa("meteo_job_sforamenti_totale", job=self.nome)
+                logging.warning(f"[Daemon] Job '{self.nome}' durato {durata:.1f}s, oltre il suo intervallo di {intervallo}s")
+            elif durata > intervallo * QUOTA_AVVISO_DURATA:
+                logging.warning(f"[Daemon] Job '{self.nome}' durato {durata:.1f}s, oltre l'{QUOTA_AVVISO_DURATA:.0%} del suo intervallo di {intervallo}s")
+
+
+class ControlloSoglie:
+    """
+    Job soglie con modalità piena: finché lo stato soglie (threshold_state) ha
+    coppie sopra soglia, o c'è un'allerta di velocità di crescita attiva
+    (rate_of_rise), il polling passa a INTERVALLO_SOGLIE_PIENA.
+    Vengono inviate solo le transizioni (superamenti, aggravamenti, rientri);
+    gli errori di fetch al massimo una volta ogni INTERVALLO_ERRORI.
+    Ogni intervallo_report secondi (0 = mai) lo stesso passaggio del motore
+    produce anche il report stazioni.
+    """
+
+    def __init__(self, intervallo_normale, intervallo_piena, intervallo_errori, intervallo_report=0):
+        self.intervallo_normale = intervallo_normale
+        self.intervallo_piena = intervallo_piena
+        self.intervallo_errori = intervallo_errori
+        self.intervallo_report = intervallo_report
+        self.in_piena = self._in_piena()
+        self.ultimo_errore = None
+        self.prossimo_report = 0.0
+
+    def intervallo(self):
+        return self.intervallo_piena if self.in_piena else self.intervallo_normale
+
+    def _in_piena(self):
+        return station_engine.stato_soglie().ha_soglie_superate() or rate_of_rise.motore().ha_allerte_attive()
+
+    def __call__(self):
+        modi = [station_engine.MODO_ALLERTE]
+        adesso = time.monotonic()
+        report_dovuto = self.intervallo_report > 0 and adesso >= self.prossimo_report
+        if report_dovuto:
+            modi.append(station_engine.MODO_IDRO)
+        risultati = station_engine.esegui(modi)
+
+        # Prima le variazioni (urgenti), poi il report
+        self.notifica(*risultati[station_engine.MODO_ALLERTE])
+        if report_dovuto:
+            self.prossimo_report = adesso + self.intervallo_report
+            station_checker_idro.pubblica_report(*risultati[station_engine.MODO_IDRO])
+
+    def notifica(self, dict_variazioni, errore_fetch):
+        if errore_fetch:
+            # In piena si continua col polling veloce, ma l'errore non viene ripetuto a ogni ciclo
+            adesso = time.monotonic()
+            if self.ultimo_errore is None or adesso - self.ultimo_errore >= self.intervallo_errori:
+                station_checker.invia_errore_fetch(errore_fetch)
+                self.ultimo_errore = adesso
+        else:
+            self.ultimo_errore = None
+
+        # Con RETEMIR non raggiungibile il motore valuta l'ultima copia valida: l'errore è
+        # notificato sopra, le eventuali variazioni di quei dati vanno comunque inviate
+
+        if any(dict_variazioni.values()):
+            station_checker.invia_variazioni_soglie(dict_variazioni)
+
+        soglie_superate = self._in_piena()
+        if soglie_superate != self.in_piena:
+            logging.warning(f"[Daemon] Modalità piena {'ATTIVATA' if soglie_superate else 'disattivata'}: "
+                            f"polling RETEMIR ogni {self.intervallo_piena if soglie_superate else self.intervallo_normale}s")
+        self.in_piena = soglie_superate
+
+
+def crea_jobs():
+    """Costruisce la lista dei job abilitati in base alla configurazione."""
+    jobs = []
+    if INTERVALLO_SOGLIE > 0:
+        controllo_soglie = ControlloSoglie(INTERVALLO_SOGLIE, INTERVALLO_SOGLIE_PIENA, INTERVALLO_ERRORI, INTERVALLO_REPORT)
+        jobs.append(Job("soglie", controllo_soglie, intervallo=controllo_soglie.intervallo))
+    elif INTERVALLO_REPORT > 0:
+        jobs.append(Job("report", station_checker_idro.esegui_report_stazioni, intervallo=INTERVALLO_REPORT))
+    if INTERVALLO_WEATHERLINK > 0:
+        missing = weather_alert.segreti_mancanti()
+        if missing:
+            logging.warning(f"[Daemon] Job 'weatherlink' disabilitato, secrets mancanti: {', '.join(missing)}")
+        else:
+            jobs.append(Job("weatherlink", weather_alert.run_weather_check, intervallo=INTERVALLO_WEATHERLINK))
+    if ORA_ALLERTE:
+        jobs.append(Job("allerte", alert_checker.esegui_controllo_allerte, orario=ORA_ALLERTE))
+    if INTERVALLO_TELEGRAM > 0 and station_checker.TELEGRAM_BOT_TOKEN:
+        # Solo i retry già scaduti: il job non deve bloccare lo scheduler in attesa di un retry_after
+        coda_telegram = telegram_queue.coda(station_checker.TELEGRAM_BOT_TOKEN)
+        jobs.append(Job("telegram", lambda: coda_telegram.svuota(attesa_massima=0), intervallo=INTERVALLO_TELEGRAM))
+    return jobs
+
+
+def esegui_daemon(jobs, stop_event):
+    """Loop dello scheduler: esegue il job più urgente e attende il successivo finché stop_event non è impostato."""
+    adesso = time.time()
+    for job in jobs:
+        # I job a intervallo partono subito, quelli a orario alla prossima occorrenza
+        job.prossima_esecuzione = job.calcola_prossima(adesso) if job.orario else adesso
+        logging.info(f"[Daemon] Job '{job.nome}' pianificato per {datetime.fromtimestamp(job.prossima_esecuzione).strftime('%d/%m/%Y %H:%M:%S')}")
+
+    while not stop_event.is_set():
+        job = min(jobs, key=lambda j: j.prossima_esecuzione)
+        attesa = job.prossima_esecuzione - time.time()
+        if attesa > 0:
+            stop_event.wait(attesa)
+            continue
+        job.esegui()
+        job.prossima_esecuzione = job.calcola_prossima(time.time())
+
+
+if __name__ == "__main__":
+    logging.info("--- [Daemon] Avvio daemon monitoraggio Meteo Marche ---")
+
+    if not station_checker.TELEGRAM_BOT_TOKEN or not len(subscriptions.registro()):
+        logging.critical("[Daemon] Errore: Credenziali Telegram mancanti (token o chat/sottoscrizioni)."); exit(1)
+
+    # Carica e valida le soglie prima del primo ciclo, poi segue le modifiche al file
+    try:
+        threshold_config.avvia_osservatore()
+    except threshold_config.ConfigSoglieNonValida as e:
+        logging.critical(f"[Daemon] Errore: {e}."); exit(1)
+    metrics.avvia()
+
+    jobs = crea_jobs()
+    if not jobs:
+        logging.critical("[Daemon] Nessun job abilitato, controllare la configurazione."); exit(1)
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+    esegui_daemon(jobs, stop_event)
+    logging.info("--- [Daemon] Daemon arrestato ---")
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Velocità di crescita dei livelli idrometrici su finestre mobili (30/60/180 min).
+
+Per ogni sensore (codice stazione, tipoSens) il motore mantiene una deque per
+finestra: ogni nuovo campione viene accodato e i campioni usciti dalla
+finestra vengono scartati dalla testa, quindi l'aggiornamento costa O(1)
+ammortizzato e la velocità (m/h) si calcola dagli estremi della finestra,
+senza mai ripercorrere lo storico.
+
+Lo stato resta in memoria tra un tick e l'altro del daemon. Nelle esecuzioni
+one-shot, alla prima lettura di un sensore le finestre vengono ricostruite
+dall'archivio storico (readings_archive), così le transizioni sono coerenti
+anche senza processo residente.
+
+Un'allerta attiva rientra solo con una velocità calcolata sotto soglia. Se la
+finestra perde copertura (buco nei dati) l'allerta viene dimenticata senza
+notifica, e scadi() toglie quelle dei sensori che non mandano più campioni
+(stazione assente, valore non valido, soglia tolta) da più di
+COPERTURA_MASSIMA × durata della finestra: senza questo il daemon resterebbe
+in polling rapido per sempre.
+"""
+import time
+import logging
+from collections import deque
+
+import readings_archive
+import threshold_state
+
+FINESTRE_MINUTI = (30, 60, 180)
+# Frazione minima della finestra che deve essere coperta dai campioni per calcolare la velocità
+COPERTURA_MINIMA = 0.5
+# Oltre questa frazione della finestra il campione di partenza (prima di un buco nei dati) non si usa
+COPERTURA_MASSIMA = 1.5
+
+
+class FinestraMobile:
+    """Campioni (timestamp, valore) che coprono gli ultimi `durata` secondi."""
+
+    __slots__ = ("durata", "campioni")
+
+    def __init__(self, durata):
+        self.durata = durata
+        self.campioni = deque()
+
+    def aggiungi(self, timestamp, valore):
+        self.campioni.append((timestamp, valore))
+        # Tiene come primo campione l'ultimo che precede (o coincide con) l'inizio della finestra
+        limite = timestamp - self.durata
+        while len(self.campioni) > 1 and self.campioni[1][0] <= limite:
+            self.campioni.popleft()
+
+    def velocita(self):
+        """
+        Variazione oraria tra il primo e l'ultimo campione, o None se la finestra non è abbastanza coperta.
+        Se il primo campione è più vecchio di COPERTURA_MASSIMA × durata si parte dal primo dentro la finestra.
+        """
+        if len(self.campioni) < 2:
+            return None
+        (t0, v0), (t1, v1) = self.campioni[0], self.campioni[-1]
+        if t1 - t0 > self.durata * COPERTURA_MASSIMA:
+            if len(self.campioni) < 3:
+                return None
+            t0, v0 = self.campioni[1]
+        if t1 - t0 < self.durata * COPERTURA_MINIMA:
+            return None
+        return (v1 - v0) * 3600.0 / (t1 - t0)
+
+
+class MotoreVelocitaCrescita:
+    """Finestre mobili per sensore e allerte di velocità attualmente attive."""
+
+    def __init__(self, archivio=None, finestre_minuti=FINESTRE_MINUTI):
+        self.archivio = archivio
+        self.finestre_minuti = finestre_minuti
+        self._finestre = {} # (codice, tipo_sens) -> {minuti: FinestraMobile}
+        self._ultimo_timestamp = {}
+        self.attive = set() # (codice, tipo_sens, minuti) con velocità sopra soglia
+
+    def _inizializza(self, chiave, soglie_finestre, prima_di):
+        self._finestre[chiave] = {minuti: FinestraMobile(minuti * 60) for minuti in self.finestre_minuti}
+        if self.archivio is None:
+            return
+        # Ricostruisce le finestre (e le allerte attive) dallo storico precedente al campione corrente
+        ore = max(self.finestre_minuti) / 60.0
+        storico = self.archivio.ultime_ore(chiave[0], chiave[1], ore, adesso=prima_di - 1)
+        for timestamp, valore in zip(storico["timestamp"].tolist(), storico["valore"].tolist()):
+            if valore == valore: # scarta NaN
+                self._applica(chiave, timestamp, valore, soglie_finestre)
+        logging.debug(f"[Velocità] Finestre {chiave} ricostruite da {len(storico)} campioni d'archivio")
+
+    def _applica(self, chiave, timestamp, valore, soglie_finestre):
+        self._ultimo_timestamp[chiave] = timestamp
+        eventi = []
+        for minuti, finestra in self._finestre[chiave].items():
+            finestra.aggiungi(timestamp, valore)
+            soglia = soglie_finestre.get(minuti)
+            if soglia is None:
+                continue
+            velocita = finestra.velocita()
+            chiave_allerta = (chiave[0], chiave[1], minuti)
+            if velocita is not None and velocita > soglia:
+                if chiave_allerta not in self.attive:
+                    self.attive.add(chiave_allerta)
+                    eventi.append((threshold_state.EVENTO_SUPERAMENTO, minuti, velocita, soglia))
+            elif chiave_allerta in self.attive:
+                self.attive.discard(chiave_allerta)
+                if velocita is not None:
+                    eventi.append((threshold_state.EVENTO_RIENTRO, minuti, velocita, soglia))
+                else:
+                    logging.warning(f"[Velocità] Allerta {chiave_allerta} dimenticata: finestra non più coperta dai campioni")
+        return eventi
+
+    def aggiorna(self, codice, tipo_sens, timestamp, valore, soglie_finestre):
+        """
+        Registra un campione e restituisce la lista di eventi (evento, minuti, velocita_m_h, soglia)
+        per le finestre che superano o rientrano dalla propria soglia.
+        I campioni già visti (timestamp non successivo all'ultimo) vengono ignorati.
+        """
+        chiave = (codice, tipo_sens)
+        if chiave not in self._finestre:
+            self._inizializza(chiave, soglie_finestre, timestamp)
+        if timestamp <= self._ultimo_timestamp.get(chiave, -1):
+            return []
+        return self._applica(chiave, timestamp, valore, soglie_finestre)
+
+    def scadi(self, adesso=None):
+        """
+        Toglie le allerte dei sensori senza campioni da più di COPERTURA_MASSIMA × durata della finestra
+        (la velocità non si potrebbe più calcolare). Restituisce le chiavi (codice, tipo_sens, minuti) rimosse.
+        """
+        adesso = time.time() if adesso is None else adesso
+        scadute = [chiave_allerta for chiave_allerta in self.attive
+                   if adesso - self._ultimo_timestamp.get(chiave_allerta[:2], adesso) > chiave_allerta[2] * 60 * COPERTURA_MASSIMA]
+        self.attive.difference_update(scadute)
+        return scadute
+
+    def ha_allerte_attive(self):
+        return bool(self.attive)
+
+
+# Istanza condivisa tra i job dello stesso processo, come readings_archive.archivio()
+_motore = None
+
+
+def motore():
+    """Restituisce il motore condiviso, agganciato all'archivio storico per la ricostruzione delle finestre."""
+    global _motore
+    if _motore is None:
+        try:
+            archivio = readings_archive.archivio()
+        except Exception as e:
+            logging.error(f"[Velocità] Archivio non disponibile, finestre solo in memoria: {e}")
+            archivio = None
+        _motore = MotoreVelocitaCrescita(archivio)
+    return _motore
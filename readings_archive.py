@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Archivio storico append-only delle letture RETEMIR.
+
+Ogni campione (codice stazione, tipoSens, timestamp, valore, trend) è un record
+binario a dimensione fissa (DTYPE_LETTURA, 22 byte) accodato al file della
+partizione giornaliera ARCHIVIO_LETTURE_DIR/AAAA-MM-GG.bin. Le query leggono le
+partizioni con np.memmap, quindi l'occupazione di memoria resta minima anche
+con mesi di storico.
+
+L'archivio è alimentato dal fetch già eseguito dagli script stazioni (nessuna
+chiamata HTTP aggiuntiva); i campioni con lo stesso lastUpdateTime già
+archiviato vengono scartati, così il polling frequente non crea duplicati.
+Più processi (daemon e bot) possono scrivere nella stessa cartella: la
+scrittura di una partizione avviene sotto lock esclusivo sul file, dopo aver
+letto i record accodati dagli altri processi, quindi la deduplica per
+(codice, tipoSens, timestamp) vale anche tra processi diversi.
+"""
+import os
+import time
+import fcntl
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import snapshot_eval
+
+ARCHIVIO_DIR = os.environ.get("ARCHIVIO_LETTURE_DIR",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "archivio_letture"))
+
+DTYPE_LETTURA = np.dtype([
+    ("codice", "<i4"),
+    ("tipo_sens", "<i2"),
+    ("timestamp", "<i8"), # secondi epoch di lastUpdateTime
+    ("valore", "<f4"),
+    ("trend", "<f4"),
+])
+
+# Formati di lastUpdateTime provati in ordine (oltre a ISO 8601)
+FORMATI_DATA = ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M")
+
+
+def parse_timestamp(last_update, default=None):
+    """Converte lastUpdateTime in secondi epoch (ora locale); restituisce `default` se non interpretabile."""
+    if last_update:
+        try:
+            return int(datetime.fromisoformat(str(last_update).replace("Z", "+00:00")).timestamp())
+        except ValueError:
+            pass
+        for formato in FORMATI_DATA:
+            try:
+                return int(datetime.strptime(str(last_update), formato).timestamp())
+            except ValueError:
+                continue
+    return default
+
+
+class ArchivioLetture:
+    """Archivio partizionato per giorno; vedi aggiungi_stazioni() e ultime_ore()."""
+
+    def __init__(self, cartella=ARCHIVIO_DIR):
+        self.cartella = cartella
+        os.makedirs(cartella, exist_ok=True)
+        # Ultimo timestamp archiviato per chiave (codice, tipoSens), per scartare i duplicati
+        self._ultimo_timestamp = {}
+        self._letti = {} # percorso partizione -> byte già considerati in _ultimo_timestamp
+        adesso = time.time()
+        for giorno in (adesso - 86400, adesso):
+            self._carica_ultimi_timestamp(self._percorso_partizione(giorno))
+
+    def _percorso_partizione(self, timestamp):
+        return os.path.join(self.cartella, datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d") + ".bin")
+
+    def _leggi_partizione(self, percorso):
+        if not os.path.exists(percorso) or os.path.getsize(percorso) < DTYPE_LETTURA.itemsize:
+            return np.empty(0, dtype=DTYPE_LETTURA)
+        # Ignora un eventuale record troncato in coda (scrittura interrotta)
+        n_record = os.path.getsize(percorso) // DTYPE_LETTURA.itemsize
+        return np.memmap(percorso, dtype=DTYPE_LETTURA, mode="r", shape=(n_record,))
+
+    def _carica_ultimi_timestamp(self, percorso):
+        letture = self._leggi_partizione(percorso)
+        self._aggiorna_ultimi_timestamp(letture)
+        self._letti[percorso] = len(letture) * DTYPE_LETTURA.itemsize
+
+    def _aggiorna_ultimi_timestamp(self, letture):
+        for codice, tipo_sens, timestamp in zip(letture["codice"].tolist(), letture["tipo_sens"].tolist(), letture["timestamp"].tolist()):
+            chiave = (codice, tipo_sens)
+            if timestamp > self._ultimo_timestamp.get(chiave, -1):
+                self._ultimo_timestamp[chiave] = timestamp
+
+    def _leggi_accodati(self, f, percorso):
+        """Legge dal file aperto i record accodati (anche da altri processi) dopo l'ultima lettura."""
+        inizio = self._letti.get(percorso, 0)
+        fine = f.seek(0, os.SEEK_END)
+        n_record = (fine - inizio) // DTYPE_LETTURA.itemsize
+        if n_record > 0:
+            f.seek(inizio)
+            self._aggiorna_ultimi_timestamp(np.frombuffer(f.read(n_record * DTYPE_LETTURA.itemsize), dtype=DTYPE_LETTURA))
+            self._letti[percorso] = inizio + n_record * DTYPE_LETTURA.itemsize
+
+    def _accoda(self, percorso, letture):
+        """Accoda alla partizione le letture non ancora archiviate, sotto lock esclusivo; restituisce quante ne ha scritte."""
+        with open(percorso, "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX) # rilasciato alla chiusura del file
+            self._leggi_accodati(f, percorso)
+            nuove = np.zeros(len(letture), dtype=bool)
+            for i, (codice, tipo_sens, timestamp) in enumerate(zip(letture["codice"].tolist(), letture["tipo_sens"].tolist(), letture["timestamp"].tolist())):
+                if timestamp > self._ultimo_timestamp.get((codice, tipo_sens), -1):
+                    self._ultimo_timestamp[(codice, tipo_sens)] = timestamp
+                    nuove[i] = True
+            if nuove.any():
+                f.write(letture[nuove].tobytes())
+                f.flush()
+                self._letti[percorso] = f.tell()
+        return int(nuove.sum())
+
+    def aggiungi_stazioni(self, stazioni):
+        """
+        Archivia tutti i sensori delle stazioni fornite come (nome_stazione, nome_bacino, record API).
+        Restituisce il numero di campioni nuovi scritti.
+        """
+        adesso = int(time.time())
+        codici, tipi, timestamps, valori_raw, trend_raw = [], [], [], [], []
+        for _, _, record in stazioni:
+            codice = record.get("codice")
+            if codice is None:
+                continue
+            timestamp = parse_timestamp(record.get("lastUpdateTime"), default=adesso)
+            for sensore in record.get("analog") or ():
+                tipo_sens = sensore.get("tipoSens")
+                # Primo filtro sullo stato in memoria; quello definitivo è in _accoda(), sotto lock
+                if tipo_sens is None or timestamp <= self._ultimo_timestamp.get((codice, tipo_sens), -1):
+                    continue
+                codici.append(codice); tipi.append(tipo_sens); timestamps.append(timestamp)
+                valori_raw.append(sensore.get("valore")); trend_raw.append(sensore.get("trend"))
+
+        if not codici:
+            return 0
+
+        letture = np.empty(len(codici), dtype=DTYPE_LETTURA)
+        letture["codice"] = codici
+        letture["tipo_sens"] = tipi
+        letture["timestamp"] = timestamps
+        letture["valore"] = snapshot_eval.converti_colonna_float(valori_raw)[0]
+        letture["trend"] = snapshot_eval.converti_colonna_float(trend_raw)[0]
+
+        # Un'unica scrittura in append per partizione giornaliera
+        giorni = np.array([datetime.fromtimestamp(ts).strftime("%Y-%m-%d") for ts in timestamps])
+        scritti = sum(self._accoda(os.path.join(self.cartella, f"{giorno}.bin"), letture[giorni == giorno])
+                      for giorno in np.unique(giorni))
+        logging.info(f"[Archivio] Archiviati {scritti} nuovi campioni in {self.cartella}")
+        return scritti
+
+    def ultime_ore(self, codice, tipo_sens, ore, adesso=None):
+        """
+        Restituisce i campioni delle ultime `ore` ore per (codice stazione, tipoSens),
+        come array strutturato DTYPE_LETTURA ordinato per timestamp.
+        """
+        adesso = time.time() if adesso is None else adesso
+        inizio = adesso - ore * 3600
+        risultati = []
+        giorno = datetime.fromtimestamp(inizio).replace(hour=0, minute=0, second=0, microsecond=0)
+        while giorno.timestamp() <= adesso:
+            letture = self._leggi_partizione(self._percorso_partizione(giorno.timestamp()))
+            if len(letture):
+                maschera = ((letture["codice"] == codice) & (letture["tipo_sens"] == tipo_sens)
+                            & (letture["timestamp"] >= inizio) & (letture["timestamp"] <= adesso))
+                risultati.append(np.array(letture[maschera]))
+            giorno += timedelta(days=1)
+
+        if not risultati:
+            return np.empty(0, dtype=DTYPE_LETTURA)
+        campioni = np.concatenate(risultati)
+        return campioni[np.argsort(campioni["timestamp"], kind="stable")]
+
+
+# Istanza condivisa tra gli script caricati nello stesso processo (es. daemon),
+# così la deduplica vale anche tra job diversi
+_archivio = None
+
+
+def archivio():
+    """Restituisce l'archivio condiviso, creandolo alla prima richiesta."""
+    global _archivio
+    if _archivio is None:
+        _archivio = ArchivioLetture()
+    return _archivio
+
+
+def archivia_stazioni(stazioni):
+    """Accoda le letture all'archivio condiviso; un errore di archiviazione non deve bloccare gli alert."""
+    try:
+        return archivio().aggiungi_stazioni(stazioni)
+    except Exception as e:
+        logging.error(f"[Archivio] Errore archiviazione letture: {e}", exc_info=True)
+        return 0
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Resa dei risultati valutati in più formati, da un'unica valutazione.
+
+Gli script valutano lo snapshot una volta e costruiscono un report immutabile
+(ReportStazioni / ReportAllerte, con record già ordinati e orario di
+generazione); ogni renderer lo trasforma nel proprio formato senza ricalcolare:
+  - MARKDOWN     Telegram Markdown legacy (il formato inviato finora)
+  - MARKDOWN_V2  Telegram MarkdownV2 (escape con weather_alert.escape_markdown)
+  - JSON         dati strutturati per sistemi a valle, niente parsing del testo Telegram
+  - HTML         pagina dashboard statica
+pubblica() scrive i formati di REPORT_FORMATI (default "json,html") nella
+cartella REPORT_DIR, con scrittura atomica; se REPORT_DIR non è impostata
+la pubblicazione su file è disattivata.
+
+Uso: python renderers.py [formato]   valuta una volta, stampa il formato
+                                     (default markdown) e pubblica i file
+"""
+import os
+import sys
+import json
+import html
+import logging
+import tempfile
+from datetime import datetime
+from dataclasses import asdict
+from collections import namedtuple, defaultdict
+
+import alert_records
+import weather_alert
+
+PERCORSO_REPORT = os.environ.get("REPORT_DIR", "")
+FORMATI_FILE = [formato.strip() for formato in os.environ.get("REPORT_FORMATI", "json,html").split(",") if formato.strip()]
+
+# Report immutabili prodotti da una valutazione; i dizionari hanno liste già ordinate per rango stazione
+# obsoleto_da: età in secondi dei dati se il servizio non risponde e si usa l'ultima copia valida, altrimenti None
+ReportStazioni = namedtuple("ReportStazioni", ["generato", "soglie_per_bacino", "valori_per_bacino", "errore_fetch", "bacini", "obsoleto_da"])
+ReportAllerte = namedtuple("ReportAllerte", ["generato", "allerte_per_area", "errore_fetch", "aree", "obsoleto_da"])
+
+
+def report_stazioni(soglie_per_bacino, valori_per_bacino, errore_fetch, bacini, generato=None, obsoleto_da=None):
+    """Congela il risultato di check_stazioni_full_report() ordinando una sola volta i record di ogni bacino."""
+    return ReportStazioni(
+        generato or datetime.now(),
+        defaultdict(list, {bacino: alert_records.ordina(records) for bacino, records in soglie_per_bacino.items()}),
+        defaultdict(list, {bacino: alert_records.ordina(records) for bacino, records in valori_per_bacino.items()}),
+        errore_fetch, list(bacini), obsoleto_da)
+
+
+def report_allerte(allerte_per_area, errore_fetch, aree, generato=None, obsoleto_da=None):
+    """Congela il risultato di alert_checker.valuta_allerte_domani() ({area: [eventi formattati]})."""
+    return ReportAllerte(generato or datetime.now(), dict(allerte_per_area), errore_fetch, list(aree), obsoleto_da)
+
+
+def _avviso(report):
+    """Avviso di dati non aggiornati del report, stringa vuota se i dati sono freschi."""
+    return alert_records.avviso_obsoleto(report.obsoleto_da) if report.obsoleto_da is not None else ""
+
+
+def _selezione(tutte, richieste):
+    """Chiavi richieste nell'ordine del report (tutte se richieste è None)."""
+    return list(tutte) if richieste is None else [chiave for chiave in tutte if chiave in richieste]
+
+
+class RendererTelegram:
+    """Messaggi Telegram nello Stile indicato (Markdown legacy o MarkdownV2)."""
+
+    def __init__(self, stile, parse_mode):
+        self.stile = stile
+        self.parse_mode = parse_mode
+
+    def stazioni(self, report, bacini=None):
+        """Report stazioni limitato ai bacini indicati (nell'ordine del report)."""
+        g, t = self.stile.grassetto, self.stile.testo
+        bacini = _selezione(report.bacini, bacini)
+        timestamp = report.generato.strftime("%d/%m/%Y %H:%M:%S")
+        parti = [g(f"{'='*5} Report Stazioni ({timestamp}) {'='*5}")]
+        if _avviso(report):
+            parti.append("\n" + g(_avviso(report)))
+
+        if report.errore_fetch:
+            parti.append("\n\n" + t(report.errore_fetch))
+        else:
+            ha_soglie_superate = any(report.soglie_per_bacino[bacino] for bacino in bacini)
+            ha_valori_attuali = any(report.valori_per_bacino[bacino] for bacino in bacini)
+
+            # 1. Sezione Soglie Superate (raggruppata per bacino, stazioni nell'ordine del bacino)
+            if ha_soglie_superate:
+                parti.append("\n\n" + g("--- ‼️ SOGLIE SUPERATE ‼️ ---"))
+                for bacino in bacini:
+                    if report.soglie_per_bacino[bacino]:
+                        parti.append("\n\n" + g(f"- Bacino {bacino} -"))
+                        parti.extend(alert_records.formatta_allerta(a, self.stile) for a in report.soglie_per_bacino[bacino])
+                parti.append(" ")
+
+            # 2. Sezione Valori Attuali Monitorati
+            if ha_valori_attuali:
+                parti.append("\n\n" + g("--- VALORI ATTUALI MONITORATI ---"))
+                for bacino in bacini:
+                    if report.valori_per_bacino[bacino]:
+                        parti.append("\n\n" + g(f"- Bacino {bacino} -"))
+                        parti.extend(alert_records.formatta_valori_stazione(v, self.stile) for v in report.valori_per_bacino[bacino])
+            elif not ha_soglie_superate:
+                parti.append("\n\n" + t("✅ Nessuna soglia superata e nessun dato monitorato rilevante al momento."))
+
+        parti.append("\n\n" + g("=" * 30))
+        return "\n".join(parti)
+
+    def allerte(self, report, aree=None):
+        """Messaggio di stato allerte di DOMANI (errore, allerte rilevanti o nessuna allerta) per le aree indicate."""
+        g, t = self.stile.grassetto, self.stile.testo
+        aree = report.aree if aree is None else list(aree)
+        timestamp = report.generato.strftime("%d/%m/%Y %H:%M:%S")
+        footer = "\n\n" + g("=" * 30)
+        if _avviso(report):
+            footer = "\n\n" + g(_avviso(report)) + footer
+
+        if report.errore_fetch:
+            return g(f"{'='*5} ERRORE Recupero Allerte DOMANI ({timestamp}) {'='*5}") + "\n\n" + t(report.errore_fetch) + footer
+
+        righe_aree = [t("  - ") + g(f"Area {area}") + t(":\n    " + "\n    ".join(eventi))
+                      for area, eventi in report.allerte_per_area.items() if area in aree]
+        if righe_aree:
+            return (g(f"{'='*5} Report ALLERTE RILEVANTI DOMANI ({timestamp}) {'='*5}") + "\n\n"
+                    + t("🚨 ") + g("Allerte Meteo RILEVANTI per DOMANI:") + "\n" + "\n".join(righe_aree) + footer)
+
+        testo_ok = (f"✅ Nessuna allerta meteo rilevante (diversa da verde/bianco) "
+                    f"prevista per DOMANI nelle aree monitorate "
+                    f"({', '.join(aree)}).")
+        return g(f"{'='*5} Report ALLERTE DOMANI ({timestamp}) {'='*5}") + "\n\n" + t(testo_ok) + footer
+
+
+class RendererJSON:
+    """Documento JSON con i record strutturati, per sistemi a valle."""
+    estensione = "json"
+
+    def stazioni(self, report, bacini=None):
+        return json.dumps({
+            "generato": report.generato.isoformat(timespec="seconds"),
+            "errore_fetch": report.errore_fetch,
+            "obsoleto_da": report.obsoleto_da,
+            "bacini": [{
+                "bacino": bacino,
+                "soglie_superate": [asdict(allerta) for allerta in report.soglie_per_bacino[bacino]],
+                "stazioni": [asdict(valori) for valori in report.valori_per_bacino[bacino]],
+            } for bacino in _selezione(report.bacini, bacini)],
+        }, ensure_ascii=False, indent=2)
+
+    def allerte(self, report, aree=None):
+        aree = report.aree if aree is None else list(aree)
+        return json.dumps({
+            "generato": report.generato.isoformat(timespec="seconds"),
+            "errore_fetch": report.errore_fetch,
+            "obsoleto_da": report.obsoleto_da,
+            "aree_monitorate": aree,
+            "allerte": [{"area": area, "eventi": eventi} for area, eventi in report.allerte_per_area.items() if area in aree],
+        }, ensure_ascii=False, indent=2)
+
+
+class RendererHTML:
+    """Pagina HTML statica (dashboard) senza dipendenze esterne."""
+    estensione = "html"
+
+    PAGINA = """<!DOCTYPE html>
+<html lang="it">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{titolo}</title>
+<style>
+body {{ font-family: sans-serif; margin: 1.5em; color: #222; }}
+table {{ border-collapse: collapse; margin-bottom: 1.5em; }}
+th, td {{ border: 1px solid #ccc; padding: 0.3em 0.6em; text-align: left; }}
+th {{ background: #eee; }}
+.superata {{ background: #fdd; font-weight: bold; }}
+.errore {{ color: #b00; font-weight: bold; }}
+</style>
+</head>
+<body>
+<h1>{titolo}</h1>
+<p>Aggiornato: {generato}</p>
+{corpo}
+</body>
+</html>
+"""
+
+    def _pagina(self, titolo, report, corpo):
+        if _avviso(report):
+            corpo = f'<p class="errore">{html.escape(_avviso(report))}</p>\n' + corpo
+        return self.PAGINA.format(titolo=html.escape(titolo), generato=report.generato.strftime("%d/%m/%Y %H:%M:%S"), corpo=corpo)
+
+    def stazioni(self, report, bacini=None):
+        if report.errore_fetch:
+            return self._pagina("Report Stazioni", report, f'<p class="errore">{html.escape(report.errore_fetch)}</p>')
+
+        e = html.escape
+        blocchi = []
+        for bacino in _selezione(report.bacini, bacini):
+            if not report.valori_per_bacino[bacino]:
+                continue
+            # Sensori con soglia superata, per evidenziare la riga corrispondente
+            superate = {(a.stazione, a.tipo_sens) for a in report.soglie_per_bacino[bacino]}
+            righe = []
+            for valori in report.valori_per_bacino[bacino]:
+                if valori.nota:
+                    righe.append(f'<tr class="superata"><td>{e(valori.stazione)}</td><td colspan="4">{e(valori.nota)}</td></tr>')
+                for lettura in valori.letture:
+                    if lettura.non_numerico:
+                        valore = f"{e(str(lettura.valore_raw))} (non numerico)"
+                    elif lettura.valore is None:
+                        valore = "N/D"
+                    else:
+                        valore = e(f"{lettura.valore:.2f} {lettura.unmis} {lettura.trend}".strip())
+                    classe = ' class="superata"' if (valori.stazione, lettura.tipo_sens) in superate else ""
+                    righe.append(f"<tr{classe}><td>{e(valori.stazione)}</td><td>{e(lettura.sensore)}</td><td>{valore}</td>"
+                                 f"<td>{e(f'{lettura.soglia} {lettura.unmis}')}</td><td>{e(str(valori.ultimo_agg))}</td></tr>")
+            blocchi.append(f"<h2>Bacino {e(bacino)}</h2>\n<table>\n"
+                           "<tr><th>Stazione</th><th>Sensore</th><th>Valore</th><th>Soglia</th><th>Ultimo agg.</th></tr>\n"
+                           + "\n".join(righe) + "\n</table>")
+        corpo = "\n".join(blocchi) or "<p>✅ Nessun dato monitorato rilevante al momento.</p>"
+        return self._pagina("Report Stazioni", report, corpo)
+
+    def allerte(self, report, aree=None):
+        if report.errore_fetch:
+            return self._pagina("Allerte Meteo DOMANI", report, f'<p class="errore">{html.escape(report.errore_fetch)}</p>')
+
+        aree = report.aree if aree is None else list(aree)
+        voci = [f"<li><b>Area {html.escape(str(area))}</b><ul>" + "".join(f"<li>{html.escape(evento)}</li>" for evento in eventi) + "</ul></li>"
+                for area, eventi in report.allerte_per_area.items() if area in aree]
+        corpo = ("<ul>\n" + "\n".join(voci) + "\n</ul>") if voci else \
+            f"<p>✅ Nessuna allerta meteo rilevante prevista per DOMANI nelle aree monitorate ({html.escape(', '.join(aree))}).</p>"
+        return self._pagina("Allerte Meteo DOMANI", report, corpo)
+
+
+# Stile MarkdownV2: ogni carattere speciale del testo va preceduto da "\"
+STILE_MARKDOWN_V2 = alert_records.Stile(lambda testo: f"*{weather_alert.escape_markdown(testo)}*", weather_alert.escape_markdown)
+
+MARKDOWN = RendererTelegram(alert_records.MARKDOWN, "Markdown")
+MARKDOWN_V2 = RendererTelegram(STILE_MARKDOWN_V2, "MarkdownV2")
+JSON = RendererJSON()
+HTML = RendererHTML()
+RENDERER = {"markdown": MARKDOWN, "markdownv2": MARKDOWN_V2, "json": JSON, "html": HTML}
+
+
+def _scrivi_atomico(percorso, testo):
+    """Scrive su file temporaneo e rinomina: chi legge (es. un web server) non vede mai file a metà."""
+    cartella = os.path.dirname(percorso)
+    fd, temporaneo = tempfile.mkstemp(dir=cartella, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(testo)
+        os.replace(temporaneo, percorso)
+    except BaseException:
+        os.unlink(temporaneo)
+        raise
+
+
+def pubblica(nome, report, percorso=PERCORSO_REPORT, formati=FORMATI_FILE):
+    """
+    Scrive il report nei formati su file (es. stazioni_idro.json, stazioni_idro.html in REPORT_DIR).
+    Il tipo di report (stazioni/allerte) dipende dal report passato. Restituisce i percorsi scritti.
+    """
+    if not percorso:
+        return []
+    os.makedirs(percorso, exist_ok=True)
+    scritti = []
+    for formato in formati:
+        renderer = RENDERER.get(formato)
+        if renderer is None or not hasattr(renderer, "estensione"):
+            logging.error(f"[Renderer] Formato file '{formato}' non supportato (REPORT_FORMATI)")
+            continue
+        testo = renderer.allerte(report) if isinstance(report, ReportAllerte) else renderer.stazioni(report)
+        destinazione = os.path.join(percorso, f"{nome}.{renderer.estensione}")
+        try:
+            _scrivi_atomico(destinazione, testo)
+            scritti.append(destinazione)
+        except OSError as e:
+            logging.error(f"[Renderer] Errore scrittura {destinazione}: {e}")
+    logging.info(f"[Renderer] Report '{nome}' pubblicato: {', '.join(scritti) or 'nessun file'}")
+    return scritti
+
+
+if __name__ == "__main__":
+    import station_engine
+    import alert_checker
+
+    formato = sys.argv[1] if len(sys.argv) > 1 else "markdown"
+    if formato not in RENDERER:
+        sys.exit(f"Formato non supportato: {formato} (disponibili: {', '.join(RENDERER)})")
+
+    soglie, valori, errore_stazioni, obsoleto_stazioni = station_engine.esegui([station_engine.MODO_IDRO])[station_engine.MODO_IDRO]
+    stazioni = report_stazioni(soglie, valori, errore_stazioni, station_engine.ORDINE_BACINI, obsoleto_da=obsoleto_stazioni)
+    allerte_per_area, errore_allerte, obsoleto_allerte = alert_checker.valuta_allerte_domani()
+    allerte = report_allerte(allerte_per_area, errore_allerte, alert_checker.AREE_INTERESSATE_ALLERTE, obsoleto_da=obsoleto_allerte)
+    print(RENDERER[formato].stazioni(stazioni))
+    print(RENDERER[formato].allerte(allerte))
+    pubblica("stazioni_idro", stazioni)
+    pubblica("allerte", allerte)
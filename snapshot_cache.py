@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Cache condivisa dei payload con TTL e single-flight.
+
+Tutti gli script che girano nello stesso processo (daemon, bot) chiedono il
+payload RETEMIR (o il bollettino allerte) a questa cache invece di scaricarlo
+ognuno per conto proprio:
+  - entro SNAPSHOT_TTL secondi dall'ultimo download il payload viene riusato;
+  - se un download è già in corso, le richieste concorrenti attendono quello
+    invece di aprirne un altro (single-flight); un errore viene propagato a
+    tutti i richiedenti e non viene messo in cache.
+Il payload decodificato è unico per versione (conditional_fetch), quindi
+report soglie e report completo lavorano sullo stesso snapshot; ogni
+consumatore mantiene comunque il proprio flag `invariato`.
+
+Se il servizio non risponde (errore di rete, timeout, HTTP, circuito aperto:
+vedi circuit_breaker) e l'ultima copia valida ha meno di SNAPSHOT_MAX_OBSOLETO
+secondi (default 3600, 0 = mai), viene servita quella con `obsoleto_da`
+impostato invece di propagare l'errore.
+"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+import requests
+
+import conditional_fetch
+import metrics
+
+TTL = float(os.environ.get("SNAPSHOT_TTL", "60"))
+MAX_OBSOLETO = float(os.environ.get("SNAPSHOT_MAX_OBSOLETO", "3600"))
+
+
+class CacheSnapshot:
+    """Ultimo download (versione, body) per URL, con TTL e un solo download in volo per URL."""
+
+    def __init__(self, fetcher, ttl=TTL, max_obsoleto=MAX_OBSOLETO):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.max_obsoleto = max_obsoleto
+        self._lock = threading.Lock()
+        self._voci = {} # url -> (istante time.monotonic(), versione, body)
+        self._in_volo = {} # url -> Future del download in corso
+
+    def ottieni(self, url, consumatore, **kwargs):
+        """
+        Restituisce il RisultatoFetch per il consumatore, scaricando il payload solo se
+        la copia in cache è scaduta. kwargs (timeout, verify, headers) vanno a conditional_fetch.
+        Se il download fallisce serve l'ultima copia valida (obsoleta) entro max_obsoleto secondi.
+        """
+        with self._lock:
+            voce = self._voci.get(url)
+            if voce is not None and time.monotonic() - voce[0] < self.ttl:
+                logging.info(f"[Cache Snapshot] {url} servito dalla cache ({time.monotonic() - voce[0]:.0f}s) a '{consumatore}'")
+                return self.fetcher.risultato(url, consumatore, voce[1], voce[2])
+            futuro = self._in_volo.get(url)
+            capofila = futuro is None
+            if capofila:
+                futuro = self._in_volo[url] = Future()
+
+        if not capofila:
+            logging.info(f"[Cache Snapshot] '{consumatore}' attende il download in corso di {url}")
+            try:
+                versione, body = futuro.result()
+            except requests.exceptions.RequestException as e:
+                return self._copia_obsoleta(url, consumatore, e)
+            return self.fetcher.risultato(url, consumatore, versione, body)
+
+        try:
+            versione, body = self.fetcher.scarica(url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            futuro.set_exception(e)
+            return self._copia_obsoleta(url, consumatore, e)
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        else:
+            with self._lock:
+                # Un 304 non ha body: si conserva quello della voce precedente, se c'è
+                if body is None and voce is not None and voce[1] == versione:
+                    body = voce[2]
+                self._voci[url] = (time.monotonic(), versione, body)
+            futuro.set_result((versione, body))
+        finally:
+            with self._lock:
+                self._in_volo.pop(url, None)
+        return self.fetcher.risultato(url, consumatore, versione, body)
+
+    def _copia_obsoleta(self, url, consumatore, errore):
+        """RisultatoFetch dall'ultima copia valida dopo un download fallito; rilancia l'errore se non c'è o è troppo vecchia."""
+        with self._lock:
+            voce = self._voci.get(url)
+        if voce is None or voce[2] is None:
+            raise errore
+        eta = time.monotonic() - voce[0]
+        if eta > self.max_obsoleto:
+            raise errore
+        logging.warning(f"[Cache Snapshot] {url} non disponibile ({errore}), servita a '{consumatore}' la copia di {eta:.0f}s fa")
+        metrics.incrementa("meteo_snapshot_obsoleti_totale", host=urlsplit(url).netloc)
+        return self.fetcher.risultato(url, consumatore, voce[1], voce[2], obsoleto_da=eta)
+
+    def invalida(self, url=None):
+        """Scarta la copia in cache di un URL (o di tutti), forzando il prossimo download."""
+        with self._lock:
+            if url is None:
+                self._voci.clear()
+            else:
+                self._voci.pop(url, None)
+
+
+# Cache condivisa dagli script caricati nello stesso processo
+_cache = None
+_lock_cache = threading.Lock()
+
+
+def cache():
+    global _cache
+    with _lock_cache:
+        if _cache is None:
+            _cache = CacheSnapshot(conditional_fetch.fetcher())
+        return _cache
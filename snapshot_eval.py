@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Valutazione vettoriale dello snapshot RETEMIR (rt-data).
+
+Le stazioni monitorate vengono trasformate una sola volta in colonne NumPy,
+una riga per ogni sensore con soglia (codice stazione, tipoSens, valore,
+trend, soglia). Conversione dei valori, controllo delle soglie e
+classificazione del trend (📈/📉/➡️/❓) sono poi operazioni vettoriali, così il
+costo della valutazione resta piatto anche monitorando tutta la rete.
+Le stringhe per i messaggi vengono costruite solo per le righe da mostrare.
+"""
+import logging
+
+import numpy as np
+
+# Sotto questa soglia (in valore assoluto) il trend è considerato stabile
+TOLLERANZA_TREND = 1e-9
+
+TREND_NESSUNO, TREND_SALITA, TREND_DISCESA, TREND_STABILE, TREND_ERRORE = range(5)
+SIMBOLI_TREND = ("", "📈", "📉", "➡️", "❓")
+
+# Moltiplicatore per la chiave intera (codice stazione, tipoSens), vedi chiavi_sensore()
+BASE_CHIAVE_SENSORE = 1024
+
+
+def converti_colonna_float(valori_raw):
+    """
+    Converte una colonna di valori grezzi (stringhe, numeri, None) in float64.
+    Restituisce (valori, non_numerici): assenti, "" e "nan" diventano NaN;
+    le stringhe non convertibili diventano NaN e sono marcate in non_numerici.
+    """
+    colonna = np.array(valori_raw, dtype=object)
+    non_numerici = np.zeros(len(colonna), dtype=bool)
+    if len(colonna) == 0:
+        return np.empty(0, dtype=np.float64), non_numerici
+    colonna[colonna == ""] = None
+    try:
+        return colonna.astype(np.float64), non_numerici
+    except (ValueError, TypeError):
+        # Percorso lento solo se c'è almeno un valore sporco nello snapshot
+        valori = np.empty(len(colonna), dtype=np.float64)
+        for i, valore in enumerate(colonna):
+            try:
+                valori[i] = np.nan if valore is None else float(valore)
+            except (ValueError, TypeError):
+                valori[i] = np.nan
+                non_numerici[i] = True
+        return valori, non_numerici
+
+
+class SnapshotColonnare:
+    """
+    Snapshot delle stazioni monitorate in forma colonnare.
+
+    Colonne per riga (un sensore con soglia): stazione (indice in `stazioni`),
+    codice, tipo_sens, valore, trend, soglia (con voci_soglia), più i risultati della valutazione:
+    valido, non_numerico, superata, trend_idx (indice in SIMBOLI_TREND).
+    """
+
+    def __init__(self, stazioni, riga_stazione, codice, tipo_sens, voci_soglia, sensori, valori_raw, trend_raw):
+        self.stazioni = stazioni # lista di (nome_stazione, nome_bacino, record)
+        self.stazione = np.asarray(riga_stazione, dtype=np.int32)
+        self.codice = np.asarray(codice, dtype=np.int64)
+        self.tipo_sens = np.asarray(tipo_sens, dtype=np.int64)
+        self.voci_soglia = voci_soglia # VoceSoglia (soglia, sorgente) originali, per il rendering
+        self.soglia = np.fromiter((voce.soglia for voce in voci_soglia), dtype=np.float64, count=len(voci_soglia))
+        self.sensori = sensori # dizionari sensore originali, usati solo in fase di rendering
+
+        self.valore, self.non_numerico = converti_colonna_float(valori_raw)
+        # Trend assente (None) -> NaN -> "➡️" stabile, come nel controllo originale
+        self.trend, self._trend_non_numerico = converti_colonna_float(trend_raw)
+
+    def valuta(self, sensori_trend):
+        """Calcola validità, superamenti e simbolo di trend per tutte le righe in un colpo solo."""
+        self.valido = ~np.isnan(self.valore)
+        self.superata = self.valido & (self.valore > self.soglia)
+
+        idrometrico = self.valido & np.isin(self.tipo_sens, list(sensori_trend))
+        self.trend_idx = np.select(
+            [
+                idrometrico & self._trend_non_numerico,
+                idrometrico & (self.trend > TOLLERANZA_TREND),
+                idrometrico & (self.trend < -TOLLERANZA_TREND),
+                idrometrico,
+            ],
+            [TREND_ERRORE, TREND_SALITA, TREND_DISCESA, TREND_STABILE],
+            default=TREND_NESSUNO,
+        ).astype(np.int8)
+
+        for i in np.flatnonzero(self.non_numerico):
+            logging.warning(f"[Snapshot] Valore non numerico '{self.sensori[i].get('valore')}' sens {self.tipo_sens[i]} staz {self.nome_stazione(i)}")
+        for i in np.flatnonzero(idrometrico & self._trend_non_numerico):
+            logging.warning(f"[Snapshot] Err conv trend '{self.sensori[i].get('trend')}' sens {self.tipo_sens[i]} staz {self.nome_stazione(i)}")
+        return self
+
+    def __len__(self):
+        return len(self.codice)
+
+    def chiavi_sensore(self):
+        """Chiave intera per riga (codice * BASE_CHIAVE_SENSORE + tipoSens), utile per np.isin."""
+        return self.codice * BASE_CHIAVE_SENSORE + self.tipo_sens
+
+    def nome_stazione(self, riga):
+        return self.stazioni[self.stazione[riga]][0]
+
+    def simbolo_trend(self, riga):
+        return SIMBOLI_TREND[self.trend_idx[riga]]
+
+    def blocchi_stazione(self):
+        """Genera (nome_stazione, nome_bacino, record, righe) per ogni stazione, nell'ordine dei dati API."""
+        confini = np.flatnonzero(np.diff(self.stazione)) + 1
+        for righe in np.split(np.arange(len(self)), confini):
+            if len(righe):
+                nome_stazione, nome_bacino, record = self.stazioni[self.stazione[righe[0]]]
+                yield nome_stazione, nome_bacino, record, righe
+
+
+def costruisci_snapshot(stazioni, indice_soglie, sensori_trend):
+    """
+    Costruisce e valuta lo snapshot colonnare.
+    `stazioni` è una lista di (nome_stazione, nome_bacino, record API) già filtrate;
+    entrano nelle colonne solo i sensori che hanno una soglia in `indice_soglie`.
+    """
+    riga_stazione, codice, tipo_sens, voci_soglia, sensori, valori_raw, trend_raw = ([] for _ in range(7))
+
+    for idx_stazione, (nome_stazione, _, record) in enumerate(stazioni):
+        codice_stazione = record.get("codice")
+        if not indice_soglie.ha_soglie(codice_stazione):
+            continue
+        for sensore in record.get("analog") or ():
+            voce_soglia = indice_soglie.cerca(codice_stazione, sensore.get("tipoSens"))
+            if voce_soglia is None:
+                continue
+            riga_stazione.append(idx_stazione)
+            codice.append(codice_stazione)
+            tipo_sens.append(sensore.get("tipoSens"))
+            voci_soglia.append(voce_soglia)
+            sensori.append(sensore)
+            valori_raw.append(sensore.get("valore"))
+            trend_raw.append(sensore.get("trend"))
+
+    snapshot = SnapshotColonnare(stazioni, riga_stazione, codice, tipo_sens, voci_soglia, sensori, valori_raw, trend_raw)
+    return snapshot.valuta(sensori_trend)
@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+"""
+Motore unico di valutazione delle stazioni RETEMIR.
+
+station_checker, station_checker_idro e station_checker_full_report erano
+copie quasi identiche (configurazione stazioni, fetch, filtro, valutazione)
+che differivano solo per le soglie usate e per l'output. Qui la pipeline è
+una sola, con tre modi selezionabili:
+  - allerte   -> transizioni soglie, velocità di crescita e stazioni ferme
+                 (threshold_state, rate_of_rise, station_updates);
+  - idro      -> report dei soli livelli idrometrici (100/101);
+  - completo  -> report di tutti i sensori con soglia.
+
+esegui(modi) produce tutti i modi richiesti con un solo passaggio sui dati:
+un fetch, un filtro stazioni, un'archiviazione e un'unica valutazione
+vettoriale (snapshot_eval) con l'indice soglie più ampio tra quelli dei modi;
+ogni modo legge poi solo le righe che gli competono. Ogni modo mantiene il
+proprio consumatore conditional_fetch (il flag `invariato`) e la propria cache
+dell'ultimo report, quindi può essere eseguito anche da solo.
+
+Gli script station_checker* restano come involucri sottili (invio Telegram,
+live, pubblicazione) attorno a questo modulo.
+
+Uso: python station_engine.py [allerte] [idro] [completo]   (default: tutti)
+"""
+import os
+import sys
+import json
+import logging
+from collections import namedtuple, defaultdict
+
+import requests
+import urllib3
+import numpy as np
+
+import threshold_config
+import threshold_state
+import snapshot_eval
+import readings_archive
+import rate_of_rise
+import conditional_fetch
+import snapshot_cache
+import station_updates
+import station_registry
+import alert_records
+import metrics
+
+# --- Configurazione Stazioni ---
+# Base URL sovrascrivibile per i test offline (mock_server)
+RETEMIR_BASE_URL = os.environ.get("RETEMIR_BASE_URL", "https://retemir.regione.marche.it").rstrip("/")
+URL_STAZIONI = f"{RETEMIR_BASE_URL}/api/stations/rt-data"
+
+# Mappa delle stazioni ai rispettivi bacini
+BACINI_STAZIONI = {
+    # Bacino Misa
+    "Arcevia": "Misa",
+    "Serra dei Conti": "Misa",
+    "Barbara": "Misa",
+    "Pianello di Ostra": "Misa",
+    "Misa": "Misa",
+    "Senigallia": "Misa",
+    "Ponte Garibaldi": "Misa",
+    # Bacino Nevola
+    "Corinaldo": "Nevola",
+    "Nevola": "Nevola",
+    "Passo Ripe": "Nevola",
+    # Bacino Cesano
+    "Cesano": "Cesano",
+    "Foce Cesano": "Cesano"
+}
+# Lista stazioni di interesse (deriva direttamente dalla mappa dei bacini)
+STAZIONI_INTERESSATE = list(BACINI_STAZIONI.keys())
+
+# Ordine delle stazioni all'interno di ogni bacino
+ORDINE_STAZIONI_PER_BACINO = {
+    "Misa": ["Arcevia", "Serra dei Conti", "Barbara", "Pianello di Ostra", "Misa", "Senigallia", "Ponte Garibaldi"],
+    "Nevola": ["Corinaldo", "Nevola", "Passo Ripe"],
+    "Cesano": ["Cesano", "Foce Cesano"],
+    "Altri Bacini": [] # Per eventuali stazioni non mappate
+}
+# Ordine dei bacini nei messaggi
+ORDINE_BACINI = ["Misa", "Nevola", "Cesano", "Altri Bacini"]
+
+# Codici RETEMIR fissati per nome: servono quando più stazioni hanno lo stesso nome
+# (due "Arcevia" nel payload); le altre stazioni vengono associate per nome al primo fetch.
+# Altri codici si fissano in CODICI_STAZIONI_JSON, es. '{"Barbara": 745}' (prevale sui predefiniti)
+CODICI_STAZIONI = {"Arcevia": 732,
+                   **{nome: int(codice) for nome, codice in json.loads(os.environ.get("CODICI_STAZIONI_JSON") or "{}").items()}}
+
+DESCRIZIONI_SENSORI = {
+    0: "Pioggia TOT Oggi", 1: "Intensità Pioggia mm/min", 5: "Temperatura Aria",
+    6: "Umidità Relativa", 8: "Pressione Atmosferica", 9: "Direzione Vento",
+    10: "Velocità Vento", 100: "Livello Idrometrico", 101: "Livello Idrometrico 2",
+    7: "Radiazione Globale", 107: "Livello Neve"
+}
+
+# Soglie (generiche, per stazione, velocità di crescita) in THRESHOLDS_JSON.txt, vedi threshold_config
+
+# Sensori idrometrici per cui si calcola il trend
+SENSORI_IDROMETRICI_TREND = [100, 101]
+
+# Anagrafica per codice: il filtro del payload è un lookup intero per record (station_registry)
+REGISTRO_STAZIONI = station_registry.RegistroStazioni(BACINI_STAZIONI, CODICI_STAZIONI)
+
+# Rango intero di ogni stazione nel proprio bacino, per l'ordinamento dei record (alert_records)
+RANGHI_STAZIONI = alert_records.compila_ranghi(ORDINE_STAZIONI_PER_BACINO)
+
+ERRORE_FETCH = "⚠️ Impossibile recuperare dati stazioni meteo."
+
+MODO_ALLERTE = "allerte"
+MODO_IDRO = "idro"
+MODO_COMPLETO = "completo"
+
+# consumatore: nome registrato in conditional_fetch (lo stesso degli script storici,
+# così le versioni già confermate restano valide); sensori: tipi con soglia (None = tutti)
+Modo = namedtuple("Modo", ["nome", "consumatore", "sensori"])
+MODI = {
+    MODO_ALLERTE: Modo(MODO_ALLERTE, "station_checker", None),
+    MODO_IDRO: Modo(MODO_IDRO, "station_checker_idro", (100, 101)),
+    MODO_COMPLETO: Modo(MODO_COMPLETO, "station_checker_full_report", None),
+}
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Disabilita avvisi SSL per verify=False
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# Stato persistente delle soglie superate, aperto alla prima richiesta
+_stato_soglie = None
+
+# Registro dell'ultimo lastUpdateTime elaborato per stazione, aperto alla prima richiesta
+_registro_aggiornamenti = None
+
+# Ultimo report per modo {modo: (indice soglie, risultato di componi_report)}, riusato se payload e soglie non cambiano
+_ultimi_report = {}
+
+
+def stato_soglie():
+    """Restituisce lo store dello stato soglie (threshold_state.StatoSoglie), aprendolo se necessario."""
+    global _stato_soglie
+    if _stato_soglie is None:
+        _stato_soglie = threshold_state.StatoSoglie()
+    return _stato_soglie
+
+def registro_aggiornamenti():
+    """Restituisce il registro degli aggiornamenti stazione (station_updates.RegistroAggiornamenti), aprendolo se necessario."""
+    global _registro_aggiornamenti
+    if _registro_aggiornamenti is None:
+        _registro_aggiornamenti = station_updates.RegistroAggiornamenti()
+    return _registro_aggiornamenti
+
+def fetch_data(url, consumatore):
+    """Fetch tramite la cache condivisa (snapshot_cache + conditional_fetch): restituisce un RisultatoFetch, None in caso di errore."""
+    try:
+        logging.warning(f"[Motore Stazioni] Tentativo richiesta STAZIONI a {url} con verify=False.")
+        risultato = snapshot_cache.cache().ottieni(url, consumatore, timeout=45, verify=False)
+        if risultato.obsoleto:
+            logging.warning(f"[Motore Stazioni] RETEMIR non disponibile: uso dei dati di {risultato.obsoleto_da:.0f}s fa (versione {risultato.versione[:8]})")
+        else:
+            logging.info(f"[Motore Stazioni] Richiesta STAZIONI a {url} - Versione: {risultato.versione[:8]}")
+        return risultato
+    except requests.exceptions.Timeout as e: logging.error(f"[Motore Stazioni] Timeout: {e}"); return None
+    except requests.exceptions.HTTPError as e: logging.error(f"[Motore Stazioni] Errore HTTP: {e.response.status_code} - {e.response.text[:200]}..."); return None
+    except requests.exceptions.ConnectionError as e: logging.error(f"[Motore Stazioni] Errore Conn: {e}"); return None
+    except requests.exceptions.RequestException as e: logging.error(f"[Motore Stazioni] Errore Req: {e}"); return None
+    except Exception as e: logging.error(f"[Motore Stazioni] Errore Imprevisto Fetch: {e}", exc_info=True); return None
+
+def descrizione_sensore(sensore, tipoSens):
+    return sensore.get("descr", DESCRIZIONI_SENSORI.get(tipoSens, f"Sensore {tipoSens}")).strip()
+
+def risultato_vuoto(modo, errore_fetch=None):
+    """Risultato di un modo senza dati: (soglie, errore) per le allerte, (soglie, valori, errore, None) per i report."""
+    if modo == MODO_ALLERTE:
+        return (defaultdict(list), errore_fetch)
+    return (defaultdict(list), defaultdict(list), errore_fetch, None)
+
+def errore_obsoleto(obsoleto_da):
+    """
+    Errore fetch del modo allerte quando RETEMIR non risponde e si valuta l'ultima copia valida:
+    il disservizio va notificato anche se la valutazione prosegue. None se i dati sono freschi.
+    """
+    if obsoleto_da is None:
+        return None
+    return f"{ERRORE_FETCH} {alert_records.avviso_obsoleto(obsoleto_da)}"
+
+def errore_soglie():
+    """Motivo per cui non c'è una configurazione soglie valida (threshold_config), None se caricata: per l'avvio degli script."""
+    try:
+        threshold_config.soglie()
+    except threshold_config.ConfigSoglieNonValida as e:
+        return str(e)
+    return None
+
+def filtra_stazioni(data):
+    """Stazioni di interesse del payload come (nome_stazione, nome_bacino, record), nell'ordine dei dati API."""
+    return [(voce.nome, voce.bacino, record) for voce, record in REGISTRO_STAZIONI.filtra(data)]
+
+
+# --- Esecuzione dei modi ---
+def esegui(modi):
+    """
+    Esegue i modi richiesti (MODO_*) con un solo fetch e una sola valutazione.
+    Restituisce {modo: risultato}: (soglie_per_bacino, errore_fetch) per MODO_ALLERTE,
+    (soglie_per_bacino, valori_per_bacino, errore_fetch, obsoleto_da) per i report, con record alert_records.
+    Se RETEMIR non risponde e viene valutata l'ultima copia valida, obsoleto_da ne è l'età in secondi
+    (None con dati freschi) e il modo allerte riporta comunque l'errore fetch (errore_obsoleto).
+    """
+    modi = list(dict.fromkeys(modi))
+    risultati = {}
+
+    logging.info(f"[Motore Stazioni] Controllo dati stazioni da {URL_STAZIONI} (modi: {', '.join(modi)})...")
+    risultato = fetch_data(URL_STAZIONI, MODI[modi[0]].consumatore)
+    if risultato is None:
+        return {modo: risultato_vuoto(modo, ERRORE_FETCH) for modo in modi}
+    obsoleto_da = risultato.obsoleto_da
+    errore_allerte = errore_obsoleto(obsoleto_da)
+
+    # Stesso download, flag `invariato` del consumatore di ogni modo
+    fetch_modi = {modo: risultato if modo == modi[0] else
+                  conditional_fetch.fetcher().risultato(risultato.url, MODI[modo].consumatore, risultato.versione, risultato.body)
+                  for modo in modi}
+    # Indice soglie della configurazione corrente, lo stesso per tutto il ciclo anche se il file viene ricaricato
+    indici = {modo: threshold_config.indice_soglie(STAZIONI_INTERESSATE, REGISTRO_STAZIONI, MODI[modo].sensori) for modo in modi}
+
+    pendenti = []
+    for modo in modi:
+        if not fetch_modi[modo].invariato:
+            pendenti.append(modo)
+        elif modo == MODO_ALLERTE:
+            # Payload identico a quello già elaborato: nessuna transizione possibile, niente decodifica né valutazione
+            logging.info("[Motore Stazioni] Dati stazioni invariati dall'ultimo controllo allerte.")
+            soglie_per_bacino = defaultdict(list)
+            controlla_stazioni_ferme([], soglie_per_bacino)
+            # Nessuna lettura nuova: le coppie sopra soglia possono solo scadere
+            scadi_soglie_assenti(set(), indici[MODO_ALLERTE])
+            scadi_velocita_ferme()
+            risultati[modo] = (soglie_per_bacino, errore_allerte)
+        elif modo in _ultimi_report and _ultimi_report[modo][0] is indici[modo]:
+            logging.info(f"[Motore Stazioni] Dati stazioni invariati, riuso dell'ultimo report '{modo}'.")
+            risultati[modo] = _ultimi_report[modo][1] + (obsoleto_da,)
+        else:
+            pendenti.append(modo)
+    if not pendenti:
+        return risultati
+
+    # Le stazioni fuori dal registro vengono scartate già in decodifica, senza costruirne i sensori
+    data = risultato.dati_filtrati(REGISTRO_STAZIONI.da_tenere)
+    if data is None:
+        risultati.update((modo, risultato_vuoto(modo, ERRORE_FETCH)) for modo in pendenti)
+        return risultati
+
+    with metrics.misura("meteo_motore_stadio_secondi", stadio="filtro"):
+        stazioni = filtra_stazioni(data)
+    if not stazioni:
+        logging.info("[Motore Stazioni] Nessuna stazione di interesse trovata nei dati API.")
+
+    # Valutazione unica con l'indice più ampio tra quelli dei modi da eseguire
+    tipi_modi = [MODI[modo].sensori for modo in pendenti]
+    indice_valutazione = threshold_config.indice_soglie(STAZIONI_INTERESSATE, REGISTRO_STAZIONI,
+                                                        None if None in tipi_modi else set().union(*tipi_modi))
+    stazioni_valutate = [voce for voce in stazioni if voce[2].get("analog") and indice_valutazione.ha_soglie(voce[2].get("codice"))]
+
+    if MODO_ALLERTE in pendenti:
+        # Stazioni il cui dato non è avanzato dall'ultimo controllo: nessuna transizione possibile
+        registro = registro_aggiornamenti()
+        stazioni_aggiornate = [voce for voce in stazioni if registro.avanzata(voce[2].get("codice"), voce[2].get("lastUpdateTime"))]
+        id_aggiornate = {id(voce[2]) for voce in stazioni_aggiornate}
+        monitorate_allerte = [voce for voce in stazioni_valutate
+                              if id(voce[2]) in id_aggiornate and indici[MODO_ALLERTE].ha_soglie(voce[2].get("codice"))]
+        soglie_allerte = defaultdict(list)
+        # Velocità di crescita: va aggiornata prima di archiviare, così le finestre si ricostruiscono dallo storico precedente
+        controlla_velocita_crescita(monitorate_allerte, soglie_allerte)
+        scadi_velocita_ferme()
+
+    # Archivia le letture di tutte le stazioni di interesse del payload, anche senza soglie nei modi eseguiti
+    # (stesso fetch, nessuna chiamata aggiuntiva)
+    with metrics.misura("meteo_motore_stadio_secondi", stadio="archivio"):
+        readings_archive.archivia_stazioni(stazioni)
+
+    # Valutazione vettoriale di tutti i sensori con soglia (valori, superamenti, trend)
+    with metrics.misura("meteo_motore_stadio_secondi", stadio="valutazione"):
+        snapshot = snapshot_eval.costruisci_snapshot(stazioni_valutate, indice_valutazione, SENSORI_IDROMETRICI_TREND)
+    metrics.incrementa("meteo_stazioni_valutate_totale", len(stazioni_valutate))
+    metrics.incrementa("meteo_sensori_valutati_totale", len(snapshot))
+
+    for modo in pendenti:
+        sensori = MODI[modo].sensori
+        righe_modo = np.isin(snapshot.tipo_sens, sensori) if sensori is not None else np.ones(len(snapshot), dtype=bool)
+        if modo == MODO_ALLERTE:
+            with metrics.misura("meteo_motore_stadio_secondi", stadio="transizioni"):
+                stazione_aggiornata = np.fromiter((id(voce[2]) in id_aggiornate for voce in snapshot.stazioni), dtype=bool, count=len(snapshot.stazioni))
+                valuta_transizioni(snapshot, righe_modo & stazione_aggiornata[snapshot.stazione], soglie_allerte)
+                righe_lette = righe_modo & snapshot.valido
+                scadi_soglie_assenti(set(zip(snapshot.codice[righe_lette].tolist(), snapshot.tipo_sens[righe_lette].tolist())),
+                                     indici[MODO_ALLERTE])
+                controlla_stazioni_ferme(stazioni_aggiornate, soglie_allerte)
+            logging.info(f"[Motore Stazioni] Stazioni aggiornate: {len(stazioni_aggiornate)}, valutate per le allerte: {len(monitorate_allerte)}")
+            for allerte in soglie_allerte.values():
+                for allerta in allerte:
+                    metrics.incrementa("meteo_allerte_totale", fonte="stazioni", evento=allerta.categoria)
+            risultati[modo] = (soglie_allerte, errore_allerte)
+        else:
+            with metrics.misura("meteo_motore_stadio_secondi", stadio=f"report_{modo}"):
+                report = componi_report(snapshot, righe_modo)
+                aggiungi_stazioni_escluse(REGISTRO_STAZIONI.escluse, indici[modo], report[1])
+            _ultimi_report[modo] = (indici[modo], report)
+            risultati[modo] = report + (obsoleto_da,)
+        # Segna il payload come elaborato per il consumatore del modo
+        conditional_fetch.fetcher().conferma(fetch_modi[modo])
+
+    return risultati
+
+def valuta_transizioni(snapshot, righe_modo, soglie_per_bacino):
+    """
+    Registra in threshold_state le transizioni (superamento, aggravamento, rientro) delle righe
+    selezionate e aggiunge i relativi alert_records.Allerta a soglie_per_bacino.
+    """
+    # Solo le righe che possono generare una transizione: sopra soglia ora o nell'esecuzione precedente
+    chiavi_attive = np.fromiter((codice * snapshot_eval.BASE_CHIAVE_SENSORE + tipo for codice, tipo in stato_soglie().chiavi()), dtype=np.int64)
+    candidate = righe_modo & snapshot.valido & (snapshot.superata | np.isin(snapshot.chiavi_sensore(), chiavi_attive))
+
+    for riga in np.flatnonzero(candidate):
+        nome_stazione, nome_bacino, stazione = snapshot.stazioni[snapshot.stazione[riga]]
+        tipoSens = int(snapshot.tipo_sens[riga]); valore_num = float(snapshot.valore[riga])
+        soglia_da_usare, sorgente_soglia = snapshot.voci_soglia[riga]
+
+        evento = stato_soglie().registra(int(snapshot.codice[riga]), tipoSens, valore_num, soglia_da_usare, nome_stazione)
+        if evento:
+            sensore = snapshot.sensori[riga]
+            allerta = alert_records.Allerta(
+                alert_records.CATEGORIA_SOGLIA, evento, nome_bacino, nome_stazione,
+                alert_records.rango_stazione(RANGHI_STAZIONI, nome_bacino, nome_stazione),
+                ultimo_agg=stazione.get("lastUpdateTime", "N/A"), sensore=descrizione_sensore(sensore, tipoSens),
+                tipo_sens=tipoSens, unmis=sensore.get("unmis", "").strip(), valore=valore_num,
+                soglia=soglia_da_usare, sorgente=sorgente_soglia, trend=snapshot.simbolo_trend(riga))
+            soglie_per_bacino[nome_bacino].append(allerta)
+            trend_display_alert = f" {allerta.trend}" if allerta.trend else ""
+            logging.warning(f"[Motore Stazioni] {evento.upper()} ({sorgente_soglia}): Bacino {nome_bacino} - {nome_stazione} - {allerta.sensore} = {valore_num}{trend_display_alert} (soglia {soglia_da_usare})")
+
+    # Salva le transizioni registrate in questo ciclo
+    stato_soglie().commit()
+
+def scadi_soglie_assenti(lette, indice):
+    """
+    Rimuove da threshold_state le coppie sopra soglia che non possono più avere un rientro: soglia tolta dalla
+    configurazione, oppure nessuna lettura valida (`lette`: coppie (codice, tipoSens) con valore valido nel ciclo)
+    da più di threshold_state.SCADENZA secondi.
+    """
+    if not stato_soglie().ha_soglie_superate():
+        return
+    rimosse = stato_soglie().aggiorna_assenti(lette, lambda nome, tipo: indice.cerca_nome(nome, tipo) is not None)
+    for codice, tipoSens, nome_stazione, motivo in rimosse:
+        logging.warning(f"[Motore Stazioni] Soglia superata di {nome_stazione} (codice {codice}, sens {tipoSens}) dimenticata: {motivo}")
+    stato_soglie().commit()
+
+def componi_report(snapshot, righe_modo):
+    """
+    Valori attuali e soglie superate delle righe selezionate, raggruppati per bacino:
+    (soglie_superate_per_bacino, valori_attuali_per_bacino, None) con record
+    alert_records.Allerta e alert_records.ValoriStazione. L'ordinamento è fatto dai renderers.
+    """
+    soglie_per_bacino = defaultdict(list)
+    valori_per_bacino = defaultdict(list)
+
+    for nome_stazione, nome_bacino, stazione, righe in snapshot.blocchi_stazione():
+        righe = righe[righe_modo[righe]]
+        if not len(righe):
+            continue
+        rango = alert_records.rango_stazione(RANGHI_STAZIONI, nome_bacino, nome_stazione)
+        valori_stazione = alert_records.ValoriStazione(nome_bacino, nome_stazione, rango, stazione.get("lastUpdateTime", "N/A"))
+
+        for riga in righe:
+            sensore = snapshot.sensori[riga]; tipoSens = int(snapshot.tipo_sens[riga])
+            soglia_da_usare, sorgente_soglia = snapshot.voci_soglia[riga]
+            lettura = alert_records.LetturaSensore(descrizione_sensore(sensore, tipoSens), tipoSens, sensore.get("unmis", "").strip(), soglia_da_usare)
+            valori_stazione.letture.append(lettura)
+
+            if snapshot.non_numerico[riga]:
+                lettura.non_numerico = True; lettura.valore_raw = sensore.get('valore')
+                continue
+
+            if snapshot.valido[riga]:
+                lettura.valore = float(snapshot.valore[riga])
+            lettura.trend = snapshot.simbolo_trend(riga)
+
+            if snapshot.superata[riga]:
+                soglie_per_bacino[nome_bacino].append(alert_records.Allerta(
+                    alert_records.CATEGORIA_SOGLIA, threshold_state.EVENTO_SUPERAMENTO, nome_bacino, nome_stazione, rango,
+                    ultimo_agg=valori_stazione.ultimo_agg, sensore=lettura.sensore, tipo_sens=tipoSens, unmis=lettura.unmis,
+                    valore=lettura.valore, soglia=soglia_da_usare, sorgente=sorgente_soglia, trend=lettura.trend))
+                trend_display_soglia = f" {lettura.trend}" if lettura.trend else ""
+                logging.warning(f"[Motore Stazioni] SOGLIA SUPERATA ({sorgente_soglia}): Bacino {nome_bacino} - {nome_stazione} - {lettura.sensore} = {lettura.valore}{trend_display_soglia} > {soglia_da_usare}")
+
+        valori_per_bacino[nome_bacino].append(valori_stazione)
+
+    return (soglie_per_bacino, valori_per_bacino, None)
+
+def aggiungi_stazioni_escluse(escluse, indice, valori_per_bacino):
+    """
+    Aggiunge ai valori del report le stazioni monitorate (con soglie nel modo) che il registro
+    ha scartato nell'ultimo payload (station_registry: collisione di nomi o assenza dai dati), con il motivo.
+    """
+    for nome_stazione, motivo in escluse.items():
+        if not indice.ha_soglie_nome(nome_stazione):
+            continue
+        nome_bacino = BACINI_STAZIONI.get(nome_stazione, "Altri Bacini")
+        valori_per_bacino[nome_bacino].append(alert_records.ValoriStazione(
+            nome_bacino, nome_stazione, alert_records.rango_stazione(RANGHI_STAZIONI, nome_bacino, nome_stazione),
+            nota=f"non valutata, {motivo}"))
+
+def controlla_velocita_crescita(stazioni_monitorate, soglie_per_bacino):
+    """
+    Aggiorna le finestre mobili di velocità (rate_of_rise) per i sensori con soglie di velocità
+    (soglie_velocita_crescita in threshold_config) e aggiunge a soglie_per_bacino gli alert
+    di superamento/rientro delle soglie di velocità.
+    """
+    soglie_velocita = threshold_config.soglie_velocita_crescita()
+    for nome_stazione, nome_bacino, stazione in stazioni_monitorate:
+        soglie_stazione = soglie_velocita.get(nome_stazione)
+        if not soglie_stazione:
+            continue
+        last_update = stazione.get("lastUpdateTime", "N/A")
+        timestamp = readings_archive.parse_timestamp(last_update)
+        if timestamp is None:
+            logging.warning(f"[Motore Stazioni] lastUpdateTime non interpretabile per {nome_stazione}: '{last_update}', velocità non calcolata")
+            continue
+
+        for sensore in stazione.get("analog", []):
+            tipoSens = sensore.get("tipoSens")
+            soglie_finestre = soglie_stazione.get(tipoSens)
+            if not soglie_finestre:
+                continue
+            try:
+                valore_num = float(sensore.get("valore"))
+            except (ValueError, TypeError):
+                continue
+            if valore_num != valore_num: # NaN
+                continue
+
+            for evento, minuti, velocita, soglia in rate_of_rise.motore().aggiorna(stazione.get("codice"), tipoSens, timestamp, valore_num, soglie_finestre):
+                descr_sens = descrizione_sensore(sensore, tipoSens)
+                soglie_per_bacino[nome_bacino].append(alert_records.Allerta(
+                    alert_records.CATEGORIA_VELOCITA, evento, nome_bacino, nome_stazione,
+                    alert_records.rango_stazione(RANGHI_STAZIONI, nome_bacino, nome_stazione),
+                    ultimo_agg=last_update, sensore=descr_sens, tipo_sens=tipoSens, unmis=sensore.get("unmis", "").strip(),
+                    valore=valore_num, soglia=soglia, minuti=minuti, velocita=velocita))
+                logging.warning(f"[Motore Stazioni] VELOCITÀ {evento.upper()}: Bacino {nome_bacino} - {nome_stazione} - {descr_sens} = {velocita:+.3f}/h su {minuti} min (soglia {soglia})")
+
+def scadi_velocita_ferme():
+    """Dimentica le allerte di velocità dei sensori che non mandano più campioni (rate_of_rise.MotoreVelocitaCrescita.scadi)."""
+    for codice, tipoSens, minuti in rate_of_rise.motore().scadi():
+        logging.warning(f"[Motore Stazioni] Allerta velocità su {minuti} min (codice {codice}, sens {tipoSens}) dimenticata: nessun campione recente")
+
+def controlla_stazioni_ferme(stazioni_aggiornate, soglie_per_bacino):
+    """
+    Registra come elaborate le stazioni aggiornate (station_updates) e aggiunge a soglie_per_bacino
+    gli avvisi operativi per le stazioni rimaste senza aggiornamenti o tornate ad aggiornarsi.
+    """
+    registro = registro_aggiornamenti()
+    for nome_stazione, nome_bacino, stazione in stazioni_aggiornate:
+        last_update = stazione.get("lastUpdateTime")
+        if registro.registra(stazione.get("codice"), nome_stazione, last_update) == station_updates.EVENTO_RIPRESA:
+            soglie_per_bacino[nome_bacino].append(alert_records.Allerta(
+                alert_records.CATEGORIA_STAZIONE, station_updates.EVENTO_RIPRESA, nome_bacino, nome_stazione,
+                alert_records.rango_stazione(RANGHI_STAZIONI, nome_bacino, nome_stazione), ultimo_agg=last_update or "N/A"))
+            logging.info(f"[Motore Stazioni] Stazione {nome_stazione} di nuovo aggiornata ({last_update})")
+
+    for codice, nome_stazione, last_update, minuti_fermo in registro.controlla_ferme():
+        nome_bacino = BACINI_STAZIONI.get(nome_stazione, "Altri Bacini")
+        soglie_per_bacino[nome_bacino].append(alert_records.Allerta(
+            alert_records.CATEGORIA_STAZIONE, station_updates.EVENTO_FERMA, nome_bacino, nome_stazione,
+            alert_records.rango_stazione(RANGHI_STAZIONI, nome_bacino, nome_stazione),
+            ultimo_agg=last_update or "N/A", minuti=minuti_fermo))
+        logging.warning(f"[Motore Stazioni] Stazione {nome_stazione} (codice {codice}) senza aggiornamenti da {minuti_fermo} min")
+    registro.commit()
+
+
+# --- Esecuzione combinata: un fetch e una valutazione per tutti i modi richiesti ---
+if __name__ == "__main__":
+    # Gli involucri importano questo modulo come station_engine: si passa da lì per condividerne lo stato
+    import station_engine
+    import station_checker
+    import station_checker_idro
+    import station_checker_full_report
+
+    modi = sys.argv[1:] or list(MODI)
+    sconosciuti = [modo for modo in modi if modo not in MODI]
+    if sconosciuti:
+        logging.critical(f"[Motore Stazioni] Modi sconosciuti: {', '.join(sconosciuti)} (ammessi: {', '.join(MODI)})"); exit(1)
+    if not station_checker.TELEGRAM_BOT_TOKEN:
+        logging.critical("[Motore Stazioni] Errore: TELEGRAM_BOT_TOKEN mancante."); exit(1)
+    errore_config = station_engine.errore_soglie()
+    if errore_config:
+        logging.critical(f"[Motore Stazioni] Errore: {errore_config}."); exit(1)
+
+    logging.info(f"--- [Motore Stazioni] Avvio controllo stazioni: {', '.join(modi)} ---")
+    risultati = station_engine.esegui(modi)
+    if MODO_ALLERTE in risultati:
+        station_checker.notifica_soglie(*risultati[MODO_ALLERTE])
+    if MODO_IDRO in risultati:
+        station_checker_idro.pubblica_report(*risultati[MODO_IDRO])
+    if MODO_COMPLETO in risultati:
+        station_checker_full_report.invia_report(*risultati[MODO_COMPLETO])
+    logging.info("--- [Motore Stazioni] Controllo stazioni completato ---")
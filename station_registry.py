@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Anagrafica delle stazioni di interesse indicizzata per codice RETEMIR.
+
+Il payload rt-data contiene tutte le stazioni della regione; di ogni record
+serve solo sapere se è una stazione monitorata e quale. Invece di confrontare
+nomi (strip, sottostringhe, eccezioni come le due stazioni "Arcevia") per
+ogni record, il registro tiene un dizionario codice -> AnagraficaStazione
+(nome visualizzato, bacino) e il filtro è un solo lookup intero:
+  - i codici fissati in configurazione (es. Arcevia -> 732) sono noti da subito;
+  - un codice mai visto viene associato per nome la prima volta che compare,
+    poi non si confronta più alcun nome;
+  - i codici che non corrispondono a nessuna stazione di interesse finiscono
+    nella cache negativa (stesso dizionario, valore None), così il resto
+    della rete costa un lookup come le stazioni monitorate.
+
+Collisioni: un nome fissato a un codice non viene mai associato ad altri
+codici. Se nello stesso payload due codici diversi hanno lo stesso nome non
+fissato, nessuno dei due viene associato (errore nei log, una volta): va
+fissato il codice giusto (CODICI_STAZIONI_JSON, vedi station_engine). Anche
+i codici scartati per collisione, o perché il nome è già associato a un
+codice presente, vanno nella cache negativa. Se una stazione cambia codice
+(il vecchio non compare più nel payload) il nome viene riassociato al nuovo:
+i codici scartati come doppioni di quel nome tornano sconosciuti e vengono
+riconsiderati dal payload successivo.
+
+Dopo ogni filtra(), `escluse` riporta {nome: motivo} delle stazioni di
+interesse assenti dal risultato (collisione o assenza dai dati), da mostrare
+nei report.
+"""
+import logging
+import threading
+from collections import namedtuple, defaultdict
+
+AnagraficaStazione = namedtuple("AnagraficaStazione", ["codice", "nome", "bacino"])
+
+BACINO_DEFAULT = "Altri Bacini"
+
+
+class RegistroStazioni:
+    """Codice RETEMIR -> AnagraficaStazione (None per le stazioni non di interesse)."""
+
+    def __init__(self, bacini_stazioni, codici_fissi=None):
+        self.bacini_stazioni = dict(bacini_stazioni)
+        self._lock = threading.Lock()
+        self._per_codice = {}
+        self._codice_per_nome = {} # nome -> codice associato
+        self._nomi_fissi = set()
+        self._collisioni_segnalate = set()
+        self._collisioni = {} # nome -> codici in collisione (tutti nella cache negativa)
+        self._doppioni = defaultdict(set) # nome -> codici scartati perché il nome era già associato
+        self.escluse = {} # nome -> motivo, per l'ultimo payload filtrato
+        for nome, codice in (codici_fissi or {}).items():
+            self._per_codice[codice] = AnagraficaStazione(codice, nome, self.bacini_stazioni.get(nome, BACINO_DEFAULT))
+            self._codice_per_nome[nome] = codice
+            self._nomi_fissi.add(nome)
+
+    def voce(self, codice):
+        """AnagraficaStazione del codice, None se non è (o non è ancora) associato a una stazione di interesse."""
+        return self._per_codice.get(codice)
+
+    def filtra(self, data):
+        """
+        Stazioni di interesse del payload come (AnagraficaStazione, record), nell'ordine dei dati API.
+        I record con codice già noto (di interesse o no) costano un solo lookup.
+        """
+        per_codice = self._per_codice
+        stazioni = []
+        sconosciuti = []
+        for record in data:
+            voce = per_codice.get(record.get("codice"), False)
+            if voce:
+                stazioni.append((voce, record))
+            elif voce is False:
+                sconosciuti.append(record)
+        if not sconosciuti:
+            self._controlla_escluse(stazioni)
+            return stazioni
+
+        # Percorso lento solo quando compaiono codici mai visti: associazione e nuovo passaggio
+        senza_codice = self._associa(sconosciuti, {record.get("codice") for record in data})
+        stazioni = []
+        for record in data:
+            codice = record.get("codice")
+            voce = per_codice.get(codice) if codice is not None else senza_codice.get(id(record))
+            if voce:
+                stazioni.append((voce, record))
+        self._controlla_escluse(stazioni)
+        return stazioni
+
+    def _controlla_escluse(self, stazioni):
+        """Aggiorna `escluse` per il payload filtrato; i doppioni di un nome rimasto senza codice tornano sconosciuti."""
+        trovate = {voce.nome for voce, _ in stazioni}
+        if trovate.issuperset(self.bacini_stazioni):
+            self.escluse = {}
+            return
+        escluse = {}
+        with self._lock:
+            for nome in self.bacini_stazioni:
+                if nome in trovate:
+                    continue
+                if nome in self._collisioni:
+                    codici = ", ".join(sorted(map(str, self._collisioni[nome])))
+                    escluse[nome] = f"più stazioni con questo nome (codici {codici}), codice da fissare"
+                    continue
+                codice = self._codice_per_nome.get(nome)
+                escluse[nome] = f"codice {codice} assente dai dati" if codice is not None else "assente dai dati"
+                doppioni = self._doppioni.pop(nome, None)
+                if doppioni:
+                    # Il codice associato non compare più: al prossimo payload un doppione può prenderne il posto
+                    for codice_doppione in doppioni:
+                        self._per_codice.pop(codice_doppione, None)
+                    logging.info(f"[Registro Stazioni] '{nome}' assente dai dati: codici {', '.join(sorted(map(str, doppioni)))} di nuovo da associare")
+        self.escluse = escluse
+
+    def da_tenere(self, record):
+        """
+        Filtro per la decodifica in streaming (stream_decode): riceve i campi semplici del record,
+        prima dei sensori, ed è falso solo per le stazioni certamente non di interesse.
+        """
+        codice = record.get("codice")
+        voce = self._per_codice.get(codice, False)
+        if voce is not False:
+            return voce is not None
+        # Codice mai visto: se il nome è già stato letto e non interessa, si scarta e lo si mette in cache negativa
+        nome = record.get("nome")
+        if nome is None or nome.strip() in self.bacini_stazioni:
+            return True # lo risolve filtra() a record completo
+        if codice is not None:
+            with self._lock:
+                self._per_codice.setdefault(codice, None)
+        return False
+
+    def _segnala_collisione(self, nome, messaggio):
+        if nome not in self._collisioni_segnalate:
+            self._collisioni_segnalate.add(nome)
+            logging.error(f"[Registro Stazioni] {messaggio}, fissare il codice giusto in CODICI_STAZIONI_JSON")
+
+    def _associa(self, sconosciuti, codici_presenti):
+        """
+        Associa per nome i codici mai visti (o li mette nella cache negativa).
+        Restituisce {id(record): AnagraficaStazione} per i record di interesse senza codice.
+        """
+        candidati = defaultdict(list) # nome -> record con codice sconosciuto e quel nome
+        senza_codice = {}
+        with self._lock:
+            for record in sconosciuti:
+                codice = record.get("codice")
+                nome = (record.get("nome") or "").strip()
+                if nome not in self.bacini_stazioni or nome in self._nomi_fissi:
+                    if codice is not None:
+                        self._per_codice[codice] = None
+                elif codice is None:
+                    # Senza codice non si può indicizzare: si associa per nome a ogni payload, senza cache
+                    senza_codice[id(record)] = AnagraficaStazione(None, nome, self.bacini_stazioni[nome])
+                else:
+                    candidati[nome].append(record)
+
+            for nome, records in candidati.items():
+                codici = {record.get("codice") for record in records}
+                codice_precedente = self._codice_per_nome.get(nome)
+                if len(codici) > 1:
+                    self._segnala_collisione(nome, f"Nome '{nome}' usato da più stazioni (codici {', '.join(sorted(map(str, codici)))}): nessuna associata")
+                    self._collisioni[nome] = self._collisioni.get(nome, set()) | codici
+                    self._per_codice.update(dict.fromkeys(codici))
+                    continue
+                codice = codici.pop()
+                if codice_precedente is not None and codice_precedente in codici_presenti:
+                    self._segnala_collisione(nome, f"Nome '{nome}' già associato al codice {codice_precedente}: codice {codice} ignorato")
+                    self._doppioni[nome].add(codice)
+                    self._per_codice[codice] = None
+                    continue
+                if codice_precedente is not None:
+                    logging.warning(f"[Registro Stazioni] Stazione '{nome}' passata dal codice {codice_precedente} al codice {codice}")
+                    self._per_codice.pop(codice_precedente, None)
+                else:
+                    logging.info(f"[Registro Stazioni] Stazione '{nome}' associata al codice {codice}")
+                self._per_codice[codice] = AnagraficaStazione(codice, nome, self.bacini_stazioni[nome])
+                self._codice_per_nome[nome] = codice
+        return senza_codice
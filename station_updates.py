@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Rilevamento incrementale delle stazioni aggiornate, per codice stazione.
+
+Per ogni stazione il registro ricorda l'ultimo lastUpdateTime elaborato:
+le stazioni il cui dato non è avanzato vengono saltate, così il costo di un
+controllo è proporzionale alle stazioni effettivamente aggiornate.
+
+Il registro ricorda anche quando (orologio locale, non lastUpdateTime, per non
+dipendere dal fuso orario dell'API) è stato visto l'ultimo avanzamento: una
+stazione ferma da più di MINUTI_OBSOLESCENZA minuti genera un evento "ferma",
+e un evento "ripresa" quando torna ad aggiornarsi. Lo stato è salvato nello
+stesso file SQLite dello stato soglie (tabella aggiornamenti_stazioni).
+"""
+import os
+import time
+import sqlite3
+import logging
+
+import alert_records
+import threshold_state
+import readings_archive
+
+PERCORSO_DB = os.environ.get("STATO_STAZIONI_DB", threshold_state.PERCORSO_DB)
+# Minuti senza nuovi dati dopo i quali una stazione è segnalata come ferma
+MINUTI_OBSOLESCENZA = int(os.environ.get("STAZIONI_MINUTI_OBSOLESCENZA", "60"))
+
+EVENTO_FERMA = alert_records.EVENTO_FERMA
+EVENTO_RIPRESA = alert_records.EVENTO_RIPRESA
+
+
+class RegistroAggiornamenti:
+    """Ultimo lastUpdateTime elaborato e stato di attività per codice stazione."""
+
+    def __init__(self, percorso=PERCORSO_DB, minuti_obsolescenza=MINUTI_OBSOLESCENZA):
+        self.percorso = percorso
+        self.minuti_obsolescenza = minuti_obsolescenza
+        self.conn = sqlite3.connect(percorso)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS aggiornamenti_stazioni ("
+            " codice INTEGER PRIMARY KEY, stazione TEXT, ultimo_agg TEXT,"
+            " timestamp INTEGER, visto INTEGER NOT NULL, ferma INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.conn.commit()
+        # Cache in memoria: codice -> [stazione, ultimo_agg, timestamp, visto, ferma]
+        self._stazioni = {
+            riga[0]: list(riga[1:])
+            for riga in self.conn.execute("SELECT codice, stazione, ultimo_agg, timestamp, visto, ferma FROM aggiornamenti_stazioni")
+        }
+        logging.info(f"[Aggiornamenti] Caricate {len(self._stazioni)} stazioni da {percorso}")
+
+    def avanzata(self, codice, last_update):
+        """True se il lastUpdateTime della stazione è nuovo rispetto all'ultimo elaborato (o non confrontabile)."""
+        voce = self._stazioni.get(codice)
+        if codice is None or voce is None or not last_update:
+            return True
+        timestamp = readings_archive.parse_timestamp(last_update)
+        if timestamp is not None and voce[2] is not None:
+            return timestamp > voce[2]
+        return last_update != voce[1]
+
+    def registra(self, codice, nome_stazione, last_update, adesso=None):
+        """
+        Registra come elaborato il lastUpdateTime di una stazione aggiornata.
+        Restituisce EVENTO_RIPRESA se la stazione era segnalata come ferma, altrimenti None.
+        """
+        if codice is None:
+            return None
+        adesso = int(time.time()) if adesso is None else int(adesso)
+        era_ferma = bool(self._stazioni.get(codice, (None,) * 5)[4])
+        voce = [nome_stazione, last_update, readings_archive.parse_timestamp(last_update), adesso, 0]
+        self._stazioni[codice] = voce
+        self.conn.execute(
+            "INSERT OR REPLACE INTO aggiornamenti_stazioni (codice, stazione, ultimo_agg, timestamp, visto, ferma)"
+            " VALUES (?, ?, ?, ?, ?, ?)", (codice, *voce)
+        )
+        return EVENTO_RIPRESA if era_ferma else None
+
+    def controlla_ferme(self, adesso=None):
+        """
+        Segna come ferme le stazioni senza nuovi dati da più di minuti_obsolescenza minuti.
+        Restituisce la lista (codice, nome_stazione, ultimo_agg, minuti_fermo) delle nuove stazioni ferme.
+        """
+        adesso = int(time.time()) if adesso is None else int(adesso)
+        limite = adesso - self.minuti_obsolescenza * 60
+        nuove_ferme = []
+        for codice, voce in self._stazioni.items():
+            if voce[4] or voce[3] > limite:
+                continue
+            voce[4] = 1
+            self.conn.execute("UPDATE aggiornamenti_stazioni SET ferma = 1 WHERE codice = ?", (codice,))
+            nuove_ferme.append((codice, voce[0], voce[1], (adesso - voce[3]) // 60))
+        return nuove_ferme
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Decodifica in streaming (ijson) di payload JSON formati da un array di record.
+
+json.loads costruisce tutto l'albero del payload (per rt-data: tutte le
+stazioni della regione con le relative liste di sensori) prima che il
+chiamante possa scartare qualcosa. Qui il body viene letto evento per evento
+e ogni record (oggetto dell'array) viene costruito solo finché servono i
+suoi campi semplici: alla prima lista o oggetto annidato (es. "analog"), o a
+fine record, il filtro `tieni` decide se completarlo o saltarne il resto
+senza costruire nulla. Memoria e tempo di costruzione seguono così i record
+tenuti, non l'intero payload.
+
+Se ijson non è installato si ripiega su json.loads seguito dallo stesso
+filtro (risultato identico, senza il risparmio).
+"""
+import io
+import json
+import logging
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+EVENTI_APERTURA = ("start_map", "start_array")
+EVENTI_CHIUSURA = ("end_map", "end_array")
+# Buffer di lettura: il backend C produce gli eventi di un buffer alla volta,
+# quindi la sua dimensione limita anche la memoria transitoria degli eventi
+DIMENSIONE_BUFFER = 16 * 1024
+
+
+def _errore_json(origine, body, e):
+    logging.error(f"[Stream JSON] Errore JSON da {origine}: Resp '{body[:200]!r}...', Err: {e}")
+
+
+def _costruisci(eventi, apertura):
+    """Costruisce il valore annidato (oggetto o lista) che inizia con l'evento `apertura`."""
+    costruttore = ijson.ObjectBuilder()
+    costruttore.event(apertura, None)
+    profondita = 1
+    for evento, valore in eventi:
+        costruttore.event(evento, valore)
+        if evento in EVENTI_APERTURA:
+            profondita += 1
+        elif evento in EVENTI_CHIUSURA:
+            profondita -= 1
+            if not profondita:
+                return costruttore.value
+
+
+def _salta(eventi, profondita):
+    """Consuma gli eventi fino a chiudere `profondita` livelli, senza costruire nulla."""
+    for evento, _ in eventi:
+        if evento in EVENTI_APERTURA:
+            profondita += 1
+        elif evento in EVENTI_CHIUSURA:
+            profondita -= 1
+            if not profondita:
+                return
+
+
+def _record(eventi, tieni):
+    """
+    Legge un record (dopo il suo start_map): campi semplici, poi al primo campo
+    annidato (o a fine record) chiede a `tieni`. Restituisce il record o None se scartato.
+    """
+    record = {}
+    chiave = None
+    deciso = False
+    for evento, valore in eventi:
+        if evento == "map_key":
+            chiave = valore
+        elif evento == "end_map":
+            return record if deciso or tieni(record) else None
+        elif evento in EVENTI_APERTURA:
+            if not deciso:
+                deciso = True
+                if not tieni(record):
+                    _salta(eventi, 2) # il campo annidato e il record
+                    return None
+            record[chiave] = _costruisci(eventi, evento)
+        else:
+            record[chiave] = valore
+
+
+def decodifica_array(body, tieni, origine="payload"):
+    """
+    Decodifica `body` (bytes, array JSON) tenendo solo i record per cui tieni(record) è vero.
+    `tieni` riceve il record con i campi semplici letti fino al primo campo annidato.
+    Restituisce la lista dei record tenuti, None se il body non è un array JSON valido.
+    """
+    if ijson is None:
+        try:
+            dati = json.loads(body)
+        except ValueError as e:
+            _errore_json(origine, body, e)
+            return None
+        if not isinstance(dati, list):
+            logging.error(f"[Stream JSON] {origine}: atteso un array JSON, trovato {type(dati).__name__}")
+            return None
+        return [record for record in dati if not isinstance(record, dict) or tieni(record)]
+
+    records = []
+    eventi = ijson.basic_parse(io.BytesIO(body), use_float=True, buf_size=DIMENSIONE_BUFFER)
+    try:
+        evento, _ = next(eventi, (None, None))
+        if evento != "start_array":
+            logging.error(f"[Stream JSON] {origine}: atteso un array JSON")
+            return None
+        for evento, valore in eventi:
+            if evento == "start_map":
+                record = _record(eventi, tieni)
+                if record is not None:
+                    records.append(record)
+            elif evento == "start_array":
+                records.append(_costruisci(eventi, evento))
+            elif evento != "end_array":
+                records.append(valore)
+    except ijson.JSONError as e:
+        _errore_json(origine, body, e)
+        return None
+    return records
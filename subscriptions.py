@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Registro delle sottoscrizioni Telegram e fan-out dei risultati per chat.
+
+Ogni chat (gruppo di protezione civile) sceglie bacini, aree di allerta e
+stazioni WeatherLink di interesse. Il registro si legge dalla variabile
+SOTTOSCRIZIONI_JSON o dal file SOTTOSCRIZIONI_FILE (default sottoscrizioni.json):
+
+  [
+    {"chat_id": "-1001234567890", "nome": "COC Senigallia",
+     "bacini": ["Misa", "Nevola"], "aree_allerta": ["2"], "stazioni_weatherlink": ["Montignano"]},
+    {"chat_id": "-1009876543210", "nome": "COC Marotta", "bacini": ["Cesano"], "aree_allerta": "*"}
+  ]
+
+Un campo assente o "*" vale "tutti", una lista vuota "nessuno". Senza
+registro tutto viene inviato a TELEGRAM_CHAT_ID, come prima.
+
+Il registro viene validato come la configurazione soglie (threshold_config):
+le voci non valide (chat_id mancante, campi sconosciuti o di tipo sbagliato)
+vengono segnalate nei log e ignorate; se il JSON non è leggibile o non resta
+alcuna voce valida si torna a TELEGRAM_CHAT_ID.
+
+Gli script valutano lo snapshot una sola volta; il registro precalcola
+l'indice chiave (bacino/area/stazione) -> chat, e fan_out() compone un solo
+messaggio per ogni insieme distinto di chiavi e lo accoda per tutte le chat
+che lo condividono (consegna in parallelo tramite telegram_queue).
+"""
+import os
+import json
+import logging
+from collections import namedtuple
+
+import telegram_queue
+
+PERCORSO_SOTTOSCRIZIONI = os.environ.get("SOTTOSCRIZIONI_FILE",
+                                         os.path.join(os.path.dirname(os.path.abspath(__file__)), "sottoscrizioni.json"))
+
+BACINI = "bacini"
+AREE_ALLERTA = "aree_allerta"
+STAZIONI_WEATHERLINK = "stazioni_weatherlink"
+ARGOMENTI = (BACINI, AREE_ALLERTA, STAZIONI_WEATHERLINK)
+TUTTI = "*"
+CAMPI = ("chat_id", "nome") + ARGOMENTI
+
+# Per ogni argomento: frozenset delle chiavi sottoscritte, None = tutte
+Sottoscrizione = namedtuple("Sottoscrizione", ["chat_id", "nome", BACINI, AREE_ALLERTA, STAZIONI_WEATHERLINK])
+
+
+def _chiave_valida(chiave):
+    return isinstance(chiave, (str, int)) and not isinstance(chiave, bool)
+
+
+def _chiavi_sottoscritte(valore, dove, errori):
+    """Valore di un argomento -> frozenset delle chiavi, None = tutte (errore se non è "*", una chiave o una lista di chiavi)."""
+    if valore is None or valore == TUTTI:
+        return None
+    if _chiave_valida(valore):
+        valore = [valore]
+    if not isinstance(valore, list) or not all(_chiave_valida(chiave) for chiave in valore):
+        errori.append(f"{dove}: atteso \"{TUTTI}\", una chiave o una lista di chiavi, trovato {valore!r}")
+        return None
+    return frozenset(str(chiave) for chiave in valore)
+
+
+def valida_sottoscrizioni(dati):
+    """
+    Valida il contenuto del registro. Restituisce (sottoscrizioni valide, errori):
+    le voci con errori vengono scartate, le altre sono utilizzabili.
+    """
+    if not isinstance(dati, list):
+        return [], [f"registro: attesa una lista JSON di sottoscrizioni, trovato {type(dati).__name__}"]
+    sottoscrizioni = []
+    errori = []
+    for i, voce in enumerate(dati):
+        dove = f"voce {i}"
+        if not isinstance(voce, dict):
+            errori.append(f"{dove}: atteso un oggetto JSON, trovato {type(voce).__name__}")
+            continue
+        errori_voce = []
+        chat_id = voce.get("chat_id")
+        if not _chiave_valida(chat_id) or not str(chat_id).strip():
+            errori_voce.append(f"{dove}: chat_id {chat_id!r} mancante o non valido")
+        else:
+            dove = f"voce {i} (chat {chat_id})"
+        sconosciuti = set(voce) - set(CAMPI)
+        if sconosciuti:
+            errori_voce.append(f"{dove}: campi sconosciuti {sorted(sconosciuti)} (ammessi: {', '.join(CAMPI)})")
+        nome = voce.get("nome", str(chat_id))
+        if not isinstance(nome, str):
+            errori_voce.append(f"{dove}: nome {nome!r} non è una stringa")
+        chiavi = [_chiavi_sottoscritte(voce.get(argomento), f"{dove}[{argomento}]", errori_voce) for argomento in ARGOMENTI]
+        if errori_voce:
+            errori.extend(errori_voce)
+            continue
+        sottoscrizioni.append(Sottoscrizione(str(chat_id).strip(), nome, *chiavi))
+    return sottoscrizioni, errori
+
+
+class RegistroSottoscrizioni:
+    """Sottoscrizioni con indice precalcolato chiave -> chat per ciascun argomento."""
+
+    def __init__(self, sottoscrizioni):
+        self.sottoscrizioni = list(sottoscrizioni)
+        self._per_chiave = {argomento: {} for argomento in ARGOMENTI}
+        self._tutte_le_chiavi = {argomento: [] for argomento in ARGOMENTI}
+        for sottoscrizione in self.sottoscrizioni:
+            for argomento in ARGOMENTI:
+                chiavi = getattr(sottoscrizione, argomento)
+                if chiavi is None:
+                    self._tutte_le_chiavi[argomento].append(sottoscrizione.chat_id)
+                    continue
+                for chiave in chiavi:
+                    self._per_chiave[argomento].setdefault(chiave, []).append(sottoscrizione.chat_id)
+
+    def __len__(self):
+        return len(self.sottoscrizioni)
+
+    def chat_per(self, argomento, chiave):
+        """Chat interessate a una chiave (es. un bacino)."""
+        return self._per_chiave[argomento].get(str(chiave), []) + self._tutte_le_chiavi[argomento]
+
+    def chiavi(self, argomento):
+        """Chiavi citate esplicitamente dalle sottoscrizioni per l'argomento."""
+        return set(self._per_chiave[argomento])
+
+    def distribuisci(self, argomento, elementi_per_chiave):
+        """
+        Instrada risultati già calcolati {chiave: elementi} alle chat:
+        restituisce {chat_id: frozenset delle chiavi con elementi di interesse per la chat}.
+        """
+        per_chat = {}
+        for chiave, elementi in elementi_per_chiave.items():
+            if not elementi:
+                continue
+            for chat_id in self.chat_per(argomento, chiave):
+                per_chat.setdefault(chat_id, set()).add(chiave)
+        return {chat_id: frozenset(chiavi) for chat_id, chiavi in per_chat.items()}
+
+    def sottoscritte(self, argomento, chiavi_disponibili):
+        """
+        Per ogni chat con almeno una chiave di interesse tra quelle disponibili (es. tutti i bacini)
+        restituisce {chat_id: frozenset delle chiavi sottoscritte}; usato per report e messaggi di stato.
+        """
+        return self.distribuisci(argomento, {chiave: True for chiave in chiavi_disponibili})
+
+
+def registro_predefinito(chat_predefinita=None):
+    """Registro con la sola chat predefinita (TELEGRAM_CHAT_ID), iscritta a tutti gli argomenti; vuoto se non c'è."""
+    chat_predefinita = chat_predefinita or os.environ.get("TELEGRAM_CHAT_ID")
+    sottoscrizioni = [Sottoscrizione(chat_predefinita, "predefinita", None, None, None)] if chat_predefinita else []
+    return RegistroSottoscrizioni(sottoscrizioni)
+
+
+def carica_registro(percorso=PERCORSO_SOTTOSCRIZIONI, chat_predefinita=None):
+    """
+    Legge e valida il registro da SOTTOSCRIZIONI_JSON o dal file; in mancanza, o se non contiene
+    alcuna sottoscrizione valida, usa la sola chat predefinita (tutti gli argomenti).
+    """
+    testo = os.environ.get("SOTTOSCRIZIONI_JSON")
+    origine = "SOTTOSCRIZIONI_JSON"
+    if not testo and os.path.exists(percorso):
+        origine = percorso
+        try:
+            with open(percorso, encoding="utf-8") as f:
+                testo = f.read()
+        except OSError as e:
+            logging.error(f"[Sottoscrizioni] {percorso} non leggibile ({e}): uso della chat predefinita")
+            return registro_predefinito(chat_predefinita)
+
+    if not testo:
+        return registro_predefinito(chat_predefinita)
+
+    try:
+        dati = json.loads(testo)
+    except json.JSONDecodeError as e:
+        logging.error(f"[Sottoscrizioni] JSON non valido in {origine} ({e}): uso della chat predefinita")
+        return registro_predefinito(chat_predefinita)
+    sottoscrizioni, errori = valida_sottoscrizioni(dati)
+    for errore in errori:
+        logging.error(f"[Sottoscrizioni] {origine}: {errore}")
+    if not sottoscrizioni:
+        logging.error(f"[Sottoscrizioni] Nessuna sottoscrizione valida in {origine}: uso della chat predefinita")
+        return registro_predefinito(chat_predefinita)
+    ignorate = len(dati) - len(sottoscrizioni)
+    logging.info(f"[Sottoscrizioni] Caricate {len(sottoscrizioni)} sottoscrizioni da {origine}"
+                 + (f" ({ignorate} voci non valide ignorate)" if ignorate else ""))
+    return RegistroSottoscrizioni(sottoscrizioni)
+
+
+def fan_out(token, per_chat, componi, parse_mode=None):
+    """
+    Compone un messaggio per ogni insieme distinto di chiavi (componi(chiavi) -> testo o None),
+    lo accoda per le chat corrispondenti e consegna tutto in un'unica passata della coda.
+    Restituisce il numero di messaggi consegnati.
+    """
+    if not token or not per_chat:
+        return 0
+    coda = telegram_queue.coda(token)
+    messaggi = {}
+    id_accodati = []
+    for chat_id, chiavi in per_chat.items():
+        if chiavi not in messaggi:
+            messaggi[chiavi] = componi(chiavi)
+        if messaggi[chiavi]:
+            # Un messaggio troppo lungo diventa più parti, consegnate in ordine
+            id_accodati.append(coda.accoda_testo(chat_id, messaggi[chiavi], parse_mode))
+    coda.svuota()
+    consegnati = sum(1 for id_parti in id_accodati if not any(coda.in_coda(id_parte) for id_parte in id_parti))
+    logging.info(f"[Sottoscrizioni] {consegnati}/{len(id_accodati)} messaggi consegnati ({len(messaggi)} composti per {len(per_chat)} chat)")
+    return consegnati
+
+
+# Registro condiviso, caricato alla prima richiesta
+_registro = None
+
+
+def registro():
+    global _registro
+    if _registro is None:
+        _registro = carica_registro()
+    return _registro
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Bot Telegram interattivo (python-telegram-bot, async) per report su richiesta.
+
+Comandi:
+  /stato             report completo stazioni (modo completo di station_engine, come il full report)
+  /bacino <nome>     report di un solo bacino, es. /bacino Misa
+  /stazione <nome>   valori attuali e soglie di una stazione, es. /stazione Arcevia
+  /allerte [aree]    stato allerte meteo di DOMANI, es. /allerte 2 4
+
+Le risposte vengono composte dalla cache in memoria dell'ultimo snapshot, che
+un task in background aggiorna ogni BOT_INTERVALLO_REPORT secondi (allerte ogni
+BOT_INTERVALLO_ALLERTE): qualunque numero di utenti genera al massimo una
+richiesta a RETEMIR/allertameteo per intervallo. Se BOT_CHAT_AUTORIZZATE è
+impostata (chat_id separati da virgola) il bot risponde solo a quelle chat.
+Le modifiche a THRESHOLDS_JSON.txt vengono applicate senza riavvio (threshold_config).
+Le metriche del processo (aggiornamenti della cache, chiamate Telegram) sono su
+http://METRICS_HOST:METRICS_PORTA/metrics (vedi metrics).
+
+Uso: python telegram_bot.py
+"""
+import os
+import asyncio
+import logging
+import threading
+from datetime import timedelta
+
+from telegram import Update
+from telegram.constants import ParseMode
+from telegram.ext import Application, CommandHandler, ContextTypes
+
+import station_engine
+import alert_checker
+import alert_records
+import renderers
+import message_splitter
+import threshold_config
+import telegram_queue
+import metrics
+
+TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+INTERVALLO_REPORT = int(os.environ.get("BOT_INTERVALLO_REPORT", "300"))
+INTERVALLO_ALLERTE = int(os.environ.get("BOT_INTERVALLO_ALLERTE", "1800"))
+CHAT_AUTORIZZATE = {chat.strip() for chat in os.environ.get("BOT_CHAT_AUTORIZZATE", "").split(",") if chat.strip()}
+
+MESSAGGIO_IN_CARICAMENTO = "⏳ Dati in caricamento, riprova tra qualche secondo."
+MESSAGGIO_AIUTO = ("*Comandi disponibili*\n"
+                   "/stato - report completo stazioni\n"
+                   "/bacino <nome> - report di un bacino (" + ", ".join(station_engine.ORDINE_BACINI) + ")\n"
+                   "/stazione <nome> - valori attuali di una stazione\n"
+                   "/allerte [aree] - allerte meteo di domani")
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def orario_dati(report):
+    """Orario a cui risalgono i dati del report: quello di generazione, o prima se viene dall'ultima copia valida."""
+    if report.obsoleto_da is None:
+        return report.generato
+    return report.generato - timedelta(seconds=report.obsoleto_da)
+
+
+class CacheSnapshot:
+    """Ultimo report stazioni e ultimo bollettino allerte, con l'orario di aggiornamento."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.report = None # renderers.ReportStazioni
+        self.aggiornato_report = None
+        self.errore_report = None
+        self.allerte = None # renderers.ReportAllerte
+        self.aggiornato_allerte = None
+        self.errore_allerte = None
+
+    def aggiorna_report(self):
+        # Tutti i sensori con soglia (non solo i livelli): /stazione deve rispondere anche per
+        # le stazioni solo pluviometriche o termometriche (es. Arcevia, Barbara)
+        dict_soglie, dict_valori, errore_fetch, obsoleto_da = station_engine.esegui([station_engine.MODO_COMPLETO])[station_engine.MODO_COMPLETO]
+        with self._lock:
+            # In caso di errore si continua a servire l'ultimo snapshot valido, segnalandolo
+            self.errore_report = errore_fetch
+            if not errore_fetch:
+                self.report = renderers.report_stazioni(dict_soglie, dict_valori, None, station_engine.ORDINE_BACINI, obsoleto_da=obsoleto_da)
+                self.aggiornato_report = orario_dati(self.report)
+
+    def aggiorna_allerte(self):
+        allerte_per_area, errore_fetch, obsoleto_da = alert_checker.valuta_allerte_domani()
+        with self._lock:
+            self.errore_allerte = errore_fetch
+            if not errore_fetch:
+                self.allerte = renderers.report_allerte(allerte_per_area, None, alert_checker.AREE_INTERESSATE_ALLERTE, obsoleto_da=obsoleto_da)
+                self.aggiornato_allerte = orario_dati(self.allerte)
+
+    def leggi_report(self):
+        with self._lock:
+            return self.report, self.aggiornato_report, self.errore_report
+
+    def leggi_allerte(self):
+        with self._lock:
+            return self.allerte, self.aggiornato_allerte, self.errore_allerte
+
+
+CACHE = CacheSnapshot()
+
+
+def nota_aggiornamento(aggiornato, errore):
+    """Riga finale con l'età dei dati e l'eventuale errore dell'ultimo aggiornamento."""
+    nota = f"\n_Dati aggiornati alle {aggiornato.strftime('%H:%M:%S')}_"
+    if errore:
+        nota += f"\n_Ultimo aggiornamento fallito: {errore}_"
+    return nota
+
+
+def trova_nome(richiesto, nomi):
+    """Cerca `richiesto` tra i nomi (senza distinzione di maiuscole), None se assente."""
+    richiesto = richiesto.strip().lower()
+    return next((nome for nome in nomi if nome.lower() == richiesto), None)
+
+
+def componi_stato(bacini=None):
+    report, aggiornato, errore = CACHE.leggi_report()
+    if report is None:
+        return errore or MESSAGGIO_IN_CARICAMENTO
+    messaggio = renderers.MARKDOWN.stazioni(report, bacini)
+    return messaggio + nota_aggiornamento(aggiornato, errore)
+
+
+def componi_stazione(nome_stazione):
+    report, aggiornato, errore = CACHE.leggi_report()
+    if report is None:
+        return errore or MESSAGGIO_IN_CARICAMENTO
+    bacino = station_engine.BACINI_STAZIONI.get(nome_stazione, "Altri Bacini")
+    valori = [alert_records.formatta_valori_stazione(v) for v in report.valori_per_bacino[bacino] if v.stazione == nome_stazione]
+    soglie = [alert_records.formatta_allerta(a) for a in report.soglie_per_bacino[bacino] if a.stazione == nome_stazione]
+    if not valori:
+        return f"Nessun dato monitorato per *{nome_stazione}* nell'ultimo snapshot." + nota_aggiornamento(aggiornato, errore)
+    parti = valori + ([""] + soglie if soglie else [])
+    if report.obsoleto_da is not None:
+        parti = [f"*{alert_records.avviso_obsoleto(report.obsoleto_da)}*"] + parti
+    return "\n".join(parti) + "\n" + nota_aggiornamento(aggiornato, errore)
+
+
+def componi_allerte(aree):
+    allerte, aggiornato, errore = CACHE.leggi_allerte()
+    if allerte is None:
+        return errore or MESSAGGIO_IN_CARICAMENTO
+    return renderers.MARKDOWN.allerte(allerte, aree) + nota_aggiornamento(aggiornato, errore)
+
+
+async def rispondi(update, testo):
+    # Le risposte lunghe (es. /stato in piena) arrivano in più messaggi consecutivi
+    for parte in message_splitter.dividi_messaggio(testo):
+        await update.effective_message.reply_text(parte, parse_mode=ParseMode.MARKDOWN)
+
+
+def autorizzata(update):
+    if not CHAT_AUTORIZZATE or str(update.effective_chat.id) in CHAT_AUTORIZZATE:
+        return True
+    logging.warning(f"[Bot] Comando da chat non autorizzata {update.effective_chat.id} ignorato")
+    return False
+
+
+async def comando_aiuto(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if autorizzata(update):
+        await rispondi(update, MESSAGGIO_AIUTO)
+
+
+async def comando_stato(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if autorizzata(update):
+        await rispondi(update, componi_stato())
+
+
+async def comando_bacino(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not autorizzata(update):
+        return
+    bacino = trova_nome(" ".join(context.args), station_engine.ORDINE_BACINI)
+    if bacino is None:
+        await rispondi(update, "Uso: /bacino <nome>, con nome tra: " + ", ".join(station_engine.ORDINE_BACINI))
+        return
+    await rispondi(update, componi_stato([bacino]))
+
+
+async def comando_stazione(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not autorizzata(update):
+        return
+    nome_stazione = trova_nome(" ".join(context.args), station_engine.STAZIONI_INTERESSATE)
+    if nome_stazione is None:
+        await rispondi(update, "Uso: /stazione <nome>, con nome tra: " + ", ".join(station_engine.STAZIONI_INTERESSATE))
+        return
+    await rispondi(update, componi_stazione(nome_stazione))
+
+
+async def comando_allerte(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if autorizzata(update):
+        await rispondi(update, componi_allerte(sorted(context.args) or alert_checker.AREE_INTERESSATE_ALLERTE))
+
+
+async def aggiorna_periodicamente(nome, funzione, intervallo):
+    """Aggiorna la cache in un thread (il fetch è bloccante) senza fermare la gestione dei comandi."""
+    while True:
+        try:
+            await asyncio.to_thread(funzione)
+            logging.info(f"[Bot] Cache '{nome}' aggiornata")
+        except Exception as e:
+            logging.error(f"[Bot] Errore aggiornamento cache '{nome}': {e}", exc_info=True)
+        await asyncio.sleep(intervallo)
+
+
+async def avvia_aggiornamenti(application):
+    application.create_task(aggiorna_periodicamente("report", CACHE.aggiorna_report, INTERVALLO_REPORT))
+    application.create_task(aggiorna_periodicamente("allerte", CACHE.aggiorna_allerte, INTERVALLO_ALLERTE))
+
+
+def crea_applicazione(token):
+    # Stessa Bot API della coda di invio (TELEGRAM_API_BASE_URL, es. mock_server)
+    application = (Application.builder().token(token).base_url(f"{telegram_queue.TELEGRAM_API_BASE_URL}/bot")
+                   .post_init(avvia_aggiornamenti).build())
+    application.add_handler(CommandHandler(["start", "aiuto", "help"], comando_aiuto))
+    application.add_handler(CommandHandler("stato", comando_stato))
+    application.add_handler(CommandHandler("bacino", comando_bacino))
+    application.add_handler(CommandHandler("stazione", comando_stazione))
+    application.add_handler(CommandHandler("allerte", comando_allerte))
+    return application
+
+
+if __name__ == "__main__":
+    if not TELEGRAM_BOT_TOKEN:
+        logging.critical("[Bot] Errore: TELEGRAM_BOT_TOKEN mancante."); exit(1)
+
+    logging.info("--- [Bot] Avvio bot Telegram Meteo Marche ---")
+    try:
+        threshold_config.avvia_osservatore()
+    except threshold_config.ConfigSoglieNonValida as e:
+        logging.critical(f"[Bot] Errore: {e}."); exit(1)
+    metrics.avvia()
+    crea_applicazione(TELEGRAM_BOT_TOKEN).run_polling(allowed_updates=Update.ALL_TYPES)
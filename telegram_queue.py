@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Coda persistente di invio messaggi Telegram con rate limit, retry e backoff.
+
+Ogni messaggio viene prima salvato in SQLite (TELEGRAM_CODA_DB) e poi inviato
+con un'unica sessione keep-alive condivisa. Regole di consegna:
+  - per chat al massimo un messaggio ogni TELEGRAM_INTERVALLO_CHAT secondi
+    (TELEGRAM_INTERVALLO_GRUPPO per gruppi/canali, chat_id negativo) e in
+    ordine di accodamento; globalmente al massimo TELEGRAM_MESSAGGI_AL_SECONDO;
+  - 429: il messaggio (e i successivi della stessa chat) attende il
+    `retry_after` indicato dalla Bot API;
+  - 5xx ed errori di rete: backoff esponenziale con jitter, fino a
+    TELEGRAM_MAX_TENTATIVI tentativi;
+  - altri 4xx: errore definitivo, il messaggio resta in tabella come "scartato"
+    (per la diagnosi) per TELEGRAM_CONSERVA_SCARTATI secondi, poi viene
+    eliminato all'inizio di svuota().
+I testi oltre il limite di 4096 caratteri vengono divisi in parti consecutive
+(message_splitter) invece di essere troncati.
+Le chat diverse vengono servite in parallelo, così il fan-out su molte chat
+non si somma in latenza. I messaggi non consegnati sopravvivono al processo
+e vengono ritentati al successivo invio (o dal job "telegram" del daemon).
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import message_splitter
+import metrics
+
+PERCORSO_DB = os.environ.get("TELEGRAM_CODA_DB",
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), "telegram_coda.sqlite3"))
+INTERVALLO_CHAT = float(os.environ.get("TELEGRAM_INTERVALLO_CHAT", "1.0"))
+INTERVALLO_GRUPPO = float(os.environ.get("TELEGRAM_INTERVALLO_GRUPPO", "3.0"))
+MESSAGGI_AL_SECONDO = float(os.environ.get("TELEGRAM_MESSAGGI_AL_SECONDO", "30"))
+MAX_TENTATIVI = int(os.environ.get("TELEGRAM_MAX_TENTATIVI", "8"))
+# Secondi massimi che un invio attende (retry compresi) prima di lasciare il messaggio in coda
+ATTESA_MASSIMA = float(os.environ.get("TELEGRAM_ATTESA_MASSIMA", "60"))
+MAX_WORKER = int(os.environ.get("TELEGRAM_MAX_WORKER", "8"))
+# Secondi per cui i messaggi scartati restano in tabella (default 7 giorni)
+CONSERVA_SCARTATI = float(os.environ.get("TELEGRAM_CONSERVA_SCARTATI", "604800"))
+BACKOFF_BASE = 2.0
+BACKOFF_MASSIMO = 300.0
+TIMEOUT_RICHIESTA = 20
+
+# Base URL della Bot API, sovrascrivibile per i test offline (mock_server)
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL", "https://api.telegram.org").rstrip("/")
+API_URL = TELEGRAM_API_BASE_URL + "/bot{token}/{metodo}"
+
+ESITO_INVIATO = "inviato"
+ESITO_RIPROVA = "riprova"
+ESITO_SCARTATO = "scartato"
+
+
+class LimitatoreGlobale:
+    """Distanzia le richieste di almeno 1/al_secondo secondi, condiviso tra i thread."""
+
+    def __init__(self, al_secondo):
+        self.intervallo = 1.0 / al_secondo if al_secondo > 0 else 0.0
+        self._prossimo = 0.0
+        self._lock = threading.Lock()
+
+    def attendi(self):
+        with self._lock:
+            adesso = time.monotonic()
+            turno = max(adesso, self._prossimo)
+            self._prossimo = turno + self.intervallo
+        if turno > adesso:
+            time.sleep(turno - adesso)
+
+
+def intervallo_chat(chat_id):
+    """Intervallo minimo tra due messaggi alla stessa chat (i gruppi hanno limiti più stretti)."""
+    return INTERVALLO_GRUPPO if str(chat_id).startswith("-") else INTERVALLO_CHAT
+
+
+def attesa_backoff(tentativi):
+    return min(BACKOFF_MASSIMO, BACKOFF_BASE * (2 ** tentativi)) * random.uniform(0.5, 1.0)
+
+
+class CodaTelegram:
+    """Coda di invio per un bot (token); vedi invia(), accoda() e svuota()."""
+
+    def __init__(self, token, percorso=PERCORSO_DB, session=None, conserva_scartati=CONSERVA_SCARTATI):
+        self.token = token
+        # I token non vengono salvati su disco: le righe sono associate a un'impronta del token
+        self.bot = hashlib.blake2b(token.encode(), digest_size=8).hexdigest()
+        if session is None:
+            session = requests.Session()
+            for schema in ("https://", "http://"):
+                session.mount(schema, HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKER))
+        self.session = session
+        self.conserva_scartati = conserva_scartati
+        self.conn = sqlite3.connect(percorso, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS coda_telegram ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, bot TEXT NOT NULL, chat_id TEXT NOT NULL,"
+            " metodo TEXT NOT NULL, parametri TEXT NOT NULL, stato TEXT NOT NULL DEFAULT 'in_coda',"
+            " tentativi INTEGER NOT NULL DEFAULT 0, prossimo_tentativo REAL NOT NULL,"
+            " creato TEXT, ultimo_errore TEXT, scartato_alle REAL)"
+        )
+        colonne = {riga[1] for riga in self.conn.execute("PRAGMA table_info(coda_telegram)")}
+        if "scartato_alle" not in colonne:
+            self.conn.execute("ALTER TABLE coda_telegram ADD COLUMN scartato_alle REAL")
+        # Scartati prima della conservazione a tempo: il periodo parte da adesso, una volta sola
+        self.conn.execute("UPDATE coda_telegram SET scartato_alle = ? WHERE stato = 'scartato' AND scartato_alle IS NULL", (time.time(),))
+        self.conn.commit()
+        self._lock_db = threading.Lock()
+        self._lock_invio = threading.Lock()
+        self._ultimo_invio = {} # chat_id -> time.monotonic() dell'ultimo invio
+        self._limitatore = LimitatoreGlobale(MESSAGGI_AL_SECONDO)
+
+    def accoda(self, chat_id, metodo="sendMessage", **parametri):
+        """Salva il messaggio nella coda persistente e ne restituisce l'id."""
+        parametri["chat_id"] = chat_id
+        with self._lock_db:
+            cursore = self.conn.execute(
+                "INSERT INTO coda_telegram (bot, chat_id, metodo, parametri, prossimo_tentativo, creato) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.bot, str(chat_id), metodo, json.dumps(parametri), time.time(), datetime.now().isoformat(timespec="seconds"))
+            )
+            self.conn.commit()
+        return cursore.lastrowid
+
+    def accoda_testo(self, chat_id, testo, parse_mode=None):
+        """
+        Accoda un testo, diviso in più messaggi se supera il limite Telegram (message_splitter).
+        Le parti vengono consegnate in ordine; restituisce la lista dei loro id.
+        """
+        parti = message_splitter.dividi_messaggio(testo)
+        if len(parti) > 1:
+            logging.info(f"[Telegram] Messaggio di {len(testo)} caratteri per {chat_id} diviso in {len(parti)} parti")
+        parametri = {"parse_mode": parse_mode} if parse_mode else {}
+        return [self.accoda(chat_id, text=parte, **parametri) for parte in parti]
+
+    def _pendenti_per_chat(self, adesso):
+        """Messaggi in coda raggruppati per chat, solo per le chat il cui primo messaggio è già dovuto."""
+        with self._lock_db:
+            righe = self.conn.execute(
+                "SELECT id, chat_id, metodo, parametri, tentativi, prossimo_tentativo FROM coda_telegram"
+                " WHERE bot = ? AND stato = 'in_coda' ORDER BY id", (self.bot,)
+            ).fetchall()
+        per_chat = {}
+        for riga in righe:
+            per_chat.setdefault(riga[1], []).append(riga)
+        return {chat_id: messaggi for chat_id, messaggi in per_chat.items() if messaggi[0][5] <= adesso}
+
+    def _invia_chat(self, chat_id, messaggi):
+        """Invia in ordine i messaggi di una chat; si ferma al primo fallimento. Restituisce gli esiti per id."""
+        esiti = []
+        for id_messaggio, _, metodo, parametri, tentativi, _ in messaggi:
+            attesa = self._ultimo_invio.get(chat_id, float("-inf")) + intervallo_chat(chat_id) - time.monotonic()
+            if attesa > 0:
+                time.sleep(attesa)
+            self._limitatore.attendi()
+            esito = self._invia_richiesta(metodo, json.loads(parametri), tentativi)
+            self._ultimo_invio[chat_id] = time.monotonic()
+            esiti.append((id_messaggio, chat_id, tentativi) + esito)
+            if esito[0] == ESITO_RIPROVA:
+                break
+        return esiti
+
+    def _invia_richiesta(self, metodo, parametri, tentativi):
+        """Esegue una chiamata alla Bot API e la classifica come (esito, attesa_secondi, errore)."""
+        return self._esegui(metodo, parametri, tentativi)[:3]
+
+    def _esegui(self, metodo, parametri, tentativi):
+        """Come _invia_richiesta, con in più il campo `result` della risposta: (esito, attesa_secondi, errore, risultato)."""
+        if tentativi:
+            metrics.incrementa("meteo_telegram_ritentativi_totale", metodo=metodo)
+        with metrics.misura("meteo_telegram_secondi", metodo=metodo):
+            esito = self._chiama_api(metodo, parametri, tentativi)
+        metrics.incrementa("meteo_telegram_esiti_totale", metodo=metodo, esito=esito[0])
+        return esito
+
+    def _chiama_api(self, metodo, parametri, tentativi):
+        try:
+            response = self.session.post(API_URL.format(token=self.token, metodo=metodo), data=parametri, timeout=TIMEOUT_RICHIESTA)
+        except requests.exceptions.RequestException as e:
+            return (ESITO_RIPROVA, attesa_backoff(tentativi), f"Errore rete: {e}", None)
+
+        try:
+            risposta = response.json()
+        except ValueError:
+            risposta = {}
+        if response.ok:
+            return (ESITO_INVIATO, 0, None, risposta.get("result"))
+        descrizione = f"{response.status_code} - {risposta.get('description', response.text[:200])}"
+        if response.status_code == 429:
+            retry_after = (risposta.get("parameters") or {}).get("retry_after") or response.headers.get("Retry-After") or BACKOFF_BASE
+            return (ESITO_RIPROVA, float(retry_after), descrizione, None)
+        if response.status_code >= 500:
+            return (ESITO_RIPROVA, attesa_backoff(tentativi), descrizione, None)
+        return (ESITO_SCARTATO, 0, descrizione, None)
+
+    def chiama(self, chat_id, metodo, attesa_massima=ATTESA_MASSIMA, **parametri):
+        """
+        Chiamata sincrona (non persistente) alla Bot API per i metodi di cui serve la risposta
+        (es. il message_id di sendMessage, editMessageText). Rispetta gli stessi limiti della coda
+        e ritenta 429/5xx finché l'attesa resta entro attesa_massima secondi.
+        Restituisce (risultato, errore): risultato è il campo `result`, None in caso di errore.
+        """
+        parametri["chat_id"] = chat_id
+        limite = time.monotonic() + attesa_massima
+        tentativi = 0
+        while True:
+            attesa = self._ultimo_invio.get(str(chat_id), float("-inf")) + intervallo_chat(chat_id) - time.monotonic()
+            if attesa > 0:
+                time.sleep(attesa)
+            self._limitatore.attendi()
+            esito, attesa, errore, risultato = self._esegui(metodo, parametri, tentativi)
+            self._ultimo_invio[str(chat_id)] = time.monotonic()
+            if esito == ESITO_INVIATO:
+                return (risultato, None)
+            if esito == ESITO_SCARTATO or time.monotonic() + attesa > limite:
+                logging.warning(f"[Telegram] {metodo} a {chat_id} non riuscito: {errore}")
+                return (None, errore)
+            tentativi += 1
+            time.sleep(attesa)
+
+    def invia_dovuti(self):
+        """Invia tutti i messaggi dovuti (chat diverse in parallelo) e restituisce il numero di messaggi consegnati."""
+        with self._lock_invio:
+            per_chat = self._pendenti_per_chat(time.time())
+            if not per_chat:
+                return 0
+            with ThreadPoolExecutor(max_workers=min(MAX_WORKER, len(per_chat))) as executor:
+                esiti = [esito for esiti_chat in executor.map(lambda voce: self._invia_chat(*voce), per_chat.items()) for esito in esiti_chat]
+            return self._registra_esiti(esiti)
+
+    def _registra_esiti(self, esiti):
+        inviati = 0
+        with self._lock_db:
+            for id_messaggio, chat_id, tentativi, esito, attesa, errore in esiti:
+                if esito == ESITO_INVIATO:
+                    self.conn.execute("DELETE FROM coda_telegram WHERE id = ?", (id_messaggio,))
+                    logging.info(f"[Telegram] Messaggio {id_messaggio} inviato a {chat_id}")
+                    inviati += 1
+                    continue
+                # I 429 non consumano tentativi: è la Bot API a indicare quando riprovare
+                tentativi = tentativi if errore.startswith("429") else tentativi + 1
+                if esito == ESITO_RIPROVA and tentativi < MAX_TENTATIVI:
+                    self.conn.execute("UPDATE coda_telegram SET tentativi = ?, prossimo_tentativo = ?, ultimo_errore = ? WHERE id = ?",
+                                      (tentativi, time.time() + attesa, errore, id_messaggio))
+                    logging.warning(f"[Telegram] Invio {id_messaggio} a {chat_id} fallito ({errore}), nuovo tentativo tra {attesa:.1f}s")
+                else:
+                    self.conn.execute("UPDATE coda_telegram SET stato = 'scartato', tentativi = ?, ultimo_errore = ?, scartato_alle = ? WHERE id = ?",
+                                      (tentativi, errore, time.time(), id_messaggio))
+                    logging.error(f"[Telegram] Messaggio {id_messaggio} a {chat_id} scartato dopo {tentativi} tentativi: {errore}")
+            self.conn.commit()
+        return inviati
+
+    def prossima_scadenza(self):
+        """
+        Timestamp del prossimo messaggio da ritentare, None se la coda è vuota. Conta solo il primo messaggio
+        di ogni chat: i successivi (già dovuti) aspettano il suo retry.
+        """
+        with self._lock_db:
+            return self.conn.execute(
+                "SELECT MIN(prossimo_tentativo) FROM coda_telegram WHERE id IN"
+                " (SELECT MIN(id) FROM coda_telegram WHERE bot = ? AND stato = 'in_coda' GROUP BY chat_id)",
+                (self.bot,)).fetchone()[0]
+
+    def elimina_scartati(self, adesso=None):
+        """Elimina i messaggi scartati da più di conserva_scartati secondi; restituisce quanti ne ha eliminati."""
+        adesso = time.time() if adesso is None else adesso
+        with self._lock_db:
+            eliminati = self.conn.execute("DELETE FROM coda_telegram WHERE bot = ? AND stato = 'scartato' AND scartato_alle < ?",
+                                          (self.bot, adesso - self.conserva_scartati)).rowcount
+            self.conn.commit()
+        if eliminati:
+            logging.info(f"[Telegram] Eliminati {eliminati} messaggi scartati da più di {self.conserva_scartati:g}s")
+        return eliminati
+
+    def svuota(self, attesa_massima=ATTESA_MASSIMA):
+        """
+        Invia i messaggi in coda, attendendo i retry che scadono entro attesa_massima secondi.
+        Restituisce True se la coda è stata svuotata.
+        """
+        self.elimina_scartati()
+        limite = time.time() + attesa_massima
+        while True:
+            self.invia_dovuti()
+            scadenza = self.prossima_scadenza()
+            if scadenza is None:
+                return True
+            if scadenza > limite:
+                return False
+            time.sleep(max(0.0, scadenza - time.time()))
+
+    def in_coda(self, id_messaggio):
+        with self._lock_db:
+            return self.conn.execute("SELECT 1 FROM coda_telegram WHERE id = ?", (id_messaggio,)).fetchone() is not None
+
+    def invia(self, chat_id, testo, parse_mode=None, attesa_massima=ATTESA_MASSIMA):
+        """
+        Accoda un messaggio (diviso in parti se troppo lungo) e prova a consegnarlo, insieme agli
+        eventuali arretrati, entro attesa_massima secondi.
+        Restituisce True se tutte le parti sono state consegnate; le altre restano in coda per i tentativi successivi.
+        """
+        id_messaggi = self.accoda_testo(chat_id, testo, parse_mode)
+        self.svuota(attesa_massima)
+        return not any(self.in_coda(id_messaggio) for id_messaggio in id_messaggi)
+
+
+# Una coda per token, condivisa dagli script caricati nello stesso processo (es. daemon)
+_code = {}
+_lock_code = threading.Lock()
+
+
+def coda(token):
+    """Restituisce la coda condivisa del bot indicato, creandola alla prima richiesta."""
+    with _lock_code:
+        if token not in _code:
+            _code[token] = CodaTelegram(token)
+        return _code[token]
+
+
+def invia_messaggio(token, chat_id, testo, parse_mode=None):
+    """Scorciatoia usata dagli script: accoda e consegna tramite la coda del bot."""
+    return coda(token).invia(chat_id, testo, parse_mode=parse_mode)
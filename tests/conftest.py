@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""I moduli del progetto sono file piatti nella radice del repository."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
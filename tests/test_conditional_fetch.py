@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import json
+
+import requests
+
+import conditional_fetch
+
+URL = "http://retemir.test/rt-data"
+BODY = b'[{"codice": 752, "nome": "Misa"}]'
+
+
+class SessioneFinta(requests.Session):
+    """Risponde con BODY ed ETag "v1", oppure 304 se la richiesta porta quell'ETag."""
+
+    def __init__(self):
+        super().__init__()
+        self.richieste = []
+
+    def get(self, url, headers=None, timeout=None, verify=None):
+        self.richieste.append(dict(headers or {}))
+        response = requests.Response()
+        response.url = url
+        if (headers or {}).get("If-None-Match") == '"v1"':
+            response.status_code = 304
+            response._content = b""
+        else:
+            response.status_code = 200
+            response._content = BODY
+            response.headers["ETag"] = '"v1"'
+        return response
+
+
+def test_validatori_salvati_tra_esecuzioni(tmp_path):
+    percorso = str(tmp_path / "stato_fetch.json")
+    primo = conditional_fetch.FetchCondizionale(SessioneFinta(), percorso)
+    risultato = primo.get(URL, "allerte")
+    assert risultato.dati == [{"codice": 752, "nome": "Misa"}]
+    primo.conferma(risultato)
+    with open(percorso, encoding="utf-8") as f:
+        assert json.load(f)["validatori"][URL]["etag"] == '"v1"'
+
+    # Nuovo processo: richiesta condizionale dai validatori su disco, 304 e payload invariato
+    sessione = SessioneFinta()
+    secondo = conditional_fetch.FetchCondizionale(sessione, percorso)
+    risultato = secondo.get(URL, "allerte")
+    assert sessione.richieste == [{"If-None-Match": '"v1"'}]
+    assert risultato.invariato and risultato.body is None
+    assert risultato.versione == conditional_fetch.calcola_versione(BODY)
+
+
+def test_body_riscaricato_dopo_304_senza_copia(tmp_path):
+    percorso = str(tmp_path / "stato_fetch.json")
+    conditional_fetch.FetchCondizionale(SessioneFinta(), percorso).get(URL, "allerte").dati
+
+    # Un altro consumatore non ha mai elaborato la versione: serve il body anche dopo il 304
+    sessione = SessioneFinta()
+    fetcher = conditional_fetch.FetchCondizionale(sessione, percorso)
+    risultato = fetcher.get(URL, "report")
+    assert not risultato.invariato
+    assert risultato.dati_filtrati(lambda record: True) == [{"codice": 752, "nome": "Misa"}]
+    assert sessione.richieste == [{"If-None-Match": '"v1"'}, {}]
+
+
+def test_stato_nel_formato_precedente(tmp_path):
+    percorso = tmp_path / "stato_fetch.json"
+    versione = conditional_fetch.calcola_versione(BODY)
+    percorso.write_text(json.dumps({f"allerte {URL}": versione}), encoding="utf-8")
+    sessione = SessioneFinta()
+    risultato = conditional_fetch.FetchCondizionale(sessione, str(percorso)).get(URL, "allerte")
+    # Nessun validatore salvato: download completo, ma la versione confermata resta valida
+    assert sessione.richieste == [{}]
+    assert risultato.invariato
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import re
+
+import message_splitter
+from message_splitter import LIMITE_TELEGRAM, dividi_messaggio, lunghezza_telegram
+
+NUMERAZIONE = re.compile(r"\n\n📄 (\d+)/(\d+)$")
+
+
+def senza_numerazione(parti):
+    return [NUMERAZIONE.sub("", parte) for parte in parti]
+
+
+def report(bacini, stazioni_per_bacino):
+    sezioni = []
+    for b in range(bacini):
+        righe = [f"🌊 *Bacino {b}*", ""]
+        for s in range(stazioni_per_bacino):
+            righe += [f"📍 Stazione {b}-{s}", f"   ‼️ Livello Idrometrico: {s}.25 m (soglia 1.00 m) 📈"]
+        sezioni.append("\n".join(righe))
+    return "\n\n".join(sezioni)
+
+
+def test_lunghezza_in_unita_utf16():
+    assert lunghezza_telegram("abc") == 3
+    assert lunghezza_telegram("🌊") == 2
+    assert lunghezza_telegram("è") == 1
+
+
+def test_testo_nel_limite_resta_intero():
+    testo = report(2, 3)
+    assert dividi_messaggio(testo) == [testo]
+
+
+def test_parti_numerate_e_nel_limite_utf16():
+    # 3000 caratteri ma 6000 unità UTF-16: va diviso anche se len() sta nel limite
+    testo = "\n".join(["🌊🌊🌊🌊🌊🌊🌊🌊🌊🌊"] * 300)
+    assert len(testo) < LIMITE_TELEGRAM < lunghezza_telegram(testo)
+    parti = dividi_messaggio(testo)
+    assert len(parti) == 2
+    for numero, parte in enumerate(parti, 1):
+        assert lunghezza_telegram(parte) <= LIMITE_TELEGRAM
+        assert NUMERAZIONE.search(parte).groups() == (str(numero), "2")
+    assert "\n".join(senza_numerazione(parti)) == testo
+
+
+def test_taglio_ai_confini_di_bacino_e_stazione():
+    testo = report(6, 20)
+    parti = senza_numerazione(dividi_messaggio(testo))
+    assert len(parti) > 1
+    for parte in parti:
+        # Ogni parte inizia con un titolo di bacino o con il blocco di una stazione, mai con una riga di sensore
+        assert parte.startswith(("🌊 *Bacino", "📍 Stazione"))
+        # Un titolo di bacino non resta in fondo a una parte
+        assert not parte.rstrip().endswith("*")
+    righe_originali = [riga for riga in testo.split("\n") if riga.strip()]
+    assert [riga for parte in parti for riga in parte.split("\n") if riga.strip()] == righe_originali
+
+
+def test_riga_lunga_con_entita_riequilibrate():
+    riga = "*" + "parola " * 1500 + "*" + " _corsivo_"
+    parti = senza_numerazione(dividi_messaggio(riga))
+    assert len(parti) > 1
+    for parte in parti:
+        assert lunghezza_telegram(parte) <= LIMITE_TELEGRAM - message_splitter.RISERVA_NUMERAZIONE
+        assert message_splitter._marcatori_aperti(parte) == []
+        assert parte.count("*") % 2 == 0
+    # Le entità richiuse e riaperte ai bordi non cambiano il contenuto
+    assert "".join(parti).replace("*", "") == riga.replace("*", "")
+
+
+def test_escape_non_separato_dal_carattere_protetto():
+    # Il taglio cadrebbe subito dopo "\\" (spazio utile 4080 - 6 marcatori)
+    riga = "a" * 4073 + "\\_" + "b" * 100
+    pezzi = message_splitter._spezza_riga(riga, LIMITE_TELEGRAM - message_splitter.RISERVA_NUMERAZIONE)
+    assert len(pezzi) == 2
+    assert pezzi[0] == "a" * 4073
+    assert "".join(pezzi) == riga
+    assert message_splitter._marcatori_aperti(pezzi[0]) == []
+
+
+def test_riga_di_emoji_senza_spezzare_i_caratteri():
+    riga = "🌊" * 5000
+    parti = dividi_messaggio(riga)
+    assert all(lunghezza_telegram(parte) <= LIMITE_TELEGRAM for parte in parti)
+    assert "".join(senza_numerazione(parti)) == riga
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import rate_of_rise
+import threshold_state
+
+SOGLIE = {30: 0.8}
+MISA = (752, 100)
+
+
+def test_velocita_su_finestra_coperta():
+    finestra = rate_of_rise.FinestraMobile(30 * 60)
+    for minuto, valore in ((0, 1.0), (10, 1.1), (20, 1.2), (30, 1.3), (40, 1.5)):
+        finestra.aggiungi(minuto * 60, valore)
+    # Parte dall'ultimo campione non successivo all'inizio della finestra (minuto 10)
+    assert [t for t, _ in finestra.campioni] == [600, 1200, 1800, 2400]
+    assert finestra.velocita() == pytest.approx(0.8)
+
+
+def test_velocita_senza_copertura():
+    finestra = rate_of_rise.FinestraMobile(30 * 60)
+    finestra.aggiungi(0, 1.0)
+    assert finestra.velocita() is None
+    finestra.aggiungi(10 * 60, 1.5)
+    # 10 minuti su 30: sotto COPERTURA_MINIMA
+    assert finestra.velocita() is None
+
+
+def test_partenza_prima_di_un_buco_ignorata():
+    finestra = rate_of_rise.FinestraMobile(30 * 60)
+    finestra.aggiungi(0, 1.0)
+    finestra.aggiungi(60 * 60, 2.0)
+    # Unico campione di partenza 60 minuti prima: oltre COPERTURA_MASSIMA × 30 minuti
+    assert finestra.velocita() is None
+    finestra.aggiungi(80 * 60, 2.5)
+    assert finestra.velocita() == pytest.approx(1.5)
+
+
+def test_superamento_e_rientro():
+    motore = rate_of_rise.MotoreVelocitaCrescita()
+    assert motore.aggiorna(*MISA, 0, 1.0, SOGLIE) == []
+    eventi = motore.aggiorna(*MISA, 20 * 60, 1.5, SOGLIE)
+    assert [(evento, minuti) for evento, minuti, _, _ in eventi] == [(threshold_state.EVENTO_SUPERAMENTO, 30)]
+    assert motore.ha_allerte_attive()
+    # Campione già visto: ignorato
+    assert motore.aggiorna(*MISA, 20 * 60, 9.9, SOGLIE) == []
+    eventi = motore.aggiorna(*MISA, 40 * 60, 1.5, SOGLIE)
+    assert [(evento, minuti) for evento, minuti, _, _ in eventi] == [(threshold_state.EVENTO_RIENTRO, 30)]
+    assert not motore.ha_allerte_attive()
+
+
+def test_buco_nei_dati_dimentica_allerta():
+    motore = rate_of_rise.MotoreVelocitaCrescita()
+    motore.aggiorna(*MISA, 0, 1.0, SOGLIE)
+    motore.aggiorna(*MISA, 20 * 60, 1.5, SOGLIE)
+    assert motore.ha_allerte_attive()
+    # Il sensore torna dopo un'ora: la finestra non è coperta, l'allerta si chiude senza notifica
+    assert motore.aggiorna(*MISA, 80 * 60, 1.5, SOGLIE) == []
+    assert not motore.ha_allerte_attive()
+
+
+def test_sensore_senza_campioni_scade():
+    motore = rate_of_rise.MotoreVelocitaCrescita()
+    motore.aggiorna(*MISA, 0, 1.0, SOGLIE)
+    motore.aggiorna(*MISA, 20 * 60, 1.5, SOGLIE)
+    assert motore.scadi(adesso=60 * 60) == []
+    assert motore.ha_allerte_attive()
+    # Oltre COPERTURA_MASSIMA × 30 minuti dall'ultimo campione
+    assert motore.scadi(adesso=70 * 60) == [(752, 100, 30)]
+    assert not motore.ha_allerte_attive()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import stream_decode
+
+PAYLOAD = [
+    {"codice": 752, "nome": "Misa", "lastUpdateTime": "2026-10-17 05:30",
+     "analog": [{"tipoSens": 100, "valore": "1.25", "trend": 0.01}, {"tipoSens": 0, "valore": 2.5}]},
+    {"codice": 9001, "nome": "Altrove", "analog": [{"tipoSens": 100, "valore": "0.3"}], "extra": {"a": [1, 2]}},
+    {"nome": "Senza codice", "codice": None},
+    {"codice": 732, "analog": [], "nome": "Arcevia"},
+    [1, 2],
+    "testo",
+]
+
+
+@pytest.fixture(params=["ijson", "json.loads"])
+def decodifica(request, monkeypatch):
+    if request.param == "ijson":
+        pytest.importorskip("ijson")
+    else:
+        monkeypatch.setattr(stream_decode, "ijson", None)
+    return stream_decode.decodifica_array
+
+
+def test_tiene_solo_i_record_filtrati(decodifica):
+    visti = []
+
+    def tieni(record):
+        visti.append(dict(record))
+        return record.get("codice") in (752, 732)
+
+    body = json.dumps(PAYLOAD).encode()
+    assert decodifica(body, tieni) == [PAYLOAD[0], PAYLOAD[3], [1, 2], "testo"]
+    # Il filtro vede almeno i campi semplici che precedono il primo campo annidato
+    assert visti[0]["codice"] == 752 and visti[0]["nome"] == "Misa"
+
+
+def test_filtro_con_campi_semplici_dopo_quelli_annidati(decodifica):
+    # "nome" dopo "analog": in streaming il filtro decide con i soli campi letti fino ad "analog"
+    body = json.dumps([{"codice": 732, "analog": [{"tipoSens": 0}], "nome": "Arcevia"}]).encode()
+    assert decodifica(body, lambda record: "codice" in record) == [{"codice": 732, "analog": [{"tipoSens": 0}], "nome": "Arcevia"}]
+
+
+def test_valori_numerici_come_float(decodifica):
+    body = b'[{"codice": 752, "analog": [{"valore": 1.25, "trend": -0.5}]}]'
+    record, = decodifica(body, lambda record: True)
+    assert record["analog"][0] == {"valore": 1.25, "trend": -0.5}
+    assert type(record["analog"][0]["valore"]) is float
+
+
+@pytest.mark.parametrize("body", [b'{"codice": 752}', b'[{"codice": 752', b"non json", b""])
+def test_body_non_valido(decodifica, body):
+    assert decodifica(body, lambda record: True, "rt-data") is None
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import subscriptions
+
+
+@pytest.fixture(autouse=True)
+def ambiente(monkeypatch):
+    monkeypatch.delenv("SOTTOSCRIZIONI_JSON", raising=False)
+    monkeypatch.setenv("TELEGRAM_CHAT_ID", "111")
+
+
+def carica(monkeypatch, tmp_path, testo):
+    monkeypatch.setenv("SOTTOSCRIZIONI_JSON", testo)
+    return subscriptions.carica_registro(str(tmp_path / "assente.json"))
+
+
+def solo_predefinita(registro):
+    return [(s.chat_id, s.nome) for s in registro.sottoscrizioni] == [("111", "predefinita")]
+
+
+def test_registro_valido(monkeypatch, tmp_path):
+    registro = carica(monkeypatch, tmp_path, json.dumps([
+        {"chat_id": -100123, "nome": "COC Senigallia", "bacini": ["Misa", "Nevola"], "aree_allerta": "2"},
+        {"chat_id": "-100456", "bacini": "*"},
+    ]))
+    assert len(registro) == 2
+    assert registro.chat_per(subscriptions.BACINI, "Misa") == ["-100123", "-100456"]
+    assert registro.chat_per(subscriptions.BACINI, "Cesano") == ["-100456"]
+    assert registro.chat_per(subscriptions.AREE_ALLERTA, 2) == ["-100123", "-100456"]
+
+
+@pytest.mark.parametrize("testo", ["[{\"chat_id\": ", "{\"chat_id\": \"-100123\"}", "[\"-100123\"]", "[]"])
+def test_registro_non_utilizzabile_usa_la_chat_predefinita(monkeypatch, tmp_path, testo):
+    assert solo_predefinita(carica(monkeypatch, tmp_path, testo))
+
+
+def test_voci_non_valide_ignorate(monkeypatch, tmp_path, caplog):
+    registro = carica(monkeypatch, tmp_path, json.dumps([
+        {"nome": "senza chat"},
+        {"chat_id": "-1", "bacinii": ["Misa"]},
+        {"chat_id": "-2", "bacini": {"Misa": True}},
+        {"chat_id": "-3", "aree_allerta": [2, None]},
+        {"chat_id": True},
+        {"chat_id": "-4", "bacini": []},
+    ]))
+    assert [s.chat_id for s in registro.sottoscrizioni] == ["-4"]
+    assert registro.chat_per(subscriptions.BACINI, "Misa") == []
+    assert "campi sconosciuti ['bacinii']" in caplog.text
+
+
+def test_file_del_registro(monkeypatch, tmp_path):
+    percorso = tmp_path / "sottoscrizioni.json"
+    percorso.write_text("non è JSON", encoding="utf-8")
+    assert solo_predefinita(subscriptions.carica_registro(str(percorso)))
+    percorso.write_text(json.dumps([{"chat_id": "-100123", "stazioni_weatherlink": ["Montignano"]}]), encoding="utf-8")
+    registro = subscriptions.carica_registro(str(percorso))
+    assert registro.chat_per(subscriptions.STAZIONI_WEATHERLINK, "Montignano") == ["-100123"]
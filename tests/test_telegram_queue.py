@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+import pytest
+import requests
+
+import telegram_queue
+
+
+class SessioneFinta(requests.Session):
+    """Risponde alle chiamate alla Bot API con le risposte preparate (status, corpo JSON), in ordine."""
+
+    def __init__(self, risposte):
+        super().__init__()
+        self.risposte = list(risposte)
+        self.inviati = []
+
+    def post(self, url, data=None, timeout=None):
+        self.inviati.append(data["text"])
+        status, corpo = self.risposte.pop(0)
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(corpo).encode()
+        return response
+
+
+@pytest.fixture(autouse=True)
+def senza_intervalli(monkeypatch):
+    monkeypatch.setattr(telegram_queue, "INTERVALLO_CHAT", 0.0)
+
+
+def crea_coda(tmp_path, risposte, **kwargs):
+    return telegram_queue.CodaTelegram("123:abc", str(tmp_path / "coda.sqlite3"), SessioneFinta(risposte), **kwargs)
+
+
+def righe(coda):
+    return coda.conn.execute("SELECT stato, tentativi, prossimo_tentativo, ultimo_errore FROM coda_telegram ORDER BY id").fetchall()
+
+
+def test_429_attende_retry_after_senza_consumare_tentativi(tmp_path):
+    coda = crea_coda(tmp_path, [(429, {"ok": False, "description": "Too Many Requests", "parameters": {"retry_after": 7}})])
+    coda.accoda_testo(42, "primo")
+    coda.accoda_testo(42, "secondo")
+    prima = time.time()
+    assert coda.invia_dovuti() == 0
+    # Il secondo messaggio della chat aspetta il primo
+    assert coda.session.inviati == ["primo"]
+    (stato, tentativi, prossimo, errore), secondo = righe(coda)
+    assert (stato, tentativi) == ("in_coda", 0)
+    assert prima + 7 <= prossimo <= time.time() + 7
+    assert errore.startswith("429")
+    assert secondo[0] == "in_coda"
+    # La prossima scadenza è il retry del primo, anche se il secondo era già dovuto: nessuna attesa attiva
+    inizio = time.monotonic()
+    assert coda.svuota(attesa_massima=1) is False
+    assert time.monotonic() - inizio < 1
+    assert coda.session.inviati == ["primo"]
+
+
+def test_5xx_backoff_e_scarto_dopo_max_tentativi(tmp_path, monkeypatch):
+    monkeypatch.setattr(telegram_queue, "MAX_TENTATIVI", 2)
+    coda = crea_coda(tmp_path, [(502, {"ok": False, "description": "Bad Gateway"})] * 2)
+    coda.accoda_testo(42, "testo")
+    prima = time.time()
+    coda.invia_dovuti()
+    stato, tentativi, prossimo, _ = righe(coda)[0]
+    assert (stato, tentativi) == ("in_coda", 1)
+    # attesa_backoff(0): BACKOFF_BASE con jitter tra 0.5 e 1
+    assert prima + telegram_queue.BACKOFF_BASE * 0.5 <= prossimo <= time.time() + telegram_queue.BACKOFF_BASE
+
+    coda.conn.execute("UPDATE coda_telegram SET prossimo_tentativo = 0")
+    coda.invia_dovuti()
+    assert righe(coda)[0][:2] == ("scartato", 2)
+
+
+def test_backoff_limitato():
+    for tentativi in range(20):
+        attesa = telegram_queue.attesa_backoff(tentativi)
+        assert 0 < attesa <= telegram_queue.BACKOFF_MASSIMO
+
+
+def test_scartati_eliminati_dopo_la_conservazione(tmp_path):
+    coda = crea_coda(tmp_path, [(400, {"ok": False, "description": "Bad Request: chat not found"}), (200, {"ok": True, "result": {}})],
+                     conserva_scartati=3600)
+    coda.accoda_testo(42, "rifiutato")
+    coda.invia_dovuti()
+    assert righe(coda)[0][0] == "scartato"
+    assert coda.elimina_scartati() == 0
+    assert coda.elimina_scartati(adesso=time.time() + 3601) == 1
+    assert righe(coda) == []
+
+
+def test_svuota_elimina_gli_scartati_scaduti(tmp_path):
+    coda = crea_coda(tmp_path, [(400, {"ok": False, "description": "Bad Request"}), (200, {"ok": True, "result": {}})],
+                     conserva_scartati=0)
+    assert coda.invia(42, "rifiutato", attesa_massima=0) is False
+    assert coda.invia(42, "consegnato", attesa_massima=0) is True
+    assert righe(coda) == []
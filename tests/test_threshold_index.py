@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import station_registry
+import threshold_index
+
+
+def indice_per(registro):
+    return threshold_index.compila_indice_soglie(["Barbara", "Misa"], {"Misa": {100: 1.8}}, {0: 15.0}, registro)
+
+
+def test_soglie_per_codice_con_sorgente():
+    registro = station_registry.RegistroStazioni({"Barbara": "Misa", "Misa": "Misa"})
+    registro.filtra([{"codice": 745, "nome": "Barbara"}, {"codice": 752, "nome": "Misa"}])
+    indice = indice_per(registro)
+
+    assert indice.ha_soglie(752)
+    assert indice.cerca(752, 100) == threshold_index.VoceSoglia(1.8, "Specifica (Misa)")
+    assert indice.cerca(752, 0) == threshold_index.VoceSoglia(15.0, "Generica")
+    assert indice.cerca(745, 100) is None
+
+
+def test_codice_non_monitorato_o_assente_senza_soglie():
+    registro = station_registry.RegistroStazioni({"Misa": "Misa"})
+    registro.filtra([{"codice": 999, "nome": "Altra"}])
+    indice = indice_per(registro)
+
+    assert not indice.ha_soglie(999)
+    assert not indice.ha_soglie(None)
+
+
+def test_stazione_rinominata_mantiene_le_soglie_del_codice():
+    registro = station_registry.RegistroStazioni({"Misa": "Misa"}, {"Misa": 752})
+    indice = indice_per(registro)
+    stazioni = registro.filtra([{"codice": 752, "nome": "Misa (Senigallia)"}])
+
+    assert [voce.nome for voce, _ in stazioni] == ["Misa"]
+    assert indice.ha_soglie(752)
+    assert indice.cerca(752, 100).soglia == 1.8
+
+
+def test_codice_associato_dopo_la_compilazione():
+    registro = station_registry.RegistroStazioni({"Misa": "Misa"})
+    indice = indice_per(registro)
+    assert not indice.ha_soglie(752)
+
+    registro.filtra([{"codice": 752, "nome": "Misa"}])
+    assert indice.ha_soglie(752)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import snapshot_eval
+import station_registry
+import threshold_index
+import threshold_state
+
+MISA = (752, 100)
+
+
+@pytest.fixture
+def stato(tmp_path):
+    stato = threshold_state.StatoSoglie(str(tmp_path / "stato.sqlite3"), margine_aggravamento=0.10, scadenza=3600)
+    yield stato
+    stato.close()
+
+
+def ha_soglia(nome, tipo_sens):
+    return (nome, tipo_sens) == ("Misa", 100)
+
+
+def test_transizioni(stato):
+    assert stato.registra(*MISA, 1.5, 2.0, "Misa") is None
+    assert stato.registra(*MISA, 2.1, 2.0, "Misa") == threshold_state.EVENTO_SUPERAMENTO
+    # Crescita inferiore al margine (10% della soglia = 0.2): nessuna nuova notifica
+    assert stato.registra(*MISA, 2.2, 2.0, "Misa") is None
+    assert stato.registra(*MISA, 2.4, 2.0, "Misa") == threshold_state.EVENTO_AGGRAVAMENTO
+    assert stato.ha_soglie_superate()
+    assert stato.registra(*MISA, 2.0, 2.0, "Misa") == threshold_state.EVENTO_RIENTRO
+    assert not stato.ha_soglie_superate()
+    assert stato.registra(*MISA, 1.0, 2.0, "Misa") is None
+
+
+def test_stato_persistente(tmp_path):
+    percorso = str(tmp_path / "stato.sqlite3")
+    stato = threshold_state.StatoSoglie(percorso)
+    stato.registra(*MISA, 2.5, 2.0, "Misa")
+    stato.commit()
+    stato.close()
+
+    riaperto = threshold_state.StatoSoglie(percorso)
+    assert set(riaperto.chiavi()) == {MISA}
+    assert riaperto.registra(*MISA, 2.6, 2.0, "Misa") is None
+    assert riaperto.registra(*MISA, 1.0, 2.0, "Misa") == threshold_state.EVENTO_RIENTRO
+    riaperto.close()
+
+
+def test_soglia_rimossa_dalla_configurazione(stato):
+    stato.registra(*MISA, 2.5, 2.0, "Misa")
+    rimosse = stato.aggiorna_assenti({MISA}, lambda nome, tipo_sens: False)
+    assert rimosse == [MISA + ("Misa", threshold_state.MOTIVO_SOGLIA_RIMOSSA)]
+    assert not stato.ha_soglie_superate()
+
+
+def test_stazione_assente_scade_dopo_la_scadenza(stato):
+    stato.registra(*MISA, 2.5, 2.0, "Misa")
+    inizio = stato._visto[MISA]
+    assert stato.aggiorna_assenti(set(), ha_soglia, adesso=inizio + 1800) == []
+    assert stato.ha_soglie_superate()
+    rimosse = stato.aggiorna_assenti(set(), ha_soglia, adesso=inizio + 3601)
+    assert rimosse == [MISA + ("Misa", threshold_state.MOTIVO_SCADUTA)]
+    assert not stato.ha_soglie_superate()
+
+
+def test_lettura_valida_rinnova_la_scadenza(stato):
+    stato.registra(*MISA, 2.5, 2.0, "Misa")
+    inizio = stato._visto[MISA]
+    assert stato.aggiorna_assenti({MISA}, ha_soglia, adesso=inizio + 3000) == []
+    assert stato.aggiorna_assenti(set(), ha_soglia, adesso=inizio + 5000) == []
+    assert stato.aggiorna_assenti(set(), ha_soglia, adesso=inizio + 6601) != []
+
+
+def test_scadenza_sopravvive_alla_riapertura(tmp_path):
+    percorso = str(tmp_path / "stato.sqlite3")
+    stato = threshold_state.StatoSoglie(percorso, scadenza=3600)
+    stato.registra(*MISA, 2.5, 2.0, "Misa")
+    inizio = stato._visto[MISA]
+    stato.commit()
+    stato.close()
+
+    riaperto = threshold_state.StatoSoglie(percorso, scadenza=3600)
+    assert riaperto.aggiorna_assenti(set(), ha_soglia, adesso=inizio + 3601) != []
+    riaperto.close()
+
+
+@pytest.mark.parametrize("valore", ["", "nan", None])
+def test_valore_vuoto_o_nan_non_rinnova_la_scadenza(stato, valore):
+    registro = station_registry.RegistroStazioni({"Misa": "Misa"})
+    stazioni = [(voce.nome, voce.bacino, record) for voce, record in registro.filtra(
+        [{"codice": 752, "nome": "Misa", "analog": [{"tipoSens": 100, "valore": valore}]}])]
+    indice = threshold_index.compila_indice_soglie(["Misa"], {"Misa": {100: 2.0}}, {}, registro)
+    snapshot = snapshot_eval.costruisci_snapshot(stazioni, indice, [100])
+    righe = snapshot.valido
+    lette = set(zip(snapshot.codice[righe].tolist(), snapshot.tipo_sens[righe].tolist()))
+    assert len(snapshot) == 1 and not np.any(snapshot.valido) and lette == set()
+
+    stato.registra(*MISA, 2.5, 2.0, "Misa")
+    inizio = stato._visto[MISA]
+    esiste = lambda nome, tipo_sens: indice.cerca_nome(nome, tipo_sens) is not None
+    assert stato.aggiorna_assenti(lette, esiste, adesso=inizio + 3601) == [MISA + ("Misa", threshold_state.MOTIVO_SCADUTA)]
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Configurazione delle soglie stazioni da file, con ricarica a caldo.
+
+THRESHOLDS_JSON.txt (percorso alternativo in SOGLIE_CONFIG) è l'unica sorgente
+delle soglie per tutti gli script:
+
+  {
+    "soglie_generiche":         {"<tipoSens>": soglia},
+    "soglie_per_stazione":      {"<stazione>": {"<tipoSens>": soglia}},
+    "soglie_velocita_crescita": {"<stazione>": {"<tipoSens>": {"<minuti>": m/h}}}
+  }
+
+Il file viene validato per intero (chiavi numeriche, soglie numeriche
+positive); ogni script ne ricava l'indice per le proprie stazioni (e, se
+serve, solo per alcuni tipi di sensore, es. il report idrometrico).
+
+Nei processi residenti (daemon, bot) avvia_osservatore() controlla ogni
+SOGLIE_INTERVALLO_CONTROLLO secondi data di modifica e dimensione del file:
+se cambiano, il file viene riletto e la nuova configurazione sostituisce la
+precedente in un colpo solo (gli indici compilati sono legati alla versione,
+quindi un ciclo in corso continua con quelli vecchi). Un file non valido
+viene segnalato nei log e la configurazione precedente resta attiva. Nel
+ciclo di controllo non c'è alcuna lettura del file.
+
+Se al primo uso non c'è alcuna configurazione valida soglie() solleva
+ConfigSoglieNonValida (riprovando alla chiamata successiva): sono gli script
+a decidere se fermarsi. Le soglie per stazioni che uno script non monitora
+vengono segnalate nei log quando se ne compila l'indice.
+"""
+import os
+import json
+import logging
+import threading
+from collections import namedtuple
+
+import threshold_index
+
+PERCORSO_CONFIG = os.environ.get("SOGLIE_CONFIG",
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), "THRESHOLDS_JSON.txt"))
+INTERVALLO_CONTROLLO = float(os.environ.get("SOGLIE_INTERVALLO_CONTROLLO", "10"))
+
+SEZIONI = ("soglie_generiche", "soglie_per_stazione", "soglie_velocita_crescita")
+
+ConfigSoglie = namedtuple("ConfigSoglie", ["generiche", "per_stazione", "velocita_crescita"])
+# Configurazione valida con il suo numero di versione e gli indici già compilati per essa
+VersioneConfig = namedtuple("VersioneConfig", ["numero", "config", "indici"])
+
+
+class ConfigSoglieNonValida(Exception):
+    """Nessuna configurazione soglie valida: file assente o non valido e nessuna versione precedente."""
+
+
+def _intero(chiave, dove, errori):
+    try:
+        return int(chiave)
+    except (TypeError, ValueError):
+        errori.append(f"{dove}: chiave '{chiave}' non è un numero intero")
+        return None
+
+
+def _soglia(valore, dove, errori):
+    if isinstance(valore, bool) or not isinstance(valore, (int, float)) or not valore > 0:
+        errori.append(f"{dove}: soglia {valore!r} non valida (serve un numero positivo)")
+        return None
+    return valore
+
+
+def _dizionario(valore, dove, errori):
+    if not isinstance(valore, dict):
+        errori.append(f"{dove}: atteso un oggetto JSON, trovato {type(valore).__name__}")
+        return {}
+    return valore
+
+
+def _soglie_sensori(valore, dove, errori):
+    """{"<tipoSens>": soglia} -> {tipoSens: soglia}"""
+    return {
+        _intero(tipo, dove, errori): _soglia(soglia, f"{dove}[{tipo}]", errori)
+        for tipo, soglia in _dizionario(valore, dove, errori).items()
+    }
+
+
+def valida_config(dati):
+    """
+    Valida il contenuto del file. Restituisce (ConfigSoglie con chiavi intere, errori):
+    la configurazione è utilizzabile solo se la lista degli errori è vuota.
+    """
+    errori = []
+    dati = _dizionario(dati, "config", errori)
+    sconosciute = set(dati) - set(SEZIONI)
+    if sconosciute:
+        errori.append(f"config: sezioni sconosciute {sorted(sconosciute)} (ammesse: {', '.join(SEZIONI)})")
+
+    generiche = _soglie_sensori(dati.get("soglie_generiche", {}), "soglie_generiche", errori)
+    per_stazione = {
+        stazione: _soglie_sensori(soglie, f"soglie_per_stazione[{stazione}]", errori)
+        for stazione, soglie in _dizionario(dati.get("soglie_per_stazione", {}), "soglie_per_stazione", errori).items()
+    }
+    velocita_crescita = {}
+    for stazione, sensori in _dizionario(dati.get("soglie_velocita_crescita", {}), "soglie_velocita_crescita", errori).items():
+        dove = f"soglie_velocita_crescita[{stazione}]"
+        velocita_crescita[stazione] = {
+            _intero(tipo, dove, errori): {
+                _intero(minuti, f"{dove}[{tipo}]", errori): _soglia(soglia, f"{dove}[{tipo}][{minuti}]", errori)
+                for minuti, soglia in _dizionario(finestre, f"{dove}[{tipo}]", errori).items()
+            }
+            for tipo, finestre in _dizionario(sensori, dove, errori).items()
+        }
+    return ConfigSoglie(generiche, per_stazione, velocita_crescita), errori
+
+
+def carica_config(percorso=PERCORSO_CONFIG):
+    """Legge e valida il file di configurazione; restituisce (config, errore), config None se non utilizzabile."""
+    try:
+        with open(percorso, encoding="utf-8") as f:
+            dati = json.load(f)
+    except OSError as e:
+        return None, f"file non leggibile: {e}"
+    except json.JSONDecodeError as e:
+        return None, f"JSON non valido: {e}"
+    config, errori = valida_config(dati)
+    if errori:
+        return None, "; ".join(errori)
+    return config, None
+
+
+class SoglieCorrenti:
+    """Ultima configurazione valida del file soglie, ricaricata quando il file cambia."""
+
+    def __init__(self, percorso=PERCORSO_CONFIG):
+        self.percorso = percorso
+        self._lock = threading.Lock()
+        self._firma = None # (mtime_ns, dimensione) dell'ultimo file letto
+        self._versione = None
+        self.errore = None # motivo dell'ultimo caricamento fallito
+        self.ricarica_se_modificato()
+
+    def _firma_file(self):
+        try:
+            stat = os.stat(self.percorso)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def ricarica_se_modificato(self):
+        """Rilegge il file se è cambiato dall'ultima lettura; True se è stata attivata una nuova configurazione."""
+        firma = self._firma_file()
+        if firma is not None and firma == self._firma:
+            return False
+        with self._lock:
+            if firma is not None and firma == self._firma:
+                return False
+            config, errore = carica_config(self.percorso)
+            if config is None:
+                # Il file non viene riletto finché non cambia di nuovo
+                self._firma = firma
+                self.errore = errore
+                stato = "mantenuta la configurazione precedente" if self._versione else "nessuna configurazione disponibile"
+                logging.error(f"[Config Soglie] {self.percorso} non valido ({errore}): {stato}")
+                return False
+            numero = self._versione.numero + 1 if self._versione else 1
+            # Sostituzione in blocco: chi ha già letto la versione precedente la usa fino a fine ciclo
+            self._versione = VersioneConfig(numero, config, {})
+            self._firma = firma
+            self.errore = None
+        logging.info(f"[Config Soglie] Caricata versione {numero} da {self.percorso}: "
+                     f"{len(config.per_stazione)} stazioni con soglie specifiche, {len(config.generiche)} generiche")
+        return True
+
+    @property
+    def caricata(self):
+        return self._versione is not None
+
+    @property
+    def config(self):
+        return self._versione.config
+
+    def indice_soglie(self, stazioni, registro, tipi_sensore=None):
+        """
+        IndiceSoglie (threshold_index) della versione corrente per le stazioni indicate, con i codici
+        risolti dal registro (station_registry), limitato ai tipi_sensore se specificati. Compilato una volta per versione.
+        """
+        versione = self._versione
+        chiave = (tuple(stazioni), registro, frozenset(tipi_sensore) if tipi_sensore is not None else None)
+        indice = versione.indici.get(chiave)
+        if indice is None:
+            config = versione.config
+            if tipi_sensore is None:
+                per_stazione, generiche = config.per_stazione, config.generiche
+            else:
+                per_stazione = {stazione: {tipo: soglia for tipo, soglia in soglie.items() if tipo in tipi_sensore}
+                                for stazione, soglie in config.per_stazione.items()}
+                generiche = {tipo: soglia for tipo, soglia in config.generiche.items() if tipo in tipi_sensore}
+            non_monitorate = sorted(set(per_stazione) - set(stazioni))
+            if non_monitorate:
+                logging.warning(f"[Config Soglie] Versione {versione.numero}: soglie ignorate per stazioni non monitorate: "
+                                f"{', '.join(non_monitorate)}")
+            indice = versione.indici[chiave] = threshold_index.compila_indice_soglie(stazioni, per_stazione, generiche, registro)
+        return indice
+
+
+# Configurazione condivisa dagli script caricati nello stesso processo
+_soglie = None
+_lock_soglie = threading.Lock()
+_osservatore = None
+
+
+def soglie():
+    """SoglieCorrenti del processo; solleva ConfigSoglieNonValida se non c'è ancora una configurazione valida."""
+    global _soglie
+    with _lock_soglie:
+        if _soglie is None:
+            corrente = SoglieCorrenti()
+            if not corrente.caricata:
+                # Senza soglie valide i controlli non hanno senso; il file viene riletto alla prossima chiamata
+                raise ConfigSoglieNonValida(f"nessuna configurazione soglie valida in {corrente.percorso} ({corrente.errore})")
+            _soglie = corrente
+        return _soglie
+
+
+def indice_soglie(stazioni, registro, tipi_sensore=None):
+    return soglie().indice_soglie(stazioni, registro, tipi_sensore)
+
+
+def soglie_velocita_crescita():
+    """{stazione: {tipoSens: {minuti: soglia m/h}}} della versione corrente."""
+    return soglie().config.velocita_crescita
+
+
+def avvia_osservatore(intervallo=INTERVALLO_CONTROLLO):
+    """Avvia (una volta per processo) il thread che ricarica la configurazione quando il file cambia."""
+    global _osservatore
+    corrente = soglie()
+    with _lock_soglie:
+        if _osservatore is not None or intervallo <= 0:
+            return
+
+        def osserva():
+            while True:
+                threading.Event().wait(intervallo)
+                try:
+                    corrente.ricarica_se_modificato()
+                except Exception as e:
+                    logging.error(f"[Config Soglie] Errore nel controllo di {corrente.percorso}: {e}", exc_info=True)
+
+        _osservatore = threading.Thread(target=osserva, name="osservatore-soglie", daemon=True)
+        _osservatore.start()
+    logging.info(f"[Config Soglie] Osservatore avviato su {corrente.percorso} (ogni {intervallo:g}s)")
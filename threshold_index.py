@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Indice compilato delle soglie stazioni.
+
+Le soglie per stazione e generiche (threshold_config) vengono risolte una sola
+volta per versione della configurazione in un dizionario piatto (codice stazione, tipoSens) -> VoceSoglia, con la
+sorgente ("Specifica (...)" / "Generica") già calcolata. Nel ciclo sui sensori
+resta un solo lookup, e le stazioni e i sensori senza soglia vengono scartati
+prima di leggerne il valore.
+
+La configurazione è per nome di stazione: il nome canonico di ogni codice viene
+dal registro stazioni (station_registry, es. "Arcevia" per il codice 732), alla
+prima richiesta per quel codice. Se il registro associa il codice a un'altra
+anagrafica le voci del codice vengono ricompilate; se la stazione cambia nome nel
+payload il codice (e quindi le soglie) resta lo stesso. I record senza codice
+non hanno soglie.
+"""
+from collections import namedtuple
+
+VoceSoglia = namedtuple("VoceSoglia", ["soglia", "sorgente"])
+
+
+class IndiceSoglie:
+    """Soglie risolte per (codice stazione, tipoSens), più l'insieme dei sensori con soglia per ogni codice."""
+
+    def __init__(self, soglie_per_nome, registro):
+        self.soglie_per_nome = soglie_per_nome # nome stazione -> {tipoSens: VoceSoglia}
+        self.registro = registro
+        self.voci = {} # (codice, tipo_sens) -> VoceSoglia
+        self.sensori_per_codice = {} # codice -> frozenset dei tipoSens con soglia
+        self._anagrafiche = {} # codice -> AnagraficaStazione (o None) da cui sono state compilate le voci
+
+    def _compila_codice(self, codice):
+        anagrafica = self.registro.voce(codice)
+        if codice in self._anagrafiche and self._anagrafiche[codice] is anagrafica:
+            return
+        for tipo_sens in self.sensori_per_codice.pop(codice, ()):
+            del self.voci[(codice, tipo_sens)]
+        soglie = self.soglie_per_nome.get(anagrafica.nome, {}) if anagrafica else {}
+        for tipo_sens, voce in soglie.items():
+            self.voci[(codice, tipo_sens)] = voce
+        if soglie:
+            self.sensori_per_codice[codice] = frozenset(soglie)
+        self._anagrafiche[codice] = anagrafica
+
+    def ha_soglie(self, codice):
+        """True se la stazione ha almeno un sensore con soglia (le altre si possono saltare del tutto)."""
+        if codice is None:
+            return False
+        self._compila_codice(codice)
+        return codice in self.sensori_per_codice
+
+    def cerca(self, codice, tipo_sens):
+        """Restituisce la VoceSoglia per (codice, tipo_sens) oppure None se non c'è soglia (dopo ha_soglie(codice))."""
+        return self.voci.get((codice, tipo_sens))
+
+    def ha_soglie_nome(self, stazione):
+        """Come ha_soglie() per nome, per le stazioni di cui non si conosce il codice (es. escluse dal registro)."""
+        return stazione in self.soglie_per_nome
+
+    def cerca_nome(self, stazione, tipo_sens):
+        """Come cerca() per nome di stazione (es. per lo stato salvato di stazioni assenti dal payload)."""
+        return self.soglie_per_nome.get(stazione, {}).get(tipo_sens)
+
+    def __len__(self):
+        return sum(len(soglie) for soglie in self.soglie_per_nome.values())
+
+
+def compila_indice_soglie(stazioni, soglie_per_stazione, soglie_generiche, registro):
+    """
+    Compila l'indice per l'elenco di stazioni monitorate; i codici vengono risolti con il registro stazioni.
+    Le soglie specifiche hanno precedenza su quelle generiche, come nel controllo originale.
+    """
+    soglie_per_nome = {}
+    for stazione in stazioni:
+        voci = {tipo_sens: VoceSoglia(soglia, "Generica") for tipo_sens, soglia in soglie_generiche.items()}
+        for tipo_sens, soglia in soglie_per_stazione.get(stazione, {}).items():
+            voci[tipo_sens] = VoceSoglia(soglia, f"Specifica ({stazione})")
+        if voci:
+            soglie_per_nome[stazione] = voci
+    return IndiceSoglie(soglie_per_nome, registro)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Stato persistente dei superamenti soglia per coppia (stazione, tipoSens).
+
+Permette agli script di notificare solo le transizioni invece di ripetere
+lo stesso alert a ogni esecuzione:
+  - superamento  : il valore passa sopra soglia
+  - aggravamento : il valore, già sopra soglia, cresce di almeno
+                   MARGINE_AGGRAVAMENTO * soglia rispetto all'ultimo valore notificato
+  - rientro      : il valore torna sotto (o pari alla) soglia
+
+Lo stato è salvato in un file SQLite (STATO_SOGLIE_DB) e mantenuto anche in
+memoria, così il controllo per sensore è un lookup in dizionario e il file
+viene scritto solo quando cambia qualcosa.
+
+Una coppia sopra soglia che non viene più valutata non avrebbe mai un rientro:
+aggiorna_assenti() la rimuove subito se la sua soglia non è più configurata, e
+la fa scadere se resta senza una lettura valida (stazione assente dal payload,
+valore vuoto o non numerico) per più di STATO_SOGLIE_SCADENZA secondi.
+"""
+import os
+import time
+import sqlite3
+import logging
+from datetime import datetime
+
+import alert_records
+
+PERCORSO_DB = os.environ.get("STATO_SOGLIE_DB",
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), "stato_soglie.sqlite3"))
+# Frazione della soglia di cui deve crescere il valore per notificare un aggravamento
+MARGINE_AGGRAVAMENTO = float(os.environ.get("STATO_SOGLIE_MARGINE_AGGRAVAMENTO", "0.10"))
+# Secondi senza letture valide dopo cui una coppia sopra soglia viene dimenticata
+SCADENZA = float(os.environ.get("STATO_SOGLIE_SCADENZA", "21600"))
+
+MOTIVO_SOGLIA_RIMOSSA = "soglia non più configurata"
+MOTIVO_SCADUTA = "nessuna lettura valida"
+
+EVENTO_SUPERAMENTO = alert_records.EVENTO_SUPERAMENTO
+EVENTO_AGGRAVAMENTO = alert_records.EVENTO_AGGRAVAMENTO
+EVENTO_RIENTRO = alert_records.EVENTO_RIENTRO
+
+
+class StatoSoglie:
+    """Registro delle coppie (codice stazione, tipoSens) attualmente sopra soglia."""
+
+    def __init__(self, percorso=PERCORSO_DB, margine_aggravamento=MARGINE_AGGRAVAMENTO, scadenza=SCADENZA):
+        self.percorso = percorso
+        self.margine_aggravamento = margine_aggravamento
+        self.scadenza = scadenza
+        self.conn = sqlite3.connect(percorso)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS stato_soglie ("
+            " codice INTEGER NOT NULL, tipo_sens INTEGER NOT NULL, stazione TEXT,"
+            " valore_notificato REAL NOT NULL, soglia REAL NOT NULL, aggiornato TEXT, visto REAL,"
+            " PRIMARY KEY (codice, tipo_sens))"
+        )
+        colonne = {riga[1] for riga in self.conn.execute("PRAGMA table_info(stato_soglie)")}
+        if "visto" not in colonne:
+            self.conn.execute("ALTER TABLE stato_soglie ADD COLUMN visto REAL")
+        # Coppie salvate prima della scadenza: l'ora dell'ultima lettura parte da adesso, una volta sola
+        adesso = time.time()
+        self.conn.execute("UPDATE stato_soglie SET visto = ? WHERE visto IS NULL", (adesso,))
+        self.conn.commit()
+        # Cache in memoria: (codice, tipo_sens) -> valore_notificato, nome stazione e ora dell'ultima lettura valida
+        self._sopra_soglia = {}
+        self._stazioni = {}
+        self._visto = {}
+        for codice, tipo_sens, stazione, valore, visto in self.conn.execute(
+                "SELECT codice, tipo_sens, stazione, valore_notificato, visto FROM stato_soglie"):
+            self._sopra_soglia[(codice, tipo_sens)] = valore
+            self._stazioni[(codice, tipo_sens)] = stazione
+            self._visto[(codice, tipo_sens)] = visto
+        logging.info(f"[Stato Soglie] Caricate {len(self._sopra_soglia)} soglie attive da {percorso}")
+
+    def registra(self, codice, tipo_sens, valore, soglia, nome_stazione=None):
+        """
+        Aggiorna lo stato con una nuova lettura e restituisce l'evento da notificare
+        (EVENTO_SUPERAMENTO, EVENTO_AGGRAVAMENTO, EVENTO_RIENTRO) oppure None se non cambia nulla.
+        Le modifiche vanno confermate con commit() a fine ciclo.
+        """
+        chiave = (codice, tipo_sens)
+        valore_notificato = self._sopra_soglia.get(chiave)
+
+        if valore > soglia:
+            if valore_notificato is None:
+                evento = EVENTO_SUPERAMENTO
+            elif valore >= valore_notificato + self.margine_aggravamento * soglia:
+                evento = EVENTO_AGGRAVAMENTO
+            else:
+                return None
+            adesso = time.time()
+            self._sopra_soglia[chiave] = valore
+            self._stazioni[chiave] = nome_stazione
+            self._visto[chiave] = adesso
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stato_soglie (codice, tipo_sens, stazione, valore_notificato, soglia, aggiornato, visto)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (codice, tipo_sens, nome_stazione, valore, soglia, datetime.now().isoformat(timespec="seconds"), adesso)
+            )
+            return evento
+
+        if valore_notificato is not None:
+            self._rimuovi(chiave)
+            return EVENTO_RIENTRO
+        return None
+
+    def _rimuovi(self, chiave):
+        del self._sopra_soglia[chiave]
+        self._stazioni.pop(chiave, None)
+        self._visto.pop(chiave, None)
+        self.conn.execute("DELETE FROM stato_soglie WHERE codice = ? AND tipo_sens = ?", chiave)
+
+    def aggiorna_assenti(self, lette, ha_soglia, adesso=None):
+        """
+        Controlla le coppie sopra soglia rispetto al ciclo appena valutato: `lette` sono le coppie
+        (codice, tipo_sens) con una lettura valida, ha_soglia(nome_stazione, tipo_sens) dice se la soglia è
+        ancora configurata. Rimuove le coppie senza soglia e quelle senza letture valide da più di
+        `scadenza` secondi; restituisce la lista di (codice, tipo_sens, nome_stazione, motivo) rimosse.
+        Le modifiche vanno confermate con commit() a fine ciclo.
+        """
+        if not self._sopra_soglia:
+            return []
+        adesso = time.time() if adesso is None else adesso
+        rimosse = []
+        viste = []
+        for chiave in list(self._sopra_soglia):
+            nome_stazione = self._stazioni.get(chiave)
+            if not ha_soglia(nome_stazione, chiave[1]):
+                motivo = MOTIVO_SOGLIA_RIMOSSA
+            elif chiave in lette:
+                self._visto[chiave] = adesso
+                viste.append((adesso,) + chiave)
+                continue
+            elif adesso - self._visto.get(chiave, adesso) > self.scadenza:
+                motivo = MOTIVO_SCADUTA
+            else:
+                continue
+            self._rimuovi(chiave)
+            rimosse.append(chiave + (nome_stazione, motivo))
+        if viste:
+            self.conn.executemany("UPDATE stato_soglie SET visto = ? WHERE codice = ? AND tipo_sens = ?", viste)
+        return rimosse
+
+    def chiavi(self):
+        """Coppie (codice, tipo_sens) attualmente sopra soglia."""
+        return self._sopra_soglia.keys()
+
+    def ha_soglie_superate(self):
+        """True se almeno una coppia (stazione, sensore) è attualmente sopra soglia."""
+        return bool(self._sopra_soglia)
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -4,6 +4,12 @@ import hmac
 import hashlib
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import circuit_breaker
+import metrics
+import telegram_queue
+import subscriptions
 
 # --- Leggi le credenziali e le configurazioni Telegram dai segreti ---
 API_KEY = os.environ.get("WEATHERLINK_API_KEY")
@@ -11,17 +17,6 @@ API_SECRET = os.environ.get("WEATHERLINK_API_SECRET")
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")
 
-# Verifica che tutti i segreti siano stati impostati
-if not all([API_KEY, API_SECRET, TELEGRAM_TOKEN, TELEGRAM_CHAT_ID]):
-    missing = [k for k, v in {
-        "WEATHERLINK_API_KEY": API_KEY,
-        "WEATHERLINK_API_SECRET": API_SECRET,
-        "TELEGRAM_BOT_TOKEN": TELEGRAM_TOKEN,
-        "TELEGRAM_CHAT_ID": TELEGRAM_CHAT_ID
-    }.items() if not v]
-    print(f"Errore: Le seguenti variabili d'ambiente (secrets) mancano: {', '.join(missing)}")
-    exit(1)
-
 # --- Informazioni Stazioni (ID e Nome) ---
 STATIONS_INFO = [
     {"id": 177386, "name": "Montignano"},
@@ -54,7 +49,19 @@ TRANSLATIONS = {
 }
 # ------------------------------
 
-API_BASE_URL = "https://api.weatherlink.com/v2"
+# Sovrascrivibile per i test offline (mock_server)
+API_BASE_URL = os.environ.get("WEATHERLINK_API_BASE_URL", "https://api.weatherlink.com/v2").rstrip("/")
+API_HOST = urlsplit(API_BASE_URL).netloc # etichetta delle metriche
+
+# Numero massimo di richieste /current in parallelo (e di connessioni keep-alive nel pool)
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("WEATHERLINK_MAX_CONCURRENT", "16"))
+
+# Sessione HTTP condivisa: riusa le connessioni keep-alive tra una chiamata e l'altra
+# (utile soprattutto quando lo script gira dentro il daemon residente).
+# Il pool è dimensionato per le richieste parallele, così nessun thread apre connessioni extra.
+SESSION = requests.Session()
+for schema in ("https://", "http://"):
+    SESSION.mount(schema, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS))
 
 # --- Funzioni Helper ---
 
@@ -68,10 +75,18 @@ def get_weatherlink_data(endpoint_path, api_key, api_secret):
         final_params = {"api-key": api_key, "t": str(current_timestamp), "api-signature": api_signature}
         headers = {'X-Api-Secret': api_secret}
         full_url = f"{API_BASE_URL}{endpoint_path}"
-        response = requests.get(full_url, params=final_params, headers=headers, timeout=30)
+        with metrics.misura("meteo_fetch_secondi", host=API_HOST):
+            # Timeout massimo 30s, ridotto dal circuito dell'host in base alle latenze osservate
+            response = circuit_breaker.circuito(API_HOST).esegui(
+                lambda timeout: SESSION.get(full_url, params=final_params, headers=headers, timeout=timeout), 30)
+        metrics.incrementa("meteo_fetch_risposte_totale", host=API_HOST, stato=str(response.status_code))
+        metrics.incrementa("meteo_fetch_byte_totale", len(response.content), host=API_HOST)
         response.raise_for_status()
-        return response.json()
+        with metrics.misura("meteo_decodifica_secondi", host=API_HOST):
+            return response.json()
     except requests.exceptions.RequestException as e:
+        if e.response is None:
+            metrics.incrementa("meteo_fetch_risposte_totale", host=API_HOST, stato=type(e).__name__)
         print(f"Errore richiesta API per {endpoint_path}: {e}")
         if e.response is not None: print(f"  Status: {e.response.status_code}, Risposta: {e.response.text[:200]}...")
         return None
@@ -80,106 +95,158 @@ def get_weatherlink_data(endpoint_path, api_key, api_secret):
         return None
 
 def send_telegram_message(bot_token, chat_id, message):
-    """Invia un messaggio a una chat Telegram tramite un bot."""
-    api_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    payload = {
-        'chat_id': chat_id,
-        'text': message,
-        'parse_mode': 'MarkdownV2'
-    }
-    try:
-        response = requests.post(api_url, data=payload, timeout=15)
-        response.raise_for_status()
+    """Invia un messaggio a una chat Telegram tramite la coda di invio (telegram_queue)."""
+    if telegram_queue.invia_messaggio(bot_token, chat_id, message, parse_mode='MarkdownV2'):
         print(f"Messaggio Telegram inviato con successo (Chat ID: {chat_id}).")
         return True
-    except requests.exceptions.RequestException as e:
-        print(f"Errore invio messaggio Telegram: {e}")
-        if e.response is not None:
-             print(f"  Status: {e.response.status_code}, Risposta: {e.response.text}")
-        return False
-    except Exception as e:
-        print(f"Errore imprevisto in send_telegram_message: {e}")
-        return False
+    print(f"Messaggio Telegram non consegnato (Chat ID: {chat_id}), resta in coda per i tentativi successivi.")
+    return False
 
 def escape_markdown(text):
     """Effettua l'escape dei caratteri speciali per MarkdownV2 di Telegram."""
     escape_chars = r'_*[]()~`>#+-=|{}.!' # Non includere '=' qui
     return ''.join(f'\\{char}' if char in escape_chars else char for char in str(text))
 
-# --- Ciclo Principale ---
-print("--- Inizio controllo dati meteo e soglie ---")
 
-alerts_to_send = []
+def segreti_mancanti():
+    """Restituisce la lista delle variabili d'ambiente (secrets) non impostate."""
+    return [k for k, v in {
+        "WEATHERLINK_API_KEY": API_KEY,
+        "WEATHERLINK_API_SECRET": API_SECRET,
+        "TELEGRAM_BOT_TOKEN": TELEGRAM_TOKEN,
+        # La chat singola serve solo se non c'è un registro sottoscrizioni
+        "TELEGRAM_CHAT_ID": TELEGRAM_CHAT_ID or len(subscriptions.registro())
+    }.items() if not v]
 
-for station_info in STATIONS_INFO:
-    station_id = station_info["id"]
-    station_name = station_info["name"]
+def check_station_thresholds(station_name, full_data):
+    """Confronta i dati correnti di una stazione con THRESHOLDS e restituisce la lista di alert (MarkdownV2)."""
     safe_station_name = escape_markdown(station_name) # Nome stazione "sicuro" per Markdown
-    print(f"\n---> Controllo dati per Stazione: {safe_station_name} (ID: {station_id}) <---")
-    current_conditions_endpoint = f"/current/{station_id}"
-
-    full_data = get_weatherlink_data(current_conditions_endpoint, API_KEY, API_SECRET)
-
-    if full_data:
-        print(f"Dati ricevuti per {safe_station_name}, controllo soglie...")
-        station_alerts = []
-
-        try:
-            if full_data.get("sensors") and len(full_data["sensors"]) > 0:
-                sensor_data_list = full_data["sensors"][0].get("data")
-                if sensor_data_list and len(sensor_data_list) > 0:
-                    core_data = sensor_data_list[0]
-
-                    for data_key in DATA_TO_MONITOR: # Itera sulle chiavi API inglesi
-                        current_value = core_data.get(data_key)
-                        threshold_value = THRESHOLDS.get(data_key)
-
-                        if current_value is not None and threshold_value is not None:
-                            try:
-                                if float(current_value) >= float(threshold_value):
-                                    # --- MODIFICA PER TRADUZIONE ---
-                                    # Cerca la traduzione italiana, se non c'è usa la chiave inglese formattata
-                                    italian_param_name = TRANSLATIONS.get(data_key, data_key.replace('_', ' ').title())
-                                    safe_italian_param_name = escape_markdown(italian_param_name)
-                                    # ---------------------------------
-
-                                    # Costruisci il messaggio di dettaglio usando il nome italiano
-                                    alert_detail = (
-                                        f"*{safe_station_name}*: " # Nome stazione (già escapato)
-                                        f"{safe_italian_param_name} \\= " # Nome parametro italiano (escapato) + = escapato
-                                        f"`{escape_markdown(current_value)}` " # Valore (escapato) in formato codice
-                                        # Nota: Le unità non sono incluse, potresti aggiungerle se conosci quelle esatte
-                                        f"\\(Soglia: `{escape_markdown(threshold_value)}`\\)" # Soglia (escapata) tra parentesi escapate
-                                    )
-                                    print(f"  ALERT: {data_key} = {current_value} >= {threshold_value} -> {italian_param_name}")
-                                    station_alerts.append(alert_detail)
-                            except (ValueError, TypeError) as e:
-                                print(f"  Attenzione: Impossibile confrontare {data_key} = '{current_value}' con soglia {threshold_value}. Errore: {e}")
-
-                    alerts_to_send.extend(station_alerts)
-
-                else:
-                    print(f"  Errore: Nessun blocco 'data' trovato per {safe_station_name}")
-            else:
-                 print(f"  Errore: Nessun blocco 'sensors' trovato per {safe_station_name}")
-        except Exception as e:
-            print(f"  Errore durante il controllo soglie per {safe_station_name}: {e}")
-    else:
-        print(f"--- Fallito recupero dati (chiamata API) per {safe_station_name} ---")
+    station_alerts = []
+
+    try:
+        if full_data.get("sensors") and len(full_data["sensors"]) > 0:
+            sensor_data_list = full_data["sensors"][0].get("data")
+            if sensor_data_list and len(sensor_data_list) > 0:
+                core_data = sensor_data_list[0]
+
+                for data_key in DATA_TO_MONITOR: # Itera sulle chiavi API inglesi
+                    current_value = core_data.get(data_key)
+                    threshold_value = THRESHOLDS.get(data_key)
+
+                    if current_value is not None and threshold_value is not None:
+                        try:
+                            if float(current_value) >= float(threshold_value):
+                                # --- MODIFICA PER TRADUZIONE ---
+                                # Cerca la traduzione italiana, se non c'è usa la chiave inglese formattata
+                                italian_param_name = TRANSLATIONS.get(data_key, data_key.replace('_', ' ').title())
+                                safe_italian_param_name = escape_markdown(italian_param_name)
+                                # ---------------------------------
+
+                                # Costruisci il messaggio di dettaglio usando il nome italiano
+                                alert_detail = (
+                                    f"*{safe_station_name}*: " # Nome stazione (già escapato)
+                                    f"{safe_italian_param_name} \\= " # Nome parametro italiano (escapato) + = escapato
+                                    f"`{escape_markdown(current_value)}` " # Valore (escapato) in formato codice
+                                    # Nota: Le unità non sono incluse, potresti aggiungerle se conosci quelle esatte
+                                    f"\\(Soglia: `{escape_markdown(threshold_value)}`\\)" # Soglia (escapata) tra parentesi escapate
+                                )
+                                print(f"  ALERT: {data_key} = {current_value} >= {threshold_value} -> {italian_param_name}")
+                                station_alerts.append(alert_detail)
+                        except (ValueError, TypeError) as e:
+                            print(f"  Attenzione: Impossibile confrontare {data_key} = '{current_value}' con soglia {threshold_value}. Errore: {e}")
 
-# --- Invio Messaggio Telegram Consolidato ---
-if alerts_to_send:
-    print("\n--- Soglie superate! Preparazione messaggio Telegram... ---")
+            else:
+                print(f"  Errore: Nessun blocco 'data' trovato per {safe_station_name}")
+        else:
+             print(f"  Errore: Nessun blocco 'sensors' trovato per {safe_station_name}")
+    except Exception as e:
+        print(f"  Errore durante il controllo soglie per {safe_station_name}: {e}")
+
+    return station_alerts
+
+def fetch_all_current_data(stations_info):
+    """
+    Recupera in parallelo i dati /current/{station_id} di tutte le stazioni sulla sessione condivisa.
+    Ogni richiesta è firmata singolarmente; il tempo totale è limitato dalla stazione più lenta.
+    Restituisce una lista di (station_info, full_data) nello stesso ordine di stations_info.
+    """
+    if not stations_info:
+        return []
+    max_workers = min(MAX_CONCURRENT_REQUESTS, len(stations_info))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="weatherlink") as executor:
+        results = executor.map(
+            lambda station_info: get_weatherlink_data(f"/current/{station_info['id']}", API_KEY, API_SECRET),
+            stations_info
+        )
+        return list(zip(stations_info, results))
+
+def check_weatherlink_thresholds():
+    """
+    Scarica i dati correnti di tutte le stazioni in STATIONS_INFO e restituisce
+    gli alert raggruppati per stazione: {nome_stazione: [alert]} nell'ordine di STATIONS_INFO.
+    """
+    alerts_per_station = {}
+
+    start_time = time.monotonic()
+    station_results = fetch_all_current_data(STATIONS_INFO)
+    print(f"Dati di {len(station_results)} stazioni recuperati in {time.monotonic() - start_time:.2f}s")
+
+    for station_info, full_data in station_results:
+        station_id = station_info["id"]
+        station_name = station_info["name"]
+        safe_station_name = escape_markdown(station_name)
+        print(f"\n---> Controllo dati per Stazione: {safe_station_name} (ID: {station_id}) <---")
+
+        if full_data:
+            print(f"Dati ricevuti per {safe_station_name}, controllo soglie...")
+            alerts_per_station[station_name] = check_station_thresholds(station_name, full_data)
+            if alerts_per_station[station_name]:
+                metrics.incrementa("meteo_allerte_totale", len(alerts_per_station[station_name]), fonte="weatherlink", evento="superamento")
+        else:
+            print(f"--- Fallito recupero dati (chiamata API) per {safe_station_name} ---")
+
+    return alerts_per_station
+
+def compose_alerts_message(alerts_to_send):
+    """Compone il messaggio Telegram consolidato (MarkdownV2) per una lista di alert."""
     # Titolo già in italiano
     final_message = "‼️ *Avviso Superamento Soglie* ‼️\n\n"
     final_message += "\n".join(alerts_to_send) # Aggiunge le allerte (già tradotte e formattate)
+    return final_message
+
+def send_alerts_message(alerts_per_station):
+    """Invia a ogni chat sottoscritta il messaggio con gli alert delle sole stazioni di suo interesse."""
+    if any(alerts_per_station.values()):
+        print("\n--- Soglie superate! Preparazione messaggi Telegram... ---")
+        per_chat = subscriptions.registro().distribuisci(subscriptions.STAZIONI_WEATHERLINK, alerts_per_station)
+
+        def componi(stazioni):
+            # Mantiene l'ordine di STATIONS_INFO
+            final_message = compose_alerts_message([alert for name, alerts in alerts_per_station.items() if name in stazioni for alert in alerts])
+            print("--- Messaggio Telegram da inviare ---")
+            print(final_message)
+            print("-----------------------------------")
+            return final_message
+
+        return subscriptions.fan_out(TELEGRAM_TOKEN, per_chat, componi, parse_mode='MarkdownV2') > 0
+    else:
+        print("\n--- Nessuna soglia superata. Nessun messaggio Telegram inviato. ---")
+        return False
 
-    print("--- Messaggio Telegram da inviare ---")
-    print(final_message)
-    print("-----------------------------------")
-
-    send_telegram_message(TELEGRAM_TOKEN, TELEGRAM_CHAT_ID, final_message)
-else:
-    print("\n--- Nessuna soglia superata. Nessun messaggio Telegram inviato. ---")
+def run_weather_check():
+    """Esegue un ciclo completo: recupero dati, controllo soglie e invio Telegram. Ritorna la lista di alert."""
+    print("--- Inizio controllo dati meteo e soglie ---")
+    alerts_per_station = check_weatherlink_thresholds()
+    send_alerts_message(alerts_per_station)
+    print("\n--- Fine controllo dati meteo e soglie ---")
+    return [alert for alerts in alerts_per_station.values() for alert in alerts]
 
-print("\n--- Fine controllo dati meteo e soglie ---")
+# --- Ciclo Principale ---
+if __name__ == "__main__":
+    # Verifica che tutti i segreti siano stati impostati
+    missing = segreti_mancanti()
+    if missing:
+        print(f"Errore: Le seguenti variabili d'ambiente (secrets) mancano: {', '.join(missing)}")
+        exit(1)
+
+    run_weather_check()